@@ -0,0 +1,196 @@
+#
+# benchmark_etl_pipelines.py
+# times each stage of the labs and MoCA ETLs on the synthetic inputs written by
+# generate_synthetic_etl_data.py, so changes can be measured and throughput regressions
+# caught without participant data. a run report is written for each pipeline, see ETLRunReport.
+#
+# two modes:
+#   stubbed (default)  no database, process_labs_etl() and process_moca_etl() are run with the reference 
+#                      tables read from the synthetic OMOP csv files, ids counted from 1, and the records
+#                      written to OMOP csv files in the report directory instead of the database
+#   --db <conn str>    the ETLs are run end to end against a local throwaway postgres, the
+#                      benchmark schema is dropped and recreated and loaded with the synthetic
+#                      person and visit_occurrence tables first
+#
+# usage: python benchmark_etl_pipelines.py --data-dir ./synthetic_data [--pipelines labs moca] [--workers 4]
+#            [--columnar] [--db postgresql+psycopg2://...] [--schema omop_benchmark] [--report-dir ./reports/benchmark]
+#            [--baseline-dir <report dir of an earlier run>] [--tolerance 0.2] [--profile]
+# exits with status 1 when a stage is more than --tolerance slower, in records/sec, than the baseline.
+#
+import os
+import sys
+import json
+import argparse
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+import labs_etl
+import moca_etl
+from omop_etl_utils import OMOPIDBlockAllocator
+from omop_etl_utils import OMOP_CDM_54_MEASUREMENT_DDL, OMOP_CDM_54_OBSERVATION_DDL
+from generate_synthetic_etl_data import SYNTHETIC_BLOOD_DRAW_VISIT_CONCEPT_ID
+
+
+class SyntheticReferenceData():
+    # stands in for OMOPReferenceSnapshotCache in the stubbed mode, the person and visit_occurrence
+    # tables come from the synthetic OMOP csv files and files are read every time
+    def __init__(self, data_dir):
+        self.df_person = pd.read_csv(os.path.join(data_dir, 'OMOP', 'person.csv'))
+        self.df_visits = pd.read_csv(os.path.join(data_dir, 'OMOP', 'visit_occurrence.csv'), parse_dates=['visit_start_date'])
+        self.df_visits['visit_start_date'] = self.df_visits['visit_start_date'].dt.date
+
+    def read_person_birth_years(self, tablename):
+        return self.df_person[['person_id', 'year_of_birth']].drop_duplicates('person_id', keep='last').reset_index(drop=True)
+
+    def read_earliest_visits(self, tablename, visit_concept_id):
+        df = self.df_visits[self.df_visits.visit_concept_id == visit_concept_id]
+        return df.sort_values(['person_id', 'visit_start_date', 'visit_occurrence_id'], kind='stable') \
+                 .drop_duplicates('person_id')[['person_id', 'visit_occurrence_id', 'visit_start_date']].reset_index(drop=True)
+
+    def read_file(self, filename, reader, *args, **kwargs):
+        return reader(filename, *args, **kwargs)
+
+
+def create_stubbed_id_allocator(tablename, idfieldname):
+    # a peek allocator never reserves ids, starting it at 1 means it never reads the high-water mark either
+    allocator = OMOPIDBlockAllocator(tablename, idfieldname, None, peek=True)
+    allocator.next_peek_id = 1
+    return allocator
+
+
+def configure_labs_etl(data_dir, args, report_path, schema_name=None):
+    # point the labs ETL at the synthetic inputs. the module level parameters are read by process_labs_etl(),
+    # which passes the ones its worker processes use to them
+    labs_etl.LABS_SOURCE_DATA_GLOB = os.path.join(data_dir, 'LABS', 'LAB-NORC-*.xlsx')
+    labs_etl.LABS_STANDARDS_MAPPING_CSV_PATH = os.path.join(data_dir, 'LABS', 'labs_standards_mapping.csv')
+    labs_etl.LABS_DATA_DICTIONARY_XLSX_PATH = os.path.join(data_dir, 'LABS', 'labs_data_dictionary.xlsx')
+    labs_etl.LABS_NT_PROBNP_RANGES_SHEETNAME = 'NT-proBNP Ranges'
+    labs_etl.LABS_ALKALINE_PHOSPHATASE_RANGES_SHEETNAME = 'Alkaline Phosphatase Ranges'
+    labs_etl.POSTGRES_LABS_READ_VISIT_OCCURENCE_CONCEPT_ID = SYNTHETIC_BLOOD_DRAW_VISIT_CONCEPT_ID
+    labs_etl.LABS_OMOP_COLUMNAR_TRANSFORM = args.columnar
+    labs_etl.LABS_INCREMENTAL_MODE = False
+    labs_etl.LABS_OMOP_DISPLAY_RECORDS_WHEN_NOT_WRITING_TO_DB = False
+    labs_etl.LABS_RUN_REPORT_PATH = report_path
+    if schema_name is not None:
+        labs_etl.POSTGRES_CONN_STRING_KEY = args.db
+        labs_etl.POSTGRES_OMOP_READ_PERSON_TABLE_NAME = f'{schema_name}.person'
+        labs_etl.POSTGRES_LABS_READ_MEASUREMENT_TABLE_NAME = f'{schema_name}.measurement'
+        labs_etl.POSTGRES_LABS_READ_VISIT_OCCURENCE_TABLE_NAME = f'{schema_name}.visit_occurrence'
+        labs_etl.POSTGRES_LABS_WRITE_SCHEMA_NAME = schema_name
+        labs_etl.POSTGRES_LABS_WRITE_MEASUREMENT_TABLE_NAME = 'measurement'
+        labs_etl.LABS_OMOP_WRITE_TO_DATABASE = True
+        labs_etl.LABS_USE_REFERENCE_SNAPSHOT_CACHE = False
+        labs_etl.LABS_OMOP_FILTER_OUT_EXISTING_RECORDS = False
+    else:
+        labs_etl.LABS_OMOP_WRITE_TO_DATABASE = False
+        labs_etl.LABS_OMOP_FILTER_OUT_EXISTING_RECORDS = False
+        labs_etl.LABS_OMOP_FILE_OUTPUT_DIR = os.path.join(os.path.dirname(report_path), 'labs_output')
+        labs_etl.LABS_OMOP_FILE_OUTPUT_FORMAT = 'csv'
+
+
+def configure_moca_etl(data_dir, args, report_path, schema_name=None):
+    moca_etl.MOCA_SOURCE_DATA_GLOB = ';'.join([os.path.join(data_dir, 'MOCA', 'MOCA-latest.csv'), os.path.join(data_dir, 'MOCA', 'MOCA-latest-Paper.csv')])
+    moca_etl.STANDARDS_MAPPING_CSV_PATH = os.path.join(data_dir, 'MOCA', 'moca_standards_mapping.csv')
+    moca_etl.redcap_report = os.path.join(data_dir, 'MOCA', 'redcap_report.csv')
+    moca_etl.MOCA_OMOP_COLUMNAR_TRANSFORM = args.columnar
+    moca_etl.MOCA_INCREMENTAL_MODE = False
+    moca_etl.MOCA_RUN_REPORT_PATH = report_path
+    if schema_name is not None:
+        moca_etl.POSTGRES_CONN_STRING_KEY = args.db
+        moca_etl.POSTGRES_OMOP_READ_PERSON_TABLE_NAME = f'{schema_name}.person'
+        moca_etl.POSTGRES_MOCA_READ_MEASUREMENT_TABLE_NAME = f'{schema_name}.measurement'
+        moca_etl.POSTGRES_MOCA_READ_OBSERVATION_TABLE_NAME = f'{schema_name}.observation'
+        moca_etl.POSTGRES_MOCA_WRITE_SCHEMA_NAME = schema_name
+        moca_etl.POSTGRES_MOCA_WRITE_MEASUREMENT_TABLE_NAME = 'measurement'
+        moca_etl.POSTGRES_MOCA_WRITE_OBSERVATION_TABLE_NAME = 'observation'
+        moca_etl.MOCA_OMOP_WRITE_TO_DATABASE = True
+        moca_etl.MOCA_USE_REFERENCE_SNAPSHOT_CACHE = False
+        moca_etl.MOCA_OMOP_FILTER_OUT_EXISTING_RECORDS = False
+    else:
+        moca_etl.MOCA_OMOP_WRITE_TO_DATABASE = False
+        moca_etl.MOCA_OMOP_FILTER_OUT_EXISTING_RECORDS = False
+        moca_etl.MOCA_OMOP_FILE_OUTPUT_DIR = os.path.join(os.path.dirname(report_path), 'moca_output')
+        moca_etl.MOCA_OMOP_FILE_OUTPUT_FORMAT = 'csv'
+
+
+def create_benchmark_schema(data_dir, schema_name, engine):
+    # drop and recreate the benchmark schema with empty measurement and observation tables,
+    # and the synthetic person and visit_occurrence tables
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {schema_name} CASCADE"))
+        connection.execute(text(f"CREATE SCHEMA {schema_name}"))
+        connection.execute(text(OMOP_CDM_54_MEASUREMENT_DDL.format(schema=schema_name)))
+        connection.execute(text(OMOP_CDM_54_OBSERVATION_DDL.format(schema=schema_name)))
+    pd.read_csv(os.path.join(data_dir, 'OMOP', 'person.csv')).to_sql('person', schema=schema_name, con=engine, index=False, chunksize=10000)
+    pd.read_csv(os.path.join(data_dir, 'OMOP', 'visit_occurrence.csv'), parse_dates=['visit_start_date']) \
+      .assign(visit_start_date=lambda df: df.visit_start_date.dt.date) \
+      .to_sql('visit_occurrence', schema=schema_name, con=engine, index=False, chunksize=10000)
+    sys.stderr.write(f"Created benchmark schema '{schema_name}'.\n")
+
+
+def compare_with_baseline(report_path, baseline_path, tolerance):
+    # returns the stages more than tolerance slower in records/sec than the baseline run
+    with open(report_path) as f:
+        stages = {s['stage']: s for s in json.load(f)['stages']}
+    with open(baseline_path) as f:
+        baseline_stages = {s['stage']: s for s in json.load(f)['stages']}
+    regressions = []
+    for name, stage in stages.items():
+        baseline = baseline_stages.get(name)
+        if baseline is None or not stage['records_per_second'] or not baseline['records_per_second']:
+            continue
+        ratio = stage['records_per_second'] / baseline['records_per_second']
+        sys.stderr.write(f"\t{name}: {stage['records_per_second']:0.0f} records/sec, {ratio:0.2f}x the baseline\n")
+        if ratio < 1.0 - tolerance:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the labs and MoCA ETL stages on synthetic data')
+    parser.add_argument('--data-dir', default='./synthetic_data', help='output directory of generate_synthetic_etl_data.py (default ./synthetic_data)')
+    parser.add_argument('--pipelines', nargs='+', choices=['labs', 'moca'], default=['labs', 'moca'])
+    parser.add_argument('--workers', type=int, default=1, help='labs worker processes (default 1)')
+    parser.add_argument('--columnar', action='store_true', help='use the columnar transforms')
+    parser.add_argument('--db', default=None, help='postgres connection string of a throwaway database, runs the ETLs end to end')
+    parser.add_argument('--schema', default='omop_benchmark', help='benchmark schema, dropped and recreated (default omop_benchmark)')
+    parser.add_argument('--report-dir', default='./reports/benchmark', help='directory the run reports are written to')
+    parser.add_argument('--baseline-dir', default=None, help='report directory of an earlier benchmark run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown in records/sec reported as a regression (default 0.2)')
+    parser.add_argument('--profile', action='store_true', help='run each stage under cProfile and tracemalloc')
+    args = parser.parse_args()
+
+    mode = 'db' if args.db is not None else 'stubbed'
+    if args.db is not None:
+        create_benchmark_schema(args.data_dir, args.schema, create_engine(args.db))
+    regressions = []
+    for pipeline in args.pipelines:
+        report_name = f"{pipeline}_{mode}_{'columnar' if args.columnar else 'record'}_run_report.json"
+        report_path = os.path.join(args.report_dir, report_name)
+        if pipeline == 'labs':
+            configure_labs_etl(args.data_dir, args, report_path, args.schema if args.db is not None else None)
+            if args.db is not None:
+                labs_etl.process_labs_etl(workers=args.workers, profile=args.profile, mode=mode, columnar=args.columnar)
+            else:
+                # an in-memory sqlite engine stands in for the database, it is connected to but never queried
+                labs_etl.process_labs_etl(workers=args.workers, profile=args.profile, engine=create_engine('sqlite://'), 
+                                          snapshot_cache=SyntheticReferenceData(args.data_dir),
+                                          measurementIDTracker=create_stubbed_id_allocator('measurement', 'measurement_id'),
+                                          mode=mode, columnar=args.columnar)
+        else:
+            configure_moca_etl(args.data_dir, args, report_path, args.schema if args.db is not None else None)
+            if args.db is not None:
+                moca_etl.process_moca_etl(profile=args.profile, mode=mode, columnar=args.columnar)
+            else:
+                moca_etl.process_moca_etl(profile=args.profile, engine=create_engine('sqlite://'),
+                                          snapshot_cache=SyntheticReferenceData(args.data_dir),
+                                          measurementIDTracker=create_stubbed_id_allocator('measurement', 'measurement_id'),
+                                          observationIDTracker=create_stubbed_id_allocator('observation', 'observation_id'),
+                                          mode=mode, columnar=args.columnar)
+        if args.baseline_dir is not None and os.path.exists(os.path.join(args.baseline_dir, report_name)):
+            sys.stderr.write(f"Comparing {pipeline} with the baseline '{args.baseline_dir}':\n")
+            regressions += [f'{pipeline}.{name}' for name in compare_with_baseline(report_path, os.path.join(args.baseline_dir, report_name), args.tolerance)]
+
+    if regressions:
+        sys.stderr.write(f"Throughput regressions in stages: {regressions}\n")
+        sys.exit(1)
@@ -0,0 +1,284 @@
+#
+# generate_synthetic_etl_data.py
+# generates a synthetic set of labs and MoCA ETL inputs, so the pipelines can be run and
+# benchmarked without participant data. no real participant data is used, all the values
+# are random. writes to the output directory:
+#
+#   LABS/LAB-NORC-YYYYMMDD.xlsx      lab workbooks, the four lab sheets, split into several
+#                                    workbooks at --participants-per-workbook
+#   LABS/labs_standards_mapping.csv  lab standards mappings, every Reference_Interval form
+#   LABS/labs_data_dictionary.xlsx   NT-proBNP and Alkaline Phosphatase normal range sheets
+#   MOCA/MOCA-latest.csv             MoCA app results
+#   MOCA/MOCA-latest-Paper.csv       MoCA results entered from paper
+#   MOCA/moca_standards_mapping.csv  MoCA standards mappings
+#   MOCA/redcap_report.csv           redcap report with the physical assessment dates
+#   OMOP/person.csv                  stand-in OMOP person table
+#   OMOP/visit_occurrence.csv        stand-in OMOP visit_occurrence table
+#
+# the source data has the mistakes the ETLs deal with: participant ids as floats and text,
+# blank rows, lab values like '<5', '>1000' and 'Invalid', 'not collected' collection dates,
+# participants missing from the person table or without a blood draw visit, duplicate rows.
+#
+# usage: python generate_synthetic_etl_data.py --participants 1000 --output-dir ./synthetic_data
+#
+import os
+import sys
+import time
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+
+# first synthetic participant id, real AI-READI ids start at 1001 too
+SYNTHETIC_FIRST_PERSON_ID = 1001
+
+# blood draw visit concept, POSTGRES_LABS_READ_VISIT_OCCURENCE_CONCEPT_ID, and another visit type
+SYNTHETIC_BLOOD_DRAW_VISIT_CONCEPT_ID = 32036
+SYNTHETIC_OTHER_VISIT_CONCEPT_ID = 9202
+
+# fractions of participants with data problems
+SYNTHETIC_NOT_IN_PERSON_TABLE_FRACTION = 0.02
+SYNTHETIC_NO_BLOOD_DRAW_VISIT_FRACTION = 0.05
+SYNTHETIC_DUPLICATE_ROW_FRACTION = 0.01
+
+# lab mappings, (Name, Reference_Interval, Units, TARGET_CONCEPT_ID, sheet, column header, typical value),
+# covering each form of Reference_Interval the labs ETL parses. a TARGET_CONCEPT_ID of None is not mapped
+SYNTHETIC_LAB_MAPPINGS = [
+    ('Glucose', '70-99', 'mg/dL', 3004501, 'EDTA Plasma', 'Glucose (mg/dL)', 95.0),
+    ('NT-proBNP', 'see table', 'pg/mL', 3029187, 'EDTA Plasma', 'NT-proBNP (pg/mL)', 80.0),
+    ('HbA1c', None, '%', 3004410, 'Whole blood', 'HbA1c (%)', 5.6),
+    ('Sodium', '136-145', 'mmol/L', 3019550, 'Serum', 'Sodium (mmol/L)', 140.0),
+    ('LDL Cholesterol Calculation', '<100', 'mg/dL', 3028437, 'Serum', 'LDL Cholesterol (calculated field)', 110.0),
+    ('HDL Cholesterol', '>40', 'mg/dL', 3007070, 'Serum', 'HDL Cholesterol (mg/dL)', 50.0),
+    ('Troponin-T', 'Female: <11; Male <16', 'ng/L', 3019800, 'Serum', 'Troponin-T (ng/L)', 8.0),
+    ('ALT (GPT)', 'Female: 7-33, Male Age 0-49: 10-64, Male Age 50+: 10-48', 'U/L', 3006923, 'Serum', 'ALT (GPT) U/L', 25.0),
+    ('Creatinine', 'Female: 0.38-1.02, Male: 0.51-1.18', 'mg/dL', 3016723, 'Serum', 'Creatinine (mg/dL)', 0.9),
+    ('Triglycerides', 'Male: 40-160, Female: 35-135', 'mg/dL', 3022192, 'Serum', 'Triglycerides (mg/dL)', 120.0),
+    ('Ferritin', '>20, <300', 'ng/mL', 3001122, 'Serum', 'Ferritin (ng/mL)', 100.0),
+    ('CRP', '<5, >0', 'mg/L', 3020460, 'Serum', 'CRP (mg/L)', 2.0),
+    ('Alkaline Phosphatase', 'see table', 'U/L', 3035995, 'Serum', 'Alkaline Phosphatase (U/L)', 80.0),
+    ('Urine Albumin', '<30', 'mg/L', 3000034, 'Urine', 'Urine Albumin (mg/L)', 12.0),
+    ('Urine Creatinine', '20-320', 'mg/dL', None, 'Urine', 'Urine Creatinine (mg/dL)', 120.0),
+]
+
+# lab sheets and the header rows above the column names, as in LABS_SHEET_NAMES_AND_SKIP_ROWS
+SYNTHETIC_LAB_SHEET_HEADER_ROWS = {
+    'EDTA Plasma': 2,
+    'Serum': 1,
+    'Whole blood': 1,
+    'Urine': 1,
+}
+
+# MoCA mappings, (SRC_CODE, Data_Type, Value_Range, TARGET_CONCEPT_ID, TARGET_DOMAIN_ID, Protected_or_open-source, Map_to_OMOP)
+SYNTHETIC_MOCA_MAPPINGS = [
+    ('app_generated', 'Text', None, 32879, 'Type Concept', 'open-source', 'No'),
+    ('manually_entered_from_paper', 'Text', None, 32880, 'Type Concept', 'open-source', 'No'),
+    ('moca_visuospatial_executive', 'Integer', '0-5', 40490001, 'Measurement', 'open-source', 'Yes'),
+    ('moca_naming', 'Integer', '0-3', 40490002, 'Measurement', 'open-source', 'Yes'),
+    ('moca_attention', 'Integer', '0-6', 40490003, 'Measurement', 'open-source', 'Yes'),
+    ('moca_language', 'Integer', '0-3', 40490004, 'Measurement', 'open-source', 'Yes'),
+    ('moca_abstraction', 'Integer', '0-2', 40490005, 'Measurement', 'open-source', 'Yes'),
+    ('moca_delayed_recall', 'Integer', '0-5', 40490006, 'Measurement', 'open-source', 'Yes'),
+    ('moca_orientation', 'Integer', '0-6', 40490007, 'Measurement', 'open-source', 'Yes'),
+    ('moca_education_point', 'Integer', None, 40490008, 'Observation', 'open-source', 'Yes'),
+    ('moca_total_score', 'Integer', '0-30', 40490009, 'Measurement', 'open-source', 'Yes'),
+    ('moca_total_score_time', 'Time Duration', None, 40490010, 'Observation', 'open-source', 'Yes'),
+    ('moca_test_comments', 'Text', None, 40490011, 'Observation', 'open-source', 'Yes'),
+    ('moca_examiner_name', 'Text', None, 40490012, 'Observation', 'protected', 'Yes'),
+]
+
+# highest score of each MoCA item
+SYNTHETIC_MOCA_ITEM_MAXIMA = {
+    'moca_visuospatial_executive': 5,
+    'moca_naming': 3,
+    'moca_attention': 6,
+    'moca_language': 3,
+    'moca_abstraction': 2,
+    'moca_delayed_recall': 5,
+    'moca_orientation': 6,
+}
+
+
+def random_dates(rng, n, first=datetime.date(2023, 1, 1), days=730):
+    return np.datetime64(first) + rng.integers(0, days, n).astype('timedelta64[D]')
+
+
+def generate_person_and_visits(person_ids, rng):
+    # the stand-in person table leaves out a few of the participants, and the visit table has
+    # several visits per participant, of the blood draw and other types, a few have no blood draw
+    n = person_ids.shape[0]
+    in_person_table = rng.random(n) >= SYNTHETIC_NOT_IN_PERSON_TABLE_FRACTION
+    df_person = pd.DataFrame({
+        'person_id': person_ids[in_person_table],
+        'gender_concept_id': rng.choice([8507, 8532], in_person_table.sum()),
+        'year_of_birth': rng.integers(1940, 2005, in_person_table.sum()),
+    })
+
+    has_blood_draw = rng.random(n) >= SYNTHETIC_NO_BLOOD_DRAW_VISIT_FRACTION
+    visits = []
+    for visit_concept_id, selected in ((SYNTHETIC_BLOOD_DRAW_VISIT_CONCEPT_ID, has_blood_draw),
+                                       (SYNTHETIC_BLOOD_DRAW_VISIT_CONCEPT_ID, has_blood_draw & (rng.random(n) < 0.3)),
+                                       (SYNTHETIC_OTHER_VISIT_CONCEPT_ID, np.ones(n, dtype=bool))):
+        visits.append(pd.DataFrame({
+            'person_id': person_ids[selected],
+            'visit_concept_id': visit_concept_id,
+            'visit_start_date': random_dates(rng, selected.sum()),
+        }))
+    df_visits = pd.concat(visits, ignore_index=True).sort_values(['person_id', 'visit_start_date'], kind='stable').reset_index(drop=True)
+    df_visits.insert(0, 'visit_occurrence_id', np.arange(1, df_visits.shape[0] + 1))
+    return df_person, df_visits
+
+
+def generate_labs_mapping(path):
+    rows = []
+    for name, reference_interval, units, concept_id, sheet_name, column_name, typical_value in SYNTHETIC_LAB_MAPPINGS:
+        rows.append({'Name': name, 'Data_Type': 'Numeric', 'Reference_Interval': reference_interval, 'Units': units,
+                     'Map_to_OMOP': 'Yes' if concept_id is not None else 'No', 'TARGET_CONCEPT_ID': concept_id,
+                     'TARGET_CONCEPT_NAME': name, 'TARGET_DOMAIN_ID': 'Measurement', 'TARGET_VOCABULARY_ID': 'LOINC',
+                     'TARGET_CONCEPT_CLASS_ID': 'Lab Test', 'TARGET_CONCEPT_CODE': f'{concept_id}' if concept_id is not None else ''})
+    pd.DataFrame(rows).to_csv(path, index=False)
+
+
+def generate_labs_data_dictionary(path, nt_probnp_sheetname='NT-proBNP Ranges', alkaline_phosphatase_sheetname='Alkaline Phosphatase Ranges'):
+    columns = ['Sex', 'Age_Low', 'Age_High', 'Range_Low', 'Range_High']
+    df_nt_probnp = pd.DataFrame([('F', '0d', '30d', 0, 500), ('M', '0d', '30d', 0, 550), ('F', '31d', '17y', 0, 200), ('M', '31d', '17y', 0, 210),
+                                 ('F', '18y', '74y', 0, 125), ('M', '18y', '74y', 0, 100), ('F', '75y', '120y', 0, 450), ('M', '75y', '120y', 0, 450)],
+                                columns=columns)
+    df_alkaline_phosphatase = pd.DataFrame([('F', '0d', '19y', 50, 400), ('M', '0d', '19y', 60, 420),
+                                            ('F', '20y', '120y', 35, 104), ('M', '20y', '120y', 40, 129)], columns=columns)
+    with pd.ExcelWriter(path) as writer:
+        df_nt_probnp.to_excel(writer, sheet_name=nt_probnp_sheetname, index=False)
+        df_alkaline_phosphatase.to_excel(writer, sheet_name=alkaline_phosphatase_sheetname, index=False)
+
+
+def generate_lab_values(rng, n, typical_value):
+    # mostly numbers around the typical value, with a few '<5', '>1000', 'Invalid' and blank values
+    values = np.round(rng.gamma(8.0, typical_value / 8.0, n), 2).astype(object)
+    kind = rng.random(n)
+    values[kind < 0.03] = '<5'
+    values[(kind >= 0.03) & (kind < 0.04)] = '>1000'
+    values[(kind >= 0.04) & (kind < 0.06)] = 'Invalid'
+    values[(kind >= 0.06) & (kind < 0.09)] = np.nan
+    return values
+
+
+def generate_lab_sheet(person_ids, columns, rng):
+    n = person_ids.shape[0]
+    # excel often stores the participant id as text or a float
+    participant_ids = person_ids.astype(object)
+    kind = rng.random(n)
+    participant_ids[kind < 0.1] = [str(pid) for pid in person_ids[kind < 0.1]]
+    participant_ids[(kind >= 0.1) & (kind < 0.15)] = person_ids[(kind >= 0.1) & (kind < 0.15)].astype(float)
+    # collection dates are datetimes, text dates or not collected
+    collection_dates = pd.Series(pd.to_datetime(random_dates(rng, n)), dtype=object)
+    kind = rng.random(n)
+    collection_dates[kind < 0.4] = collection_dates[kind < 0.4].map(lambda d: d.strftime('%m/%d/%Y'))
+    collection_dates[kind > 0.97] = 'not collected'
+    df = pd.DataFrame({'Participant ID': participant_ids, 'Date of Collection': collection_dates.to_numpy()})
+    for column_name, typical_value in columns:
+        df[column_name] = generate_lab_values(rng, n, typical_value)
+    df['Comments'] = np.where(rng.random(n) < 0.05, 'hemolyzed', '')
+    # a few duplicated and blank rows
+    duplicates = df[rng.random(n) < SYNTHETIC_DUPLICATE_ROW_FRACTION]
+    blanks = pd.DataFrame(index=range(max(1, n // 1000)), columns=df.columns)
+    return pd.concat([df, duplicates, blanks], ignore_index=True)
+
+
+def generate_lab_workbooks(labs_dir, person_ids, participants_per_workbook, rng):
+    # one workbook per block of participants, with all of the sheets each
+    filenames = []
+    sheet_columns = {sheet_name: [] for sheet_name in SYNTHETIC_LAB_SHEET_HEADER_ROWS}
+    for name, reference_interval, units, concept_id, sheet_name, column_name, typical_value in SYNTHETIC_LAB_MAPPINGS:
+        sheet_columns[sheet_name].append((column_name, typical_value))
+    for i, first in enumerate(range(0, person_ids.shape[0], participants_per_workbook)):
+        block = person_ids[first:first + participants_per_workbook]
+        filename = os.path.join(labs_dir, f"LAB-NORC-{(datetime.date(2023, 1, 1) + datetime.timedelta(days=i)).strftime('%Y%m%d')}.xlsx")
+        with pd.ExcelWriter(filename) as writer:
+            for sheet_name, header_rows in SYNTHETIC_LAB_SHEET_HEADER_ROWS.items():
+                df_sheet = generate_lab_sheet(block, sheet_columns[sheet_name], rng)
+                # title rows above the column names, skipped by the ETL
+                pd.DataFrame([[f'NORC {sheet_name} results']] * header_rows).to_excel(writer, sheet_name=sheet_name, index=False, header=False)
+                df_sheet.to_excel(writer, sheet_name=sheet_name, index=False, startrow=header_rows)
+        sys.stderr.write(f"Wrote {filename} with {block.shape[0]} participants.\n")
+        filenames.append(filename)
+    return filenames
+
+
+def generate_moca_mapping(path):
+    pd.DataFrame([{'SRC_CODE': src_code, 'Data_Type': data_type, 'Value_Range': value_range, 'TARGET_CONCEPT_ID': concept_id,
+                   'TARGET_CONCEPT_NAME': src_code, 'TARGET_DOMAIN_ID': domain_id, 'Protected_or_open-source': protection,
+                   'Map_to_OMOP': map_to_omop}
+                  for src_code, data_type, value_range, concept_id, domain_id, protection, map_to_omop in SYNTHETIC_MOCA_MAPPINGS]).to_csv(path, index=False)
+
+
+def generate_moca_results(person_ids, rng):
+    n = person_ids.shape[0]
+    # the Institute File number is the participant id, with a few typos and blanks
+    file_numbers = person_ids.astype(str).astype(object)
+    kind = rng.random(n)
+    file_numbers[kind < 0.01] = 'unknown'
+    file_numbers[(kind >= 0.01) & (kind < 0.02)] = np.nan
+    df = pd.DataFrame({'Institute File number': file_numbers})
+    df['test_upload_date'] = pd.Series(pd.to_datetime(random_dates(rng, n))).dt.strftime('%m/%d/%Y %H:%M')
+    df['device_id'] = rng.integers(100000, 999999, n).astype(str)
+    total = np.zeros(n, dtype=np.int64)
+    for src_code, maximum in SYNTHETIC_MOCA_ITEM_MAXIMA.items():
+        scores = rng.integers(0, maximum + 1, n)
+        total += scores
+        df[src_code] = np.where(rng.random(n) < 0.03, np.nan, scores)
+    df['moca_education_point'] = rng.integers(0, 2, n)
+    df['moca_total_score'] = np.minimum(total + df['moca_education_point'].to_numpy(), 30)
+    minutes, seconds = rng.integers(5, 25, n), rng.integers(0, 60, n)
+    df['moca_total_score_time'] = np.where(rng.random(n) < 0.05, None, [f'{m} mins {s}secs' for m, s in zip(minutes, seconds)])
+    df['moca_test_comments'] = rng.choice(np.array([None, None, None, 'no issues', ' participant tired ', 'glasses not available'], dtype=object), n)
+    df['moca_examiner_name'] = 'synthetic examiner'
+    duplicates = df[rng.random(n) < SYNTHETIC_DUPLICATE_ROW_FRACTION]
+    return pd.concat([df, duplicates], ignore_index=True)
+
+
+def generate_redcap_report(path, person_ids, rng):
+    n = person_ids.shape[0]
+    df = pd.DataFrame({'record_id': np.arange(1, n + 1), 'studyid': person_ids, 'redcap_event_name': 'baseline_arm_1',
+                       'pacmpdat': pd.Series(pd.to_datetime(random_dates(rng, n))).dt.strftime('%Y-%m-%d'),
+                       'siteid': rng.choice(['UAB', 'UCSD', 'UW'], n)})
+    # a few participants appear twice
+    df = pd.concat([df, df[rng.random(n) < 0.005]], ignore_index=True)
+    df.to_csv(path, index=False)
+
+
+def generate_synthetic_etl_data(output_dir, n_participants, participants_per_workbook=50000, seed=0):
+    rng = np.random.default_rng(seed)
+    labs_dir, moca_dir, omop_dir = (os.path.join(output_dir, d) for d in ('LABS', 'MOCA', 'OMOP'))
+    for d in (labs_dir, moca_dir, omop_dir):
+        os.makedirs(d, exist_ok=True)
+    person_ids = np.arange(SYNTHETIC_FIRST_PERSON_ID, SYNTHETIC_FIRST_PERSON_ID + n_participants, dtype=np.int64)
+
+    df_person, df_visits = generate_person_and_visits(person_ids, rng)
+    df_person.to_csv(os.path.join(omop_dir, 'person.csv'), index=False)
+    df_visits.to_csv(os.path.join(omop_dir, 'visit_occurrence.csv'), index=False)
+    sys.stderr.write(f"Wrote {df_person.shape[0]} persons and {df_visits.shape[0]} visits.\n")
+
+    generate_labs_mapping(os.path.join(labs_dir, 'labs_standards_mapping.csv'))
+    generate_labs_data_dictionary(os.path.join(labs_dir, 'labs_data_dictionary.xlsx'))
+    generate_lab_workbooks(labs_dir, person_ids, participants_per_workbook, rng)
+
+    # most participants took the MoCA on the app, the rest on paper
+    on_paper = rng.random(n_participants) < 0.25
+    generate_moca_mapping(os.path.join(moca_dir, 'moca_standards_mapping.csv'))
+    generate_moca_results(person_ids[~on_paper], rng).to_csv(os.path.join(moca_dir, 'MOCA-latest.csv'), index=False)
+    generate_moca_results(person_ids[on_paper], rng).to_csv(os.path.join(moca_dir, 'MOCA-latest-Paper.csv'), index=False)
+    generate_redcap_report(os.path.join(moca_dir, 'redcap_report.csv'), person_ids, rng)
+    sys.stderr.write(f"Wrote MoCA results of {(~on_paper).sum()} app and {on_paper.sum()} paper participants.\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='generate synthetic labs and MoCA ETL inputs')
+    parser.add_argument('--participants', type=int, default=1000, help='number of synthetic participants (default 1000)')
+    parser.add_argument('--output-dir', default='./synthetic_data', help='directory the files are written to (default ./synthetic_data)')
+    parser.add_argument('--participants-per-workbook', type=int, default=50000,
+                        help='participants in each LAB-NORC workbook, larger runs are split into several workbooks (default 50000)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+    args = parser.parse_args()
+    start = time.time()
+    generate_synthetic_etl_data(args.output_dir, args.participants, args.participants_per_workbook, args.seed)
+    sys.stderr.write(f"Generated synthetic data for {args.participants} participants in '{args.output_dir}' in {time.time() - start:0.2f} seconds.\n")
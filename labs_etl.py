@@ -13,6 +13,7 @@ from sqlalchemy import create_engine, text
 import glob
 import time
 import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 # configuration imports
 import labs_etl_parameters
@@ -34,19 +35,36 @@ from labs_etl_parameters import POSTGRES_LABS_WRITE_SCHEMA_NAME
 from labs_etl_parameters import POSTGRES_LABS_WRITE_MEASUREMENT_TABLE_NAME
 
 from labs_etl_parameters import LABS_OMOP_WRITE_TO_DATABASE
+from labs_etl_parameters import LABS_OMOP_DATABASE_WRITE_METHOD, LABS_OMOP_COPY_FORMAT
 from labs_etl_parameters import LABS_OMOP_DISPLAY_RECORDS_WHEN_NOT_WRITING_TO_DB
+from labs_etl_parameters import LABS_OMOP_FILE_OUTPUT_DIR, LABS_OMOP_FILE_OUTPUT_FORMAT
 
 from labs_etl_parameters import LABS_OMOP_FILTER_OUT_DUPLICATE_RECORDS
+from labs_etl_parameters import LABS_OMOP_FILTER_OUT_EXISTING_RECORDS, LABS_OMOP_MEASUREMENT_DIGEST_INDEX_PATH
+
+from labs_etl_parameters import LABS_OMOP_COLUMNAR_TRANSFORM
+from labs_etl_parameters import LABS_EXCEL_ENGINE
+from labs_etl_parameters import LABS_INCREMENTAL_MODE, LABS_INCREMENTAL_MANIFEST_PATH
+from labs_etl_parameters import LABS_USE_REFERENCE_SNAPSHOT_CACHE, LABS_REFERENCE_SNAPSHOT_CACHE_DIR
+from labs_etl_parameters import LABS_DIAGNOSTICS_MAX_SAMPLES, LABS_DIAGNOSTICS_QUARANTINE_PATH
+from labs_etl_parameters import LABS_RUN_REPORT_PATH
 
 # omop etl utilities
 from omop_etl_utils import create_empty_measurement_record
+from omop_etl_utils import OMOPMeasurementRecord, records_to_dataframe
 from omop_etl_utils import EQUALS_OMOP_CONCEPT_ID, LESS_THAN_OMOP_CONCEPT_ID
-from omop_etl_utils import labs_string_to_date, labs_string_to_datetime, labs_string_to_time
+from omop_etl_utils import labs_string_to_date_datetime_time, labs_column_to_date_datetime_time
 from omop_etl_utils import LAB_OMOP_CONCEPT_ID
-from omop_etl_utils import OMOPIDTracker
-from omop_etl_utils import dotdict
+from omop_etl_utils import OMOPIDBlockAllocator
+from omop_etl_utils import dotdict, MappingPlan
 from omop_etl_utils import get_table_row_count
+from omop_etl_utils import OMOPRecordDigestIndex, filter_duplicate_records, MEASUREMENT_DIGEST_KEY_COLUMNS
+from omop_etl_utils import ETLIncrementalManifest, file_sha256, compute_mapping_plan_key
+from omop_etl_utils import copy_dataframe_to_table, OMOP_CDM_54_MEASUREMENT_COLUMNS
+from omop_etl_utils import write_omop_dataframe_to_file, OMOP_CDM_54_MEASUREMENT_DEFAULTS
 from omop_etl_utils import OMOPVisitOccurrenceLookup
+from omop_etl_utils import OMOPReferenceSnapshotCache
+from omop_etl_utils import ETLDiagnostics, ETLRunReport
 
 def normalize_lab_test_name(s):
     # convert to lowercase...
@@ -64,7 +82,13 @@ def normalize_lab_test_name(s):
     # return the normalized part
     return s
 
-def create_standards_completed_lab_mappings():
+# bump when compile_labs_mapping_plan() changes, so incremental manifests of the old plan are discarded
+LABS_MAPPING_PLAN_VERSION = 1
+
+def compile_labs_mapping_plan(normal_range_lookups, snapshot_cache=None):
+    # compile the completed standards lab mappings into a read-only plan, with one entry
+    # per mapping holding its normalized lab name and compiled reference range resolver,
+    # and the concept ids as an int array
     MAPPING_COLUMNS_REQUIRED = [
         'Name',
         'Data_Type',
@@ -78,31 +102,75 @@ def create_standards_completed_lab_mappings():
         'TARGET_CONCEPT_CODE',
     ]
 
-    sys.stderr.write("Reading completed standards lab mappings...")
+    sys.stderr.write("Compiling completed standards lab mappings...")
     
     # load mappings files that are completed and ready for mapping...
-    df_labs_mapping = pd.read_csv(LABS_STANDARDS_MAPPING_CSV_PATH)
+    if snapshot_cache is not None:
+        df_labs_mapping = snapshot_cache.read_file(LABS_STANDARDS_MAPPING_CSV_PATH, pd.read_csv)
+    else:
+        df_labs_mapping = pd.read_csv(LABS_STANDARDS_MAPPING_CSV_PATH)
     df_completed_labs_mappings = df_labs_mapping[lambda df: (df['Map_to_OMOP'] == 'Yes') & \
         df.TARGET_CONCEPT_ID.notnull()][MAPPING_COLUMNS_REQUIRED]
 
     # correct data types...
     df_completed_labs_mappings.TARGET_CONCEPT_ID = df_completed_labs_mappings.TARGET_CONCEPT_ID.astype(int)
 
-    # display mappings
-    sys.stderr.write("Display Completed Mappings")
-    for index, mapping_row in df_completed_labs_mappings.iterrows():
-        sys.stderr.write(f"{index} {str(mapping_row)}\n")
-    sys.stderr.write("\n")
-
+    # compile the reference intervals into range resolvers once, report and drop
+    # any mappings whose reference interval can't be parsed, rather than failing mid-run
+    mappings = []
+    for mapping_row in map(dotdict, df_completed_labs_mappings.to_dict('records')):
+        try:
+            resolver = compile_reference_range_resolver(mapping_row, normal_range_lookups)
+        except (ValueError, TypeError, IndexError, AttributeError) as e:
+            sys.stderr.write(f"Unable to parse Reference_Interval '{mapping_row['Reference_Interval']}' for lab mapping '{mapping_row['Name']}', " \
+                             f"skipping this mapping: {e}\n")
+            continue
+        mappings.append(MappingPlan(Name=mapping_row['Name'], normalized_name=normalize_lab_test_name(mapping_row['Name']),
+                                    Data_Type=mapping_row['Data_Type'], Units=mapping_row['Units'],
+                                    TARGET_CONCEPT_ID=int(mapping_row['TARGET_CONCEPT_ID']), Reference_Range_Resolver=resolver))
     sys.stderr.write("OK.\n")
     
-    return df_completed_labs_mappings
+    return MappingPlan(mappings=tuple(mappings),
+                       normalized_names=frozenset(mapping.normalized_name for mapping in mappings),
+                       concept_ids=np.array([mapping.TARGET_CONCEPT_ID for mapping in mappings], dtype=np.int64))
+
+
+def get_labs_mapping_plan_key():
+    # key of the labs mapping plan, changes when the plan would compile differently
+    return compute_mapping_plan_key(LABS_MAPPING_PLAN_VERSION, [LABS_STANDARDS_MAPPING_CSV_PATH, LABS_DATA_DICTIONARY_XLSX_PATH],
+                                    LABS_NT_PROBNP_RANGES_SHEETNAME, LABS_ALKALINE_PHOSPHATASE_RANGES_SHEETNAME)
+
+
+def read_labs_mapping_plan(snapshot_cache=None):
+    # compile the labs mapping plan from the standards mapping csv and the data dictionary 
+    # range sheets, with a snapshot cache those are read from their snapshots when unchanged
+    normal_range_lookups = {
+        'NT-proBNP': NormalRangeLookupTable(LABS_DATA_DICTIONARY_XLSX_PATH, LABS_NT_PROBNP_RANGES_SHEETNAME, snapshot_cache),
+        'Alkaline Phosphatase': NormalRangeLookupTable(LABS_DATA_DICTIONARY_XLSX_PATH, LABS_ALKALINE_PHOSPHATASE_RANGES_SHEETNAME, snapshot_cache),
+    }
+    plan = compile_labs_mapping_plan(normal_range_lookups, snapshot_cache)
+
+    sys.stderr.write(f"Completed lab mappings: {len(plan.mappings)} mappings to {np.unique(plan.concept_ids).shape[0]} concepts.\n")
+    return plan
 
 class OMOPMapPIDToAgeInYears(object):
-    def __init__(self, engine):
-        query = text(f"SELECT person_id, year_of_birth FROM {POSTGRES_OMOP_READ_PERSON_TABLE_NAME}")        
-        df_temp = pd.read_sql(query, engine)      
-        self.pid2age = {int(r.person_id):int(r.year_of_birth) for index, r in df_temp.iterrows()}            
+    def __init__(self, engine, person_ids=None, snapshot_cache=None):
+        # only load the participants in person_ids when given, e.g. the participants in the source batch
+        if snapshot_cache is not None:
+            df_temp = snapshot_cache.read_person_birth_years(POSTGRES_OMOP_READ_PERSON_TABLE_NAME)
+            if person_ids is not None:
+                df_temp = df_temp[df_temp.person_id.isin(person_ids)]
+        elif person_ids is None:
+            query = text(f"SELECT person_id, year_of_birth FROM {POSTGRES_OMOP_READ_PERSON_TABLE_NAME}")        
+            df_temp = pd.read_sql(query, engine)      
+        else:
+            query = text(f"SELECT person_id, year_of_birth FROM {POSTGRES_OMOP_READ_PERSON_TABLE_NAME} WHERE person_id = ANY(:person_ids)")
+            df_temp = pd.read_sql(query, engine, params={'person_ids': [int(pid) for pid in person_ids]})
+        df_temp = df_temp.drop_duplicates('person_id', keep='last').sort_values('person_id')
+        # sorted arrays for batch lookups, and a dict for single lookups
+        self.person_ids = df_temp.person_id.to_numpy(dtype=np.int64)
+        self.years_of_birth = df_temp.year_of_birth.to_numpy(dtype=np.int64)
+        self.pid2age = dict(zip(self.person_ids.tolist(), self.years_of_birth.tolist()))
         self.current_year = datetime.date.today().year
         
     def get_age_in_years(self, pid):
@@ -111,6 +179,16 @@ class OMOPMapPIDToAgeInYears(object):
         else:
             return None
 
+    def get_ages_in_years(self, pids):
+        # batch lookup, returns a float array of ages with NaN for unknown participants
+        pids = np.asarray(pids, dtype=np.int64)
+        ages = np.full(pids.shape[0], np.nan)
+        if self.person_ids.shape[0] > 0:
+            positions = np.searchsorted(self.person_ids, pids).clip(max=self.person_ids.shape[0] - 1)
+            found = self.person_ids[positions] == pids
+            ages[found] = self.current_year - self.years_of_birth[positions[found]]
+        return ages
+
 
 def age_string_to_fractional_years(s):
     yrs = None
@@ -123,26 +201,129 @@ def age_string_to_fractional_years(s):
     return yrs        
 
 
+# status codes returned by the NormalRangeLookupTable batch lookups
+NORMAL_RANGE_FOUND = 0
+NORMAL_RANGE_NO_INTERVAL = 1
+NORMAL_RANGE_OVERLAPPING_INTERVALS = 2
+
+class CompiledNormalRanges():
+    # dense precomputed lookup table for the normal ranges of one sex.
+    # the sorted unique interval end points split the age line into elementary pieces,
+    # each end point and each open gap between end points, and the set of matching 
+    # intervals is the same for every age within a piece. so the match count and the
+    # normal range are worked out once per piece and ages are looked up with a binary search.
+    def __init__(self, age_low_years, age_high_years, range_low, range_high):
+        age_low_years = np.asarray(age_low_years, dtype=float)
+        age_high_years = np.asarray(age_high_years, dtype=float)
+        end_points = np.concatenate((age_low_years, age_high_years))
+        self.end_points = np.unique(end_points[np.isfinite(end_points)])
+
+        # a representative age for every piece, even pieces are the gaps
+        # before each end point (and after the last), odd pieces are the end points
+        k = len(self.end_points)
+        representative_ages = np.full(2*k + 1, np.nan)
+        if k > 0:
+            representative_ages[1::2] = self.end_points
+            representative_ages[2:-1:2] = (self.end_points[:-1] + self.end_points[1:]) / 2
+            representative_ages[0] = self.end_points[0] - 1
+            representative_ages[-1] = self.end_points[-1] + 1
+
+        # match every piece against every interval, this is small
+        matches = (representative_ages[:, None] >= age_low_years[None, :]) & \
+                  (representative_ages[:, None] <= age_high_years[None, :])
+        self.match_count = matches.sum(axis=1)
+        self.range_low = np.full(len(representative_ages), np.nan)
+        self.range_high = np.full(len(representative_ages), np.nan)
+        if matches.shape[1] > 0:
+            first_match = matches.argmax(axis=1)
+            unique_match = self.match_count == 1
+            self.range_low[unique_match] = np.asarray(range_low, dtype=float)[first_match[unique_match]]
+            self.range_high[unique_match] = np.asarray(range_high, dtype=float)[first_match[unique_match]]
+        self.representative_ages = representative_ages
+
+    def lookup_pieces(self, ages_in_years):
+        ages_in_years = np.asarray(ages_in_years, dtype=float)
+        k = len(self.end_points)
+        if k == 0:
+            return np.zeros(ages_in_years.shape, dtype=int)
+        i = np.searchsorted(self.end_points, ages_in_years, side='left')
+        on_end_point = (i < k) & (self.end_points[np.minimum(i, k - 1)] == ages_in_years)
+        return np.where(on_end_point, 2*i + 1, 2*i)
+
+    def lookup(self, ages_in_years):
+        # return arrays of (range_low, range_high, status) for an array of ages
+        pieces = self.lookup_pieces(ages_in_years)
+        match_count = self.match_count[pieces]
+        status = np.where(match_count == 1, NORMAL_RANGE_FOUND, 
+                          np.where(match_count == 0, NORMAL_RANGE_NO_INTERVAL, NORMAL_RANGE_OVERLAPPING_INTERVALS))
+        return self.range_low[pieces], self.range_high[pieces], status
+
+
 class NormalRangeLookupTable():
-    def __init__(self, xlsx_path, sheetname):
-        df_ranges = pd.read_excel(xlsx_path, sheet_name=sheetname)
+    def __init__(self, xlsx_path, sheetname, snapshot_cache=None):
+        if snapshot_cache is not None:
+            df_ranges = snapshot_cache.read_file(xlsx_path, pd.read_excel, sheet_name=sheetname)
+        else:
+            df_ranges = pd.read_excel(xlsx_path, sheet_name=sheetname)
         df_ranges = df_ranges[lambda df: df.Sex.map(lambda s: s in ('M', 'F'))]
         df_ranges['Age_Low_Years'] = df_ranges.Age_Low.map(age_string_to_fractional_years)
         df_ranges['Age_High_Years'] = df_ranges.Age_High.map(age_string_to_fractional_years)
         self.df_ranges = df_ranges
+
+        # compile the ranges once into a sorted interval structure for each sex
+        self.compiled_ranges = {}
+        for sex in ('F', 'M'):
+            df_sex = df_ranges[df_ranges.Sex == sex]
+            compiled = CompiledNormalRanges(df_sex.Age_Low_Years.astype(float), df_sex.Age_High_Years.astype(float), 
+                                            df_sex.Range_Low, df_sex.Range_High)
+            self.compiled_ranges[sex] = compiled
+            # report gaps and overlaps in the table once, up front
+            if len(compiled.end_points) > 0:
+                ignore, ignore, piece_status = compiled.lookup(compiled.representative_ages)
+                inside = (compiled.representative_ages >= compiled.end_points[0]) & (compiled.representative_ages <= compiled.end_points[-1])
+                for status, description in ((NORMAL_RANGE_NO_INTERVAL, 'no'), (NORMAL_RANGE_OVERLAPPING_INTERVALS, 'overlapping')):
+                    flagged_ages = compiled.representative_ages[inside & (piece_status == status)]
+                    if len(flagged_ages) > 0:
+                        sys.stderr.write(f"Normal range table '{sheetname}' has {description} intervals for Sex = {sex} at some ages between " \
+                                         f"{flagged_ages.min():0.3f} and {flagged_ages.max():0.3f} years.\n")
         
+    def lookup_normal_ranges(self, ages_in_years, sexes):
+        # batch lookup, returns arrays of (range_low, range_high, status) for arrays of ages and sexes,
+        # status flags ages that fall into no interval or into overlapping intervals
+        ages_in_years = np.asarray(ages_in_years, dtype=float)
+        sexes = np.broadcast_to(np.asarray(sexes, dtype=object), ages_in_years.shape)
+        range_low = np.full(ages_in_years.shape, np.nan)
+        range_high = np.full(ages_in_years.shape, np.nan)
+        status = np.full(ages_in_years.shape, NORMAL_RANGE_NO_INTERVAL)
+        for sex, compiled in self.compiled_ranges.items():
+            is_sex = sexes == sex
+            range_low[is_sex], range_high[is_sex], status[is_sex] = compiled.lookup(ages_in_years[is_sex])
+        return range_low, range_high, status
+
+    def lookup_normal_superintervals(self, ages_in_years):
+        # batch lookup of the superinterval of the Female and Male normal ranges,
+        # used since we don't have gender information. the status is NORMAL_RANGE_FOUND
+        # only when both the Female and Male ranges were found.
+        low_F, high_F, status_F = self.compiled_ranges['F'].lookup(ages_in_years)
+        low_M, high_M, status_M = self.compiled_ranges['M'].lookup(ages_in_years)
+        status = np.where(status_F != NORMAL_RANGE_FOUND, status_F, status_M)
+        return np.minimum(low_F, low_M), np.maximum(high_F, high_M), status
+
     def lookup_normal_range(self, age_in_years, sex):
-        df_temp = self.df_ranges[lambda df: (df.Sex == sex) \
-                                 & (age_in_years >= df.Age_Low_Years) \
-                                 & (age_in_years <= df.Age_High_Years)]
-        if df_temp.shape[0] == 1:
-            low = df_temp.iloc[0].Range_Low
-            high = df_temp.iloc[0].Range_High
-            return (low, high)
+        low, high, status = self.lookup_normal_ranges([age_in_years], [sex])
+        if status[0] == NORMAL_RANGE_FOUND:
+            return (low[0], high[0])
         else:
             # some kind of error
             return None
 
+    def lookup_normal_superinterval(self, age_in_years):
+        low, high, status = self.lookup_normal_superintervals([age_in_years])
+        if status[0] == NORMAL_RANGE_FOUND:
+            return (low[0], high[0])
+        else:
+            return None
+
     
 def extract_range_from_text(t):
     t = t.strip()
@@ -164,16 +345,154 @@ def compute_superinterval(interval1, interval2):
     return (low, high)
 
 
-def create_measurement(data_row, data_column_name, mapping_row, utilities):
+class FixedReferenceRange():
+    # reference range that does not depend on the participant
+    def __init__(self, range_low, range_high):
+        self.range_low = float(range_low)
+        self.range_high = float(range_high)
+
+    def resolve(self, age_in_years):
+        return (self.range_low, self.range_high)
+
+    def resolve_many(self, ages_in_years):
+        # returns arrays of (range_low, range_high, valid)
+        n = len(ages_in_years)
+        return np.full(n, self.range_low), np.full(n, self.range_high), np.ones(n, dtype=bool)
+
+    def __repr__(self):
+        return f"FixedReferenceRange({self.range_low}, {self.range_high})"
+
+
+class AgeDependentReferenceRange():
+    # reference range that is a function of the participant age, lookup_superintervals
+    # takes an array of ages and returns arrays of (range_low, range_high, status)
+    def __init__(self, description, lookup_superintervals):
+        self.description = description
+        self.lookup_superintervals = lookup_superintervals
+
+    def resolve(self, age_in_years):
+        range_low, range_high, valid = self.resolve_many([age_in_years])
+        if valid[0]:
+            return (range_low[0], range_high[0])
+        else:
+            return None
+
+    def resolve_many(self, ages_in_years):
+        # returns arrays of (range_low, range_high, valid)
+        range_low, range_high, status = self.lookup_superintervals(np.asarray(ages_in_years, dtype=float))
+        return range_low, range_high, status == NORMAL_RANGE_FOUND
+
+    def __repr__(self):
+        return f"AgeDependentReferenceRange('{self.description}')"
+
+
+def alt_gpt_normal_superintervals(ages_in_years):
+    # Female: 7-33, Male Age 0-49: 10-64, Male Age 50+: 10-48
+    # complex logic in string, hardcode this here
+    # note that we know the age, but not the sex, so take the superinterval
+    # of the Female and Male ranges
+    ages_in_years = np.asarray(ages_in_years, dtype=float)
+    range_low = np.full(ages_in_years.shape, float(min(7, 10)))
+    range_high = np.where(ages_in_years <= 49, float(max(33, 64)), float(max(33, 48)))
+    return range_low, range_high, np.full(ages_in_years.shape, NORMAL_RANGE_FOUND)
+
+
+def compile_reference_range_resolver(mapping_row, normal_range_lookups):
+    # turn the Reference_Interval text of a lab mapping into a resolver object once,
+    # instead of parsing the text for every measurement. 
+    # this is a little tricky because sometimes the normal range is in the 
+    # mapping and sometimes we need to use tables loaded from elsewhere
+    # also note that we don't know the sex of the participant, so 
+    # assume always Female, since we have to pick something
+    range_low, range_high = 0.0, 0.0
+    if pd.isna(mapping_row['Reference_Interval']):
+        # no reference range is given
+        range_low = 0.0
+        range_high = 0.0
+    elif mapping_row.Name in ('NT-proBNP', 'Alkaline Phosphatase'):
+        # note: we don't have gender information, so to create the normal range, we use the
+        # max/min of the Male and Female values for the appropriate age, 
+        # not having a reference interval for an age is a fatal error for the record for now
+        return AgeDependentReferenceRange(mapping_row.Name, normal_range_lookups[mapping_row.Name].lookup_normal_superintervals)
+    elif mapping_row.Name == 'Troponin-T':
+        # Female: <11; Male <16
+        # handle special case for this lab, we need to take the larger of the Female and Male ranges
+        fpart, mpart = mapping_row['Reference_Interval'].split(';')
+        fpart = fpart.split(' ')[-1]
+        mpart = mpart.split(' ')[-1]
+        ignore, fvalue = extract_range_from_text(fpart)
+        ignore, mvalue = extract_range_from_text(mpart)
+        range_high = max(fvalue, mvalue)
+        range_low = 0.0
+    elif mapping_row.Name == 'ALT (GPT)':
+        return AgeDependentReferenceRange(mapping_row.Name, alt_gpt_normal_superintervals)
+    elif mapping_row.Name == 'Creatinine':
+        # Female: 0.38-1.02, Male: 0.51-1.18
+        # handle special case for this lab, we need to take the larger of the Female and Male ranges
+        fpart, mpart = mapping_row['Reference_Interval'].split(',')
+        fpart = fpart.split(' ')[-1]
+        mpart = mpart.split(' ')[-1]
+        reference_interval_F = extract_range_from_text(fpart)
+        reference_interval_M = extract_range_from_text(mpart)
+        if reference_interval_F and reference_interval_M:
+            range_low, range_high = compute_superinterval(reference_interval_F, reference_interval_M)
+        else:
+            raise ValueError(f"no Female and Male reference intervals in '{mapping_row['Reference_Interval']}'")
+    elif ',' in mapping_row['Reference_Interval']:
+        parts = mapping_row['Reference_Interval'].split(',')
+        if 'Female:' in parts[0]:
+            t = parts[0].split(':')[-1].strip()
+            range_low, range_high = extract_range_from_text(t)
+        elif 'Female:' in parts[1]:
+            t = parts[1].split(':')[-1].strip()
+            range_low, range_high = extract_range_from_text(t)
+        elif '>' in parts[0] and '<' in parts[1]:
+            low, ignore = extract_range_from_text(parts[0])
+            ignore, high = extract_range_from_text(parts[1])
+            range_low, range_high = low, high
+        elif '<' in parts[0] and '>' in parts[1]:
+            ignore, high = extract_range_from_text(parts[0])
+            low, ignore = extract_range_from_text(parts[1])        
+            range_low, range_high = low, high
+    elif mapping_row['Reference_Interval'][0] == '<':
+        range_low, range_high = extract_range_from_text(mapping_row['Reference_Interval'])
+    elif mapping_row['Reference_Interval'][0] == '>':
+        range_low, range_high = extract_range_from_text(mapping_row['Reference_Interval'])
+    elif '-' in mapping_row['Reference_Interval']:
+        range_low, range_high = extract_range_from_text(mapping_row['Reference_Interval'])        
+    elif len(mapping_row['Reference_Interval']) == 0:
+        # no reference range is given
+        range_low = 0.0
+        range_high = 0.0
+
+    return FixedReferenceRange(range_low, range_high)
+
+
+# reasons reported in the labs ETLDiagnostics
+LABS_REJECTED_NO_AGE = 'measurement records rejected, person_id has no valid age in PERSON table'
+LABS_REJECTED_NO_REFERENCE_RANGE = 'measurement records rejected, no reference range for the age of the participant'
+LABS_WARNING_NO_BLOOD_DRAW_VISIT = 'no blood draw visit_id for person_id, using date from labs xlsx file'
+LABS_REMOVED_DUPLICATE = 'duplicate measurement records removed'
+LABS_WARNING_CHANGED_ROW = 'changed lab sheet rows, their records are appended next to the records of the earlier version already loaded'
+
+def reject_measurement(reason, data_row, data_column_name, mapping_row, diagnostics):
+    # count and quarantine a lab value that is not turned into a measurement record
+    diagnostics.add(reason, mapping_row.Name, data_row['Participant ID'])
+    diagnostics.quarantine_record(reason, {'Participant ID': data_row['Participant ID'], 'Date of Collection': data_row['Date of Collection'],
+                                           'lab_mapping': mapping_row.Name, 'source_column': data_column_name, 
+                                           'value': str(data_row[data_column_name])})
+
+
+def create_measurement(data_row, data_column_name, mapping_row, utilities, diagnostics):
     # create the measurement record or return None if there is a mistake
-    # or if there is no associated person_id
+    # or if there is no associated person_id, the reason is added to diagnostics
     m = create_empty_measurement_record()
     
     m.person_id = data_row['Participant ID']
     age_in_years = utilities.pid2age_mapper.get_age_in_years(m.person_id)    
     if age_in_years is None:
         # no person_id for this participant, so no lab measurements
-        sys.stderr.write(f"Invalid measurement record, person_id = {m.person_id} has no valid age in PERSON table.\n")
+        reject_measurement(LABS_REJECTED_NO_AGE, data_row, data_column_name, mapping_row, diagnostics)
         return None
     
     # process concept ids
@@ -190,10 +509,7 @@ def create_measurement(data_row, data_column_name, mapping_row, utilities):
     m.measurement_source_concept_id = 0
     
     # process dates and times
-    m.measurement_date = labs_string_to_date(data_row['Date of Collection'])
-    m.measurement_datetime = labs_string_to_datetime(data_row['Date of Collection'])
-    #print(data_row['Date of Collection'], data_row['Participant ID'])
-    m.measurement_time = labs_string_to_time(data_row['Date of Collection'])
+    m.measurement_date, m.measurement_datetime, m.measurement_time = labs_string_to_date_datetime_time(data_row['Date of Collection'])
     
     # process unit values
     m.unit_source_value = mapping_row.Units
@@ -216,97 +532,15 @@ def create_measurement(data_row, data_column_name, mapping_row, utilities):
          m.operator_concept_id = EQUALS_OMOP_CONCEPT_ID
         
     # process normal ranges
-    # this is a little tricky because sometimes the normal range is in the 
-    # mapping and sometimes we need to use tables loaded from elsewhere
-    # also note that we don't know the sex of the participant, so 
-    # assume always Female, since we have to pick something
-    if pd.isna(mapping_row['Reference_Interval']):
-        # no reference range is given
-        m.range_low = 0.0
-        m.range_high = 0.0
-    elif mapping_row.Name == 'NT-proBNP':
-        # note: we don't have gender information, so to create the normal range, we use the
-        # max/min of the Male and Female values for the appropriate age
-        reference_interval_F = utilities.NT_PROBNP_NormalRangeLookup.lookup_normal_range(age_in_years, 'F')
-        reference_interval_M = utilities.NT_PROBNP_NormalRangeLookup.lookup_normal_range(age_in_years, 'M')
-        if reference_interval_F and reference_interval_M:
-            m.range_low, m.range_high = compute_superinterval(reference_interval_F, reference_interval_M)
-        else:
-            # treat not having a reference interval as a fatal error for now
-            return None
-    elif mapping_row.Name == 'Alkaline Phosphatase':
-        reference_interval_F = utilities.ALKALINE_PHOSPHATASE_NormalRangeLookup.lookup_normal_range(age_in_years, 'F')
-        reference_interval_M = utilities.ALKALINE_PHOSPHATASE_NormalRangeLookup.lookup_normal_range(age_in_years, 'M')
-        if reference_interval_F and reference_interval_M:
-            m.range_low, m.range_high = compute_superinterval(reference_interval_F, reference_interval_M)
-        else:
-            # treat not having a reference interval as a fatal error for now
-            return None
-    elif mapping_row.Name == 'Troponin-T':
-        # Female: <11; Male <16
-        # handle special case for this lab, we need to take the larger of the Female and Male ranges
-        fpart, mpart = mapping_row['Reference_Interval'].split(';')
-        fpart = fpart.split(' ')[-1]
-        mpart = mpart.split(' ')[-1]
-        ignore, fvalue = extract_range_from_text(fpart)
-        ignore, mvalue = extract_range_from_text(mpart)
-        m.range_high = max(fvalue, mvalue)
-        m.range_low = 0.0
-    elif mapping_row.Name == 'ALT (GPT)':
-        # Female: 7-33, Male Age 0-49: 10-64, Male Age 50+: 10-48
-        # handle special case for this lab, we need to take the larger of the Female and Male ranges
-        # complex logic in string, hardcode this here
-        # note that we know the age, but not the sex,
-        reference_interval_F = (7, 33)
-        if age_in_years <= 49:
-            reference_interval_M = (10, 64)
-        else:
-            reference_interval_M = (10, 48)
-        m.range_low, m.range_high = compute_superinterval(reference_interval_F, reference_interval_M)
-    elif mapping_row.Name == 'Creatinine':
-        # Female: 0.38-1.02, Male: 0.51-1.18
-        # handle special case for this lab, we need to take the larger of the Female and Male ranges
-        fpart, mpart = mapping_row['Reference_Interval'].split(',')
-        fpart = fpart.split(' ')[-1]
-        mpart = mpart.split(' ')[-1]
-        reference_interval_F = extract_range_from_text(fpart)
-        reference_interval_M = extract_range_from_text(mpart)
-        if reference_interval_F and reference_interval_M:
-            m.range_low, m.range_high = compute_superinterval(reference_interval_F, reference_interval_M)
-        else:
-            # treat not having a reference interval as a fatal error for now
-            return None
-    elif ',' in mapping_row['Reference_Interval']:
-        parts = mapping_row['Reference_Interval'].split(',')
-        if 'Female:' in parts[0]:
-            t = parts[0].split(':')[-1].strip()
-            m.range_low, m.range_high = extract_range_from_text(t)
-            pass
-        elif 'Female:' in parts[1]:
-            t = parts[1].split(':')[-1].strip()
-            m.range_low, m.range_high = extract_range_from_text(t)
-        elif '>' in parts[0] and '<' in parts[1]:
-            low, ignore = extract_range_from_text(parts[0])
-            ignore, high = extract_range_from_text(parts[1])
-            m.range_low, m.range_high = low, high
-        elif '<' in parts[0] and '>' in parts[1]:
-            ignore, high = extract_range_from_text(parts[0])
-            low, ignore = extract_range_from_text(parts[1])        
-            m.range_low, m.range_high = low, high
-    elif mapping_row['Reference_Interval'][0] == '<':
-        m.range_low, m.range_high = extract_range_from_text(mapping_row['Reference_Interval'])
-    elif mapping_row['Reference_Interval'][0] == '>':
-        m.range_low, m.range_high = extract_range_from_text(mapping_row['Reference_Interval'])
-    elif '-' in mapping_row['Reference_Interval']:
-        m.range_low, m.range_high = extract_range_from_text(mapping_row['Reference_Interval'])        
-    elif len(mapping_row['Reference_Interval']) == 0:
-        # no reference range is given
-        m.range_low = 0.0
-        m.range_high = 0.0
+    reference_range = mapping_row.Reference_Range_Resolver.resolve(age_in_years)
+    if reference_range is None:
+        # treat not having a reference interval as a fatal error for now
+        reject_measurement(LABS_REJECTED_NO_REFERENCE_RANGE, data_row, data_column_name, mapping_row, diagnostics)
+        return None
+    m.range_low, m.range_high = reference_range
         
-    # assign new measurement_id when we are sure that we have
-    # a valid new record
-    m.measurement_id = utilities.measurementIDTracker.get_next_id()
+    # measurement_id is assigned once all of the records have been
+    # merged and filtered, see assign_measurement_ids()
 
     # fix up the date of the lab blood draw and insert the visit_occurrence 
     # if we have one in the lookup table...
@@ -318,47 +552,211 @@ def create_measurement(data_row, data_column_name, mapping_row, utilities):
         m.measurement_datetime = datetime.datetime(year=visit_date.year, month=visit_date.month, day=visit_date.day)
         m.measurement_time = m.measurement_datetime.time()
     else:
-        sys.stderr.write(f"Unable to find blood draw visit_id for person_id {m.person_id}, using date from labs xlsx file.\n")
+        diagnostics.add(LABS_WARNING_NO_BLOOD_DRAW_VISIT, mapping_row.Name, m.person_id)
 
 
     # return the valid record
     return m
 
 
-def process_lab_sheet_row(r, utilities):
+def build_lab_sheet_column_index(sheet_columns, labs_mapping_plan, sheet_name):
+    # work out which sheet columns match which lab mappings once per sheet,
+    # from the sheet header, instead of once per participant row.
+    # just look for prefix matching, since the data has units after the
+    # lab name. the index is a list of (column name, plan mapping) pairs in
+    # mapping order, then column order, which is the order records are created in.
+    normalized_columns = [(k, normalize_lab_test_name(str(k))) for k in sheet_columns]
+    column_index = []
+    mapping_names_by_column = {}
+    columns_by_mapping_name = {}
+    for mapping_row in labs_mapping_plan.mappings:
+        for k, normalized_k in normalized_columns:
+            if normalized_k == mapping_row.normalized_name:
+                column_index.append((k, mapping_row))
+                mapping_names_by_column.setdefault(k, []).append(mapping_row.Name)
+                columns_by_mapping_name.setdefault(mapping_row.Name, []).append(k)
+
+    # report ambiguous columns once for the whole sheet, the columns with no lab
+    # mapping are not read, they are reported by read_lab_workbook()
+    for k, names in mapping_names_by_column.items():
+        if len(names) > 1:
+            sys.stderr.write(f"\t Sheet '{sheet_name}' column '{k}' matches more than one lab mapping: {names}\n")
+    for name, columns in columns_by_mapping_name.items():
+        if len(columns) > 1:
+            sys.stderr.write(f"\t Sheet '{sheet_name}' lab mapping '{name}' matches more than one column: {columns}\n")
+
+    return column_index
+
+
+def process_lab_sheet_row(r, column_index, utilities, diagnostics):
     labs_measurements = []
     bad_record_count = 0
-    for index, mapping_row in utilities.df_completed_labs_mappings.iterrows():
-        # look for a match to create a record
-        # just look for prefix matching, since the data has units after the
-        # lab name. this is a nest loop, and not greatly fast, but we need
-        # to check all the rows.
-        # could be optimized by truncating the value names if necessary
-        for k in r.keys():
-            if normalize_lab_test_name(k) == normalize_lab_test_name(mapping_row.Name):
-                # found a matching value, create the measurement
-                m = create_measurement(r, k, mapping_row, utilities)
-                if m:
-                    labs_measurements.append(m)
-                else:
-                    bad_record_count += 1
+    for k, mapping_row in column_index:
+        # found a matching value, create the measurement
+        m = create_measurement(r, k, mapping_row, utilities, diagnostics)
+        if m:
+            labs_measurements.append(m)
+        else:
+            bad_record_count += 1
                     
     return labs_measurements, bad_record_count
 
 
 ## Added by SRC 10/22/24: Do not process a row if the date of collection is missing or 'not collected'
-def process_lab_sheet(df_lab_sheet, utilities):
+def process_lab_sheet(df_lab_sheet, column_index, utilities, diagnostics):
     labs_measurements = []
     bad_record_count = 0
     for index, r in df_lab_sheet.iterrows():
         if pd.notna(r['Date of Collection']) and r['Date of Collection'] != 'not collected ' and r['Date of Collection'] != 'not collected':
            #print(r['Participant ID'],r['Date of Collection']) 
-           ms, bad = process_lab_sheet_row(r, utilities)
+           ms, bad = process_lab_sheet_row(r, column_index, utilities, diagnostics)
            labs_measurements.extend(ms)
            bad_record_count += bad
     return labs_measurements, bad_record_count
 
 
+def select_collected_lab_sheet_rows(df_lab_sheet):
+    # vectorized version of the date of collection check in process_lab_sheet()
+    collection_dates = df_lab_sheet['Date of Collection']
+    collected = collection_dates.notna() & (collection_dates != 'not collected ') & (collection_dates != 'not collected')
+    return df_lab_sheet[collected.to_numpy(dtype=bool)]
+
+
+def convert_lab_value_strings(values):
+    # vectorized version of the value processing in create_measurement():
+    # '<x' and '>x' get the less than operator, 'Invalid' gets no value or operator,
+    # everything else must be a number and gets the equals operator.
+    values = pd.Series(values, dtype=object)
+    first_characters = values.str[0]
+    is_comparison = first_characters.isin(['<', '>']).to_numpy()
+    is_invalid = (values == 'Invalid').to_numpy() & ~is_comparison
+    number_strings = values.where(~is_comparison, values.str[1:])
+    value_as_number = pd.to_numeric(number_strings.where(~is_invalid, '0.0'), errors='coerce').to_numpy(dtype=float)
+
+    # to_numeric() is stricter than float(), so retry anything it could not convert with float(),
+    # which raises for a genuinely bad value exactly as the per-record path does
+    retry = np.isnan(value_as_number) & ~is_invalid & (number_strings != 'nan').to_numpy()
+    for i in np.flatnonzero(retry):
+        value_as_number[i] = float(number_strings.iat[i])
+
+    operator_concept_id = np.where(is_comparison, LESS_THAN_OMOP_CONCEPT_ID, 
+                                   np.where(is_invalid, 0, EQUALS_OMOP_CONCEPT_ID))
+    return value_as_number, operator_concept_id
+
+
+def concat_measurement_dataframes(df_measurements):
+    # concatenate measurement DataFrames, skipping empty ones so that they don't turn
+    # every column into an object column
+    df_measurements = [df for df in df_measurements if df.shape[0] > 0]
+    if len(df_measurements) == 0:
+        return pd.DataFrame(columns=list(OMOPMeasurementRecord.fields))
+    return pd.concat(df_measurements, ignore_index=True)
+
+
+def process_lab_sheet_columnar(df_lab_sheet, column_index, utilities, diagnostics):
+    # columnar version of process_lab_sheet(), returns a DataFrame of MEASUREMENT
+    # records that matches the per-record path field for field, and the bad record count.
+    # the same events are added to diagnostics as by the per-record path
+    measurement_columns = list(OMOPMeasurementRecord.fields)
+    df_lab_sheet = select_collected_lab_sheet_rows(df_lab_sheet)
+    n_rows = df_lab_sheet.shape[0]
+    n_pairs = len(column_index)
+    if n_rows == 0 or n_pairs == 0:
+        return pd.DataFrame(columns=measurement_columns), 0
+
+    # melt the sheet into a long frame of (participant, column, value) in row order, 
+    # then column index order, which is the order the per-record path creates records in
+    column_names = [k for k, mapping_row in column_index]
+    row_position = np.repeat(np.arange(n_rows), n_pairs)
+    pair_position = np.tile(np.arange(n_pairs), n_rows)
+    df_long = pd.DataFrame({
+        'person_id': df_lab_sheet['Participant ID'].to_numpy()[row_position],
+        'collection_date': df_lab_sheet['Date of Collection'].to_numpy(dtype=object)[row_position],
+        'pair_position': pair_position,
+        'value_source_value': pd.Series(df_lab_sheet[column_names].to_numpy(dtype=object).ravel(), dtype=object).map(str).to_numpy(dtype=object),
+    })
+
+    # look up ages and blood draw visits once per participant, 
+    # participants without an age have no lab measurements
+    df_person = pd.DataFrame({'person_id': df_long['person_id'].unique()})
+    df_person['age_in_years'] = utilities.pid2age_mapper.get_ages_in_years(df_person['person_id'].to_numpy())
+    visit_occurrence_ids, visit_start_dates, has_visit = utilities.pid2visit_mapper.get_earliest_visits(df_person['person_id'].to_numpy())
+    df_person['visit_occurrence_id'] = visit_occurrence_ids
+    df_person['visit_date'] = pd.Series(visit_start_dates, dtype=object)
+    df_long = df_long.merge(df_person, on='person_id', how='left')
+
+    # resolve the reference ranges for the distinct ages of each mapping in one batch,
+    # missing reference ranges are treated as a fatal error for the record as in create_measurement()
+    df_ranges = df_long.loc[df_long['age_in_years'].notna(), ['pair_position', 'age_in_years']].drop_duplicates()
+    df_ranges = df_ranges.sort_values('pair_position', kind='stable').reset_index(drop=True)
+    range_low, range_high, has_range = [], [], []
+    for j, df_pair in df_ranges.groupby('pair_position', sort=True):
+        low, high, valid = column_index[j][1].Reference_Range_Resolver.resolve_many(df_pair['age_in_years'].to_numpy())
+        range_low.append(low)
+        range_high.append(high)
+        has_range.append(valid)
+    df_ranges['range_low'] = np.concatenate(range_low).astype(float) if range_low else np.zeros(0)
+    df_ranges['range_high'] = np.concatenate(range_high).astype(float) if range_high else np.zeros(0)
+    df_ranges['has_range'] = np.concatenate(has_range).astype(bool) if has_range else np.zeros(0, dtype=bool)
+    df_long = df_long.merge(df_ranges, on=['pair_position', 'age_in_years'], how='left')
+
+    keep = df_long['has_range'].eq(True).to_numpy()
+    bad_record_count = int(n_rows * n_pairs - keep.sum())
+    mapping_names = np.array([mapping_row.Name for k, mapping_row in column_index], dtype=object)
+    df_events = pd.DataFrame({
+        'Participant ID': df_long['person_id'],
+        'Date of Collection': df_long['collection_date'],
+        'lab_mapping': mapping_names[df_long['pair_position'].to_numpy()],
+        'source_column': np.array(column_names, dtype=object)[df_long['pair_position'].to_numpy()],
+        'value': df_long['value_source_value'],
+    })
+    no_age = df_long['age_in_years'].isna().to_numpy()
+    diagnostics.add_rows(LABS_REJECTED_NO_AGE, df_events[no_age], 'lab_mapping', 'Participant ID')
+    diagnostics.add_rows(LABS_REJECTED_NO_REFERENCE_RANGE, df_events[~no_age & ~keep], 'lab_mapping', 'Participant ID')
+    diagnostics.add_rows(LABS_WARNING_NO_BLOOD_DRAW_VISIT, df_events[keep & df_long['visit_date'].isna().to_numpy()], 
+                         'lab_mapping', 'Participant ID', quarantine=False)
+    df_long = df_long[keep].reset_index(drop=True)
+    if df_long.shape[0] == 0:
+        return pd.DataFrame(columns=measurement_columns), bad_record_count
+
+    # fill in the OMOP columns with array operations
+    pair_position = df_long['pair_position'].to_numpy()
+    df_m = pd.DataFrame(index=df_long.index)
+    df_m['person_id'] = df_long['person_id'].astype(int)
+    df_m['measurement_concept_id'] = np.array([mapping_row.TARGET_CONCEPT_ID for k, mapping_row in column_index], dtype=np.int64)[pair_position]
+    df_m['measurement_type_concept_id'] = LAB_OMOP_CONCEPT_ID
+    df_m['value_as_concept_id'] = 0
+    df_m['unit_concept_id'] = 0 # these have not been mapped by standards yet
+    df_m['provider_id'] = 0
+    df_m['visit_occurrence_id'] = df_long['visit_occurrence_id'].astype(int)
+    df_m['visit_detail_id'] = 0
+    df_m['measurement_source_value'] = np.array(column_names, dtype=object)[pair_position]
+    df_m['measurement_source_concept_id'] = 0
+    df_m['unit_source_value'] = np.array([mapping_row.Units for k, mapping_row in column_index], dtype=object)[pair_position]
+    df_m['unit_source_concept_id'] = 0 # these have not been mapped by standards yet
+    df_m['measurement_event_id'] = 0
+    df_m['meas_event_field_concept_id'] = 0
+    df_m['value_source_value'] = df_long['value_source_value']
+    df_m['value_as_number'], df_m['operator_concept_id'] = convert_lab_value_strings(df_long['value_source_value'])
+    df_m['range_low'] = df_long['range_low']
+    df_m['range_high'] = df_long['range_high']
+
+    # parse each distinct collection date once
+    measurement_date, measurement_datetime, measurement_time = labs_column_to_date_datetime_time(df_long['collection_date'])
+
+    # fix up the date of the lab blood draw if we have a visit in the lookup table...
+    has_visit = df_long['visit_date'].notna().to_numpy()
+    visit_datetime = pd.to_datetime(df_long['visit_date'].where(has_visit))
+    df_m['measurement_date'] = measurement_date.where(~has_visit, df_long['visit_date']).astype(object)
+    df_m['measurement_datetime'] = measurement_datetime.where(~has_visit, visit_datetime)
+    df_m['measurement_time'] = measurement_time.where(~has_visit, datetime.time(0, 0)).astype(object)
+
+    # measurement_id is assigned once all of the records have been
+    # merged and filtered, see assign_measurement_ids_dataframe()
+    df_m['measurement_id'] = None
+
+    return df_m[measurement_columns], bad_record_count
+
 
 def safe_participant_id_converstion(s):
     if pd.isna(s):
@@ -376,34 +774,188 @@ def safe_participant_id_converstion(s):
             return 0
 
 
-def process_lab_source_file(filename, utilities):
-    LABS_SHEET_NAMES_AND_SKIP_ROWS = {
-        'EDTA Plasma' : [0, 1], 
-        'Serum' : [0], 
-        'Whole blood' : [0], 
-        'Urine' : [0],        
-    }
-    
+# lab sheets to process in each source file, and the rows to skip above the header
+LABS_SHEET_NAMES_AND_SKIP_ROWS = {
+    'EDTA Plasma' : [0, 1], 
+    'Serum' : [0], 
+    'Whole blood' : [0], 
+    'Urine' : [0],        
+}
+
+def clean_lab_sheet(df_lab_sheet):
+    # remove any blank rows, these are found by having an NA value in particpant ID...
+    df_lab_sheet = df_lab_sheet[lambda df: df['Participant ID'].notna()].reset_index(drop=True).copy()
+
+    # need to clean up Participant ID so that it is always integer
+    # since sometimes Excel thinks that it is text that looks like a float
+    df_lab_sheet['Participant ID'] = df_lab_sheet['Participant ID'].map(safe_participant_id_converstion)
+    df_lab_sheet['Participant ID']  =  df_lab_sheet['Participant ID'].astype(int)
+
+    return df_lab_sheet
+
+
+# columns in the lab sheets that identify the participant and sample,
+# these are never expected to match a lab mapping
+LABS_SHEET_NON_LAB_COLUMNS = ('Participant ID', 'Date of Collection')
+
+def read_lab_workbook(filename, labs_mapping_plan, sheet_names=None, excel_engine=None):
+    # open the workbook once and read all of the configured lab sheets from it,
+    # instead of parsing the whole xlsx file again for every sheet.
+    # only the columns that match a lab mapping, plus the participant id and
+    # collection date, are read. sheet_names optionally limits the sheets read.
+    # excel_engine is the pandas excel engine, None for the default.
+    # returns a dict of sheet name to DataFrame.
+    mapped_names = labs_mapping_plan.normalized_names
+    lab_sheets = {}
+    with pd.ExcelFile(filename, engine=excel_engine) as workbook:
+        for sn, sr in LABS_SHEET_NAMES_AND_SKIP_ROWS.items():
+            if sheet_names is not None and sn not in sheet_names:
+                continue
+            unread_columns = []
+            def is_lab_sheet_column(k):
+                if k in LABS_SHEET_NON_LAB_COLUMNS or normalize_lab_test_name(str(k)) in mapped_names:
+                    return True
+                unread_columns.append(k)
+                return False
+            df_lab_sheet = workbook.parse(sn, skiprows=sr, usecols=is_lab_sheet_column)
+            if unread_columns:
+                sys.stderr.write(f"\t Sheet '{sn}' has {len(unread_columns)} columns with no lab mapping: {unread_columns}\n")
+            lab_sheets[sn] = clean_lab_sheet(df_lab_sheet)
+
+    return lab_sheets
+
+
+# columns that identify a lab sheet row, a new row with the same values is a changed row
+LABS_INCREMENTAL_ROW_KEY_COLUMNS = ['Participant ID', 'Date of Collection']
+
+def select_unprocessed_lab_sheet_rows(df_lab_sheet, sheet_name, utilities, row_fingerprints):
+    # in incremental mode only keep the sheet rows that are new or changed since the last run,
+    # the (fingerprints, key fingerprints, changed mask) of the kept rows are put in row_fingerprints by sheet name
+    if utilities.incremental_manifest is None:
+        return df_lab_sheet
+    n_rows = df_lab_sheet.shape[0]
+    df_lab_sheet, fingerprints, key_fingerprints, changed = utilities.incremental_manifest.select_unprocessed_rows(
+        df_lab_sheet, sheet_name, LABS_INCREMENTAL_ROW_KEY_COLUMNS)
+    row_fingerprints[sheet_name] = (fingerprints, key_fingerprints, changed)
+    sys.stderr.write(f"\t Sheet '{sheet_name}' has {df_lab_sheet.shape[0]} new or changed rows out of {n_rows}, {changed.sum()} of them changed.\n")
+    return df_lab_sheet
+
+
+def update_labs_incremental_manifest(manifest, work_units, read_results, filenames, file_hashes, pid2age_mapper):
+    # remember the rows read this run, and the files all of whose rows were read, once their
+    # records are written. rows of participants with no age in the PERSON table yet produced no
+    # records, these rows and their files are left out so they are read again on the next run.
+    # rows rejected for any other reason would be rejected again, they are remembered.
+    # returns the number of rows left for the next run
+    retried_filenames = set()
+    n_retried = 0
+    for (filename, sheet_name), (lab_sheets, row_fingerprints) in zip(work_units, read_results):
+        for sn, df_lab_sheet in lab_sheets.items():
+            fingerprints, key_fingerprints, changed = row_fingerprints[sn]
+            retried = ~np.isin(df_lab_sheet['Participant ID'].to_numpy(dtype=np.int64), pid2age_mapper.person_ids)
+            if retried.any():
+                retried_filenames.add(filename)
+                n_retried += int(retried.sum())
+            manifest.add_row_fingerprints(sn, fingerprints[~retried], key_fingerprints[~retried])
+    for filename in filenames:
+        if filename not in retried_filenames:
+            manifest.add_file(filename, file_hashes[filename])
+    return n_retried
+
+
+# read-only utility objects shared with each worker process by initialize_lab_worker()
+_lab_worker_utilities = None
+
+def get_labs_worker_settings():
+    # the parameters the read and transform work units use, passed to the worker processes in
+    # the utilities. spawned workers import this module afresh, so they would not see parameters
+    # set at run time, e.g. by the benchmark
+    return dotdict(columnar_transform=LABS_OMOP_COLUMNAR_TRANSFORM,
+                   excel_engine=LABS_EXCEL_ENGINE,
+                   diagnostics_max_samples=LABS_DIAGNOSTICS_MAX_SAMPLES,
+                   diagnostics_quarantine=LABS_DIAGNOSTICS_QUARANTINE_PATH is not None)
+
+def initialize_lab_worker(utilities):
+    global _lab_worker_utilities
+    _lab_worker_utilities = utilities
+
+
+def build_lab_work_units(filenames, workers):
+    # a work unit is a (filename, sheet name) pair, a sheet name of None means
+    # all of the lab sheets in the file. files are split into sheets only when
+    # there are more workers than files. units are in the same order as serial processing.
+    if workers > len(filenames):
+        return [(filename, sn) for filename in filenames for sn in LABS_SHEET_NAMES_AND_SKIP_ROWS]
+    return [(filename, None) for filename in filenames]
+
+
+def read_lab_work_unit(work_unit, utilities=None):
+    # read the lab sheets of one work unit, in incremental mode only the new or changed rows.
+    # uses the worker's shared utilities when run in a worker process. returns the lab sheets 
+    # by sheet name and, in incremental mode, the fingerprints of the rows read by sheet name
+    filename, sheet_name = work_unit
+    if utilities is None:
+        utilities = _lab_worker_utilities
+    sheet_names = None if sheet_name is None else [sheet_name]
+    if sheet_name is None:
+        sys.stderr.write(f"Reading lab data file: {filename}\n")
+    else:
+        sys.stderr.write(f"Reading lab data file: {filename} sheet: '{sheet_name}'\n")
+    lab_sheets = read_lab_workbook(filename, utilities.labs_mapping_plan, sheet_names, utilities.settings.excel_engine)
+    row_fingerprints = {}
+    for sn in lab_sheets:
+        lab_sheets[sn] = select_unprocessed_lab_sheet_rows(lab_sheets[sn], sn, utilities, row_fingerprints)
+    return lab_sheets, row_fingerprints
+
+
+def create_labs_diagnostics(settings):
+    return ETLDiagnostics('Labs', settings.diagnostics_max_samples, quarantine=settings.diagnostics_quarantine)
+
+
+def transform_lab_sheets(lab_sheets, utilities=None):
+    # transform the lab sheets of one work unit into measurements without measurement_ids,
+    # a list of records or, with the columnar transform, a DataFrame, the bad record count and
+    # the diagnostics of the work unit. uses the worker's shared utilities when run in a worker process
+    if utilities is None:
+        utilities = _lab_worker_utilities
     labs_measurements = []
-    bad_record_count = 0    
-    # loop over the lab sheets, process each sheet into measurements
-    for sn, sr in LABS_SHEET_NAMES_AND_SKIP_ROWS.items():
+    bad_record_count = 0
+    diagnostics = create_labs_diagnostics(utilities.settings)
+    for sn, df_lab_sheet in lab_sheets.items():
         sys.stderr.write(f"\t Processing Sheet = '{sn}'.\n")
-        df_lab_sheet = pd.read_excel(filename, sheet_name=sn, skiprows=sr)
 
-        # remove any blank rows, these are found by having an NA value in particpant ID...
-        df_lab_sheet = df_lab_sheet[lambda df: df['Participant ID'].notna()].reset_index(drop=True).copy()
+        # match the sheet columns to the lab mappings once for the whole sheet
+        column_index = build_lab_sheet_column_index(df_lab_sheet.columns, utilities.labs_mapping_plan, sn)
 
-        # need to clean up Participant ID so that it is always integer
-        # since sometimes Excel thinks that it is text that looks like a float
-        df_lab_sheet['Participant ID'] = df_lab_sheet['Participant ID'].map(safe_participant_id_converstion)
-        df_lab_sheet['Participant ID']  =  df_lab_sheet['Participant ID'].astype(int)
-
-        ms, bad = process_lab_sheet(df_lab_sheet, utilities)
-        labs_measurements.extend(ms)
+        if utilities.settings.columnar_transform:
+            df_m, bad = process_lab_sheet_columnar(df_lab_sheet, column_index, utilities, diagnostics)
+            labs_measurements.append(df_m)
+        else:
+            ms, bad = process_lab_sheet(df_lab_sheet, column_index, utilities, diagnostics)
+            labs_measurements.extend(ms)
         bad_record_count += bad
-        
-    return labs_measurements, bad_record_count
+
+    if utilities.settings.columnar_transform:
+        return concat_measurement_dataframes(labs_measurements), bad_record_count, diagnostics
+    return labs_measurements, bad_record_count, diagnostics
+
+
+def run_lab_work_units(function, work_items, utilities, workers):
+    # run function over the work items serially, or across a pool of worker processes,
+    # returns the results in work item order
+    if workers <= 1:
+        return [function(work_item, utilities) for work_item in work_items]
+    # the workers do not assign ids, so they get everything but the id tracker
+    worker_utilities = dotdict({k: v for k, v in utilities.items() if k != 'measurementIDTracker'})
+    with ProcessPoolExecutor(max_workers=workers, initializer=initialize_lab_worker, initargs=(worker_utilities,)) as executor:
+        return list(executor.map(function, work_items))
+
+
+def assign_measurement_ids_dataframe(df_measurements, measurementIDTracker):
+    # assign new measurement_ids in record order once all of the valid new records
+    # are merged and filtered, so the ids do not depend on how the work was split up
+    df_measurements['measurement_id'] = measurementIDTracker.get_next_ids(df_measurements.shape[0])
+    return df_measurements
 
 
 def display_labs_configuration_parameters():
@@ -413,84 +965,168 @@ def display_labs_configuration_parameters():
             sys.stderr.write(f"\t{name} = '{value}'\n")
 
 
-def hash_measurement_record(m):
-    hstring = f'{m.person_id}_{m.measurement_datetime}_{m.measurement_source_value}_{m.value_source_value}'
-    return hash(hstring)
+def filter_duplicate_measurement_dataframe(df_measurements, digest_index=None, diagnostics=None):
+    # keep the first record having each unique digest of the essential distinctive 
+    # source data fields, and drop records already in the database when given a digest_index.
+    # the duplicates are added to diagnostics by measurement_source_value
+    df_filtered, duplicated, existing = filter_duplicate_records(df_measurements, MEASUREMENT_DIGEST_KEY_COLUMNS, digest_index)
+    if duplicated.any():
+        sys.stderr.write(f"Removing {duplicated.sum()} duplicate records.\n")
+        if diagnostics is not None:
+            diagnostics.add_rows(LABS_REMOVED_DUPLICATE, df_measurements[duplicated], 'measurement_source_value', 'person_id', quarantine=False)
+    if existing.any():
+        sys.stderr.write(f"Removing {existing.sum()} records already in the OMOP database.\n")
+    return df_filtered
 
 
-def filter_duplicate_measurement_records(labs_measurements):
-    # filter duplicate records in one pass by hashing essential distinctive record
-    # source data fields and only keeping the first record having each unique hash....
-    hash_set = set()
-    filtered_labs_measurements = []
-    for m in labs_measurements:
-        h = hash_measurement_record(m)
-        if h in hash_set:
-            sys.stderr.write(f"Removing duplicate record for person_id:{m['person_id']}, measurement_source_value:{m['measurement_source_value']}\n")
-        else:
-            hash_set.add(h)
-            filtered_labs_measurements.append(m)
-    return filtered_labs_measurements
-
-
-def process_labs_etl():
+def process_labs_etl(workers=1, profile=False, engine=None, snapshot_cache=None, measurementIDTracker=None, **report_info):
+    # engine, snapshot_cache, the source of the reference tables and files, and measurementIDTracker
+    # can be passed in, e.g. by the benchmark, otherwise they are created from the parameters.
+    # report_info is added to the run report
     # begin timing
     sys.stderr.write(f"Starting process_labs_etl().\n")
     display_labs_configuration_parameters()                        
     start = time.time()
+    report = ETLRunReport('labs', LABS_RUN_REPORT_PATH, profile, workers=workers, **report_info)
     
     # connect to the omop database
-    engine = create_engine(POSTGRES_CONN_STRING_KEY)
+    if engine is None:
+        engine = create_engine(POSTGRES_CONN_STRING_KEY)
     connection = engine.connect()    
 
-    # create utility objects
-    utilities = dotdict()
-    utilities.df_completed_labs_mappings = create_standards_completed_lab_mappings()
-    utilities.measurementIDTracker = OMOPIDTracker(POSTGRES_LABS_READ_MEASUREMENT_TABLE_NAME, 'measurement_id', engine)
-    utilities.ALKALINE_PHOSPHATASE_NormalRangeLookup = NormalRangeLookupTable(LABS_DATA_DICTIONARY_XLSX_PATH, LABS_ALKALINE_PHOSPHATASE_RANGES_SHEETNAME)
-    utilities.NT_PROBNP_NormalRangeLookup = NormalRangeLookupTable(LABS_DATA_DICTIONARY_XLSX_PATH, LABS_NT_PROBNP_RANGES_SHEETNAME)
-    utilities.pid2age_mapper = OMOPMapPIDToAgeInYears(engine)
-    utilities.pid2visit_mapper = OMOPVisitOccurrenceLookup(POSTGRES_LABS_READ_VISIT_OCCURENCE_TABLE_NAME, POSTGRES_LABS_READ_VISIT_OCCURENCE_CONCEPT_ID, engine)
+    with report.stage('reference_load'):
+        # local snapshots of the reference data, refreshed when the tables or files change
+        if snapshot_cache is None and LABS_USE_REFERENCE_SNAPSHOT_CACHE:
+            snapshot_cache = OMOPReferenceSnapshotCache(LABS_REFERENCE_SNAPSHOT_CACHE_DIR, engine)
 
-    # extract data measurement records
-    labs_measurements = []
-    bad_record_count = 0
-    # loop over lab source data files
-    for filename in glob.glob(LABS_SOURCE_DATA_GLOB):
-        sys.stderr.write(f"Processing lab data file: {filename}\n")
-        ms, bad = process_lab_source_file(filename, utilities)
-        labs_measurements.extend(ms)
-        bad_record_count += bad
-    sys.stderr.write(f"Found {len(labs_measurements)} valid records and rejected {bad_record_count} invalid records.\n")
+        # create utility objects, the worker processes get the parameters they use in the settings
+        utilities = dotdict()
+        utilities.settings = get_labs_worker_settings()
+        utilities.labs_mapping_plan = read_labs_mapping_plan(snapshot_cache)
+        # ids are only reserved when the records will be written
+        if measurementIDTracker is None:
+            measurementIDTracker = OMOPIDBlockAllocator(POSTGRES_LABS_READ_MEASUREMENT_TABLE_NAME, 'measurement_id', engine, 
+                                                        peek=not LABS_OMOP_WRITE_TO_DATABASE)
+        utilities.measurementIDTracker = measurementIDTracker
+        utilities.incremental_manifest = None
+
+    with report.stage('source_read') as stage:
+        # in incremental mode skip the source files that have not changed since the last run,
+        # and only transform the rows of the other files that are new or changed
+        filenames = glob.glob(LABS_SOURCE_DATA_GLOB)
+        if LABS_INCREMENTAL_MODE:
+            utilities.incremental_manifest = ETLIncrementalManifest(LABS_INCREMENTAL_MANIFEST_PATH, get_labs_mapping_plan_key())
+            file_hashes = {filename: file_sha256(filename) for filename in filenames}
+            filenames = [filename for filename in filenames if not utilities.incremental_manifest.is_file_unchanged(filename, file_hashes[filename])]
+            sys.stderr.write(f"Incremental mode, {len(filenames)} of {len(file_hashes)} lab data files are new or changed.\n")
+
+        # read the lab source files, one work unit per file or per sheet
+        work_units = build_lab_work_units(filenames, workers)
+        sys.stderr.write(f"Reading {len(work_units)} lab work units with {workers} workers.\n")
+        read_results = run_lab_work_units(read_lab_work_unit, work_units, utilities, workers)
+        stage.records = sum(df_lab_sheet.shape[0] for lab_sheets, row_fingerprints in read_results for df_lab_sheet in lab_sheets.values())
+    
+    with report.stage('participant_lookup') as stage:
+        # look up ages and visits for just the participants in the lab sheets
+        person_ids = np.unique(np.concatenate([np.zeros(0, dtype=np.int64)] + [df_lab_sheet['Participant ID'].to_numpy(dtype=np.int64) 
+                                               for lab_sheets, row_fingerprints in read_results for df_lab_sheet in lab_sheets.values()]))
+        utilities.pid2age_mapper = OMOPMapPIDToAgeInYears(engine, person_ids, snapshot_cache)
+        sys.stderr.write(f"Loaded ages of {len(utilities.pid2age_mapper.pid2age)} of {person_ids.shape[0]} participants in the lab data files.\n")
+        utilities.pid2visit_mapper = OMOPVisitOccurrenceLookup(POSTGRES_LABS_READ_VISIT_OCCURENCE_TABLE_NAME, POSTGRES_LABS_READ_VISIT_OCCURENCE_CONCEPT_ID, engine, 
+                                                               person_ids, snapshot_cache)
+        stage.records = person_ids.shape[0]
+
+    with report.stage('transform') as stage:
+        # transform the lab sheets
+        sys.stderr.write(f"Transforming {len(work_units)} lab work units with {workers} workers.\n")
+        results = run_lab_work_units(transform_lab_sheets, [lab_sheets for lab_sheets, row_fingerprints in read_results], utilities, workers)
+
+        # merge the results in work unit order
+        bad_record_count = sum(bad for ms, bad, diagnostics in results)
+        diagnostics = create_labs_diagnostics(utilities.settings)
+        for ms, bad, work_unit_diagnostics in results:
+            diagnostics.merge(work_unit_diagnostics)
+        if LABS_INCREMENTAL_MODE:
+            for lab_sheets, row_fingerprints in read_results:
+                for sn, df_lab_sheet in lab_sheets.items():
+                    changed = row_fingerprints[sn][2]
+                    diagnostics.add_rows(LABS_WARNING_CHANGED_ROW, df_lab_sheet[changed].assign(sheet=sn), 'sheet', 'Participant ID', quarantine=False)
+        if utilities.settings.columnar_transform:
+            df_new_measurements = concat_measurement_dataframes([ms for ms, bad, work_unit_diagnostics in results])
+        else:
+            df_new_measurements = records_to_dataframe([m for ms, bad, work_unit_diagnostics in results for m in ms], OMOPMeasurementRecord)
+        n_valid = df_new_measurements.shape[0]
+        sys.stderr.write(f"Found {n_valid} valid records and rejected {bad_record_count} invalid records.\n")
+        stage.records = n_valid + bad_record_count
 
     if LABS_OMOP_FILTER_OUT_DUPLICATE_RECORDS:
-        sys.stderr.write("Filtering out duplicate records...\n")
-        sys.stderr.write(f"Starting with {len(labs_measurements)} Measurement records.\n")
-        labs_measurements = filter_duplicate_measurement_records(labs_measurements)
-        sys.stderr.write(f"Now have {len(labs_measurements)} unique Measurement records.\n")
-        sys.stderr.write("OK, filtering complete.\n\n")
+        with report.stage('dedup') as stage:
+            stage.records = n_valid
+            sys.stderr.write("Filtering out duplicate records...\n")
+            sys.stderr.write(f"Starting with {n_valid} Measurement records.\n")
+            digest_index = None
+            if LABS_OMOP_FILTER_OUT_EXISTING_RECORDS:
+                digest_index = OMOPRecordDigestIndex(POSTGRES_LABS_WRITE_SCHEMA_NAME, POSTGRES_LABS_WRITE_MEASUREMENT_TABLE_NAME, 'measurement_id',
+                                                     MEASUREMENT_DIGEST_KEY_COLUMNS, LABS_OMOP_MEASUREMENT_DIGEST_INDEX_PATH, engine)
+            df_new_measurements = filter_duplicate_measurement_dataframe(df_new_measurements, digest_index, diagnostics)
+            n_valid = df_new_measurements.shape[0]
+            sys.stderr.write(f"Now have {n_valid} unique Measurement records.\n")
+            sys.stderr.write("OK, filtering complete.\n\n")
+
+    with report.stage('id_assignment') as stage:
+        # assign measurement_ids to the merged and filtered records
+        df_new_measurements = assign_measurement_ids_dataframe(df_new_measurements, utilities.measurementIDTracker)
+        stage.records = n_valid
 
     if LABS_OMOP_WRITE_TO_DATABASE:
-        # write measurement records to OMOP database as append...
-        n_before = get_table_row_count(POSTGRES_LABS_WRITE_SCHEMA_NAME, POSTGRES_LABS_WRITE_MEASUREMENT_TABLE_NAME, engine)    
-        df_new_measurements = pd.DataFrame([dict(m) for m in labs_measurements])        
-        ignore = df_new_measurements.to_sql(POSTGRES_LABS_WRITE_MEASUREMENT_TABLE_NAME, schema=POSTGRES_LABS_WRITE_SCHEMA_NAME, 
-                                                if_exists='append', index=False, con=engine)
-        n_wrote = get_table_row_count(POSTGRES_LABS_WRITE_SCHEMA_NAME, POSTGRES_LABS_WRITE_MEASUREMENT_TABLE_NAME, engine) - n_before        
-        sys.stderr.write(f"Appended {n_wrote} MEASUREMENT records to table '{POSTGRES_LABS_WRITE_SCHEMA_NAME}.{POSTGRES_LABS_WRITE_MEASUREMENT_TABLE_NAME}'.\n")
+        with report.stage('db_write') as stage:
+            # write measurement records to OMOP database as append...
+            if LABS_OMOP_DATABASE_WRITE_METHOD == 'copy':
+                # COPY reports the exact number of rows written
+                n_wrote = copy_dataframe_to_table(df_new_measurements, POSTGRES_LABS_WRITE_SCHEMA_NAME, POSTGRES_LABS_WRITE_MEASUREMENT_TABLE_NAME, 
+                                                  OMOP_CDM_54_MEASUREMENT_COLUMNS, engine, copy_format=LABS_OMOP_COPY_FORMAT)
+            else:
+                n_before = get_table_row_count(POSTGRES_LABS_WRITE_SCHEMA_NAME, POSTGRES_LABS_WRITE_MEASUREMENT_TABLE_NAME, engine)    
+                ignore = df_new_measurements.to_sql(POSTGRES_LABS_WRITE_MEASUREMENT_TABLE_NAME, schema=POSTGRES_LABS_WRITE_SCHEMA_NAME, 
+                                                        if_exists='append', index=False, con=engine)
+                n_wrote = get_table_row_count(POSTGRES_LABS_WRITE_SCHEMA_NAME, POSTGRES_LABS_WRITE_MEASUREMENT_TABLE_NAME, engine) - n_before        
+            sys.stderr.write(f"Appended {n_wrote} MEASUREMENT records to table '{POSTGRES_LABS_WRITE_SCHEMA_NAME}.{POSTGRES_LABS_WRITE_MEASUREMENT_TABLE_NAME}'.\n")
+            stage.records = n_wrote
+
+        # the new records are written, remember the files and rows they came from
+        if LABS_INCREMENTAL_MODE:
+            n_retried = update_labs_incremental_manifest(utilities.incremental_manifest, work_units, read_results, filenames, file_hashes, 
+                                                         utilities.pid2age_mapper)
+            utilities.incremental_manifest.save()
+            sys.stderr.write(f"Updated incremental manifest '{LABS_INCREMENTAL_MANIFEST_PATH}', {n_retried} rows of participants not in the PERSON table are read again next run.\n")
     else:
         sys.stderr.write("*** Skipping writing records to database.***\n")
         sys.stderr.write("Set configuration option LABS_OMOP_WRITE_TO_DATABASE to True to enable write.\n")
+        if LABS_INCREMENTAL_MODE:
+            sys.stderr.write(f"Incremental manifest '{LABS_INCREMENTAL_MANIFEST_PATH}' not updated.\n")
         if LABS_OMOP_DISPLAY_RECORDS_WHEN_NOT_WRITING_TO_DB:
             sys.stderr.write("*** Printing records to stdout for debugging.***\n")
-            for index, row in enumerate(labs_measurements):
+            for index, row in enumerate(df_new_measurements.to_dict(orient='records')):
                 sys.stdout.write(f"{index} {str(row)}\n")
 
+    # write the records to OMOP CDM files, to diff between runs or bulk load later
+    if LABS_OMOP_FILE_OUTPUT_DIR is not None:
+        with report.stage('file_write') as stage:
+            filename = os.path.join(LABS_OMOP_FILE_OUTPUT_DIR, f'measurement.{LABS_OMOP_FILE_OUTPUT_FORMAT}')
+            stage.records = write_omop_dataframe_to_file(df_new_measurements, filename, OMOP_CDM_54_MEASUREMENT_COLUMNS, OMOP_CDM_54_MEASUREMENT_DEFAULTS)
+            sys.stderr.write(f"Wrote {stage.records} MEASUREMENT records to file '{filename}'.\n")
+
+    # report the warnings and rejections of the whole run
+    diagnostics.write_summary()
+    if LABS_DIAGNOSTICS_QUARANTINE_PATH is not None:
+        n_quarantined = diagnostics.write_quarantine(LABS_DIAGNOSTICS_QUARANTINE_PATH)
+        sys.stderr.write(f"Wrote {n_quarantined} rejected rows to quarantine file '{LABS_DIAGNOSTICS_QUARANTINE_PATH}'.\n")
+
     # close database connection
     connection.close()
 
     # end timing
+    report.info['diagnostics'] = {reason: diagnostics.get_total(reason) for reason, key in diagnostics.counts}
+    report.write()
     elapsed = time.time() - start    
     sys.stderr.write(f"Completed process_labs_etl() in {elapsed:0.2f} seconds.\n")
-
-
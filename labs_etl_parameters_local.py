@@ -22,15 +22,70 @@ LABS_ALKALINE_PHOSPHATASE_RANGES_SHEETNAME = 'Alkaline Phosphatase Ranges'
 # glob wildcard path to the raw MOCA source data files
 LABS_SOURCE_DATA_GLOB = './LABS/EXAMPLE_DATA/LAB-NORC-????????.xlsx'
 
+# pandas engine used to read the LAB-NORC xlsx files, None uses the pandas default (openpyxl),
+# 'calamine' is much faster for large workbooks but needs the python-calamine package
+LABS_EXCEL_ENGINE = None
+
 # control filtering out DUPLICATE records
 LABS_OMOP_FILTER_OUT_DUPLICATE_RECORDS = True
 
+# control also filtering out records that are already in the OMOP measurement table,
+# off by default, only used when filtering out duplicate records. the digests of the existing records
+# are kept in an on-disk index, only records added since the last run are read from the database
+LABS_OMOP_FILTER_OUT_EXISTING_RECORDS = False
+LABS_OMOP_MEASUREMENT_DIGEST_INDEX_PATH = './cache/measurement_digest_index.npz'
+
+# control incremental runs, source files that have not changed since the last run are skipped
+# and only the new or changed participant rows of the other files are transformed and appended.
+# the manifest of loaded files and rows is only updated after the records are written. rows of participants
+# not in the person table yet, and their files, are read again on the next run, and all files and rows are
+# processed again when the mapping files change. changed rows are reported in the diagnostics, the records
+# of their earlier version are not removed
+LABS_INCREMENTAL_MODE = False
+LABS_INCREMENTAL_MANIFEST_PATH = './cache/labs_incremental_manifest.npz'
+
+# control caching the reference data read on each run (the person and visit_occurrence tables,
+# the standards mapping csv and the data dictionary range sheets) as local snapshots, shared with
+# the MoCA ETL. snapshots are refreshed when the tables or files change, which is checked
+# from the tables' row count, highest id and statistics counters. off by default, the parquet snapshots
+# are written to the cache directory, relative to the working directory unless it is an absolute path
+LABS_USE_REFERENCE_SNAPSHOT_CACHE = False
+LABS_REFERENCE_SNAPSHOT_CACHE_DIR = './cache/reference_snapshots'
+
+# warnings and rejected records are counted by reason and lab mapping and summarized at the end
+# of the run, with this many sample person_ids of each. set the quarantine path, a .csv or .parquet
+# file, e.g. './quarantine/labs_rejected.csv', to also write the full rejected rows
+LABS_DIAGNOSTICS_MAX_SAMPLES = 5
+LABS_DIAGNOSTICS_QUARANTINE_PATH = None
+
+# JSON run report with the seconds, records/sec and peak memory of each stage of the run,
+# None for no report. with --profile the stage profiles are written next to it
+LABS_RUN_REPORT_PATH = './reports/labs_run_report.json'
+
+# control transforming lab sheets with the columnar (array based) engine
+# instead of creating one record at a time, the output records are the same
+LABS_OMOP_COLUMNAR_TRANSFORM = False
+
 # control writing to the OMOP database, for debugging
 LABS_OMOP_WRITE_TO_DATABASE = True
 
+# method used to write records to the OMOP database, 'copy' streams the records
+# with postgres COPY ... FROM STDIN, 'to_sql' appends them with INSERT statements
+LABS_OMOP_DATABASE_WRITE_METHOD = 'copy'
+
+# COPY format used when writing with the 'copy' method, 'text' or 'binary'
+LABS_OMOP_COPY_FORMAT = 'text'
+
 # control displaying records when not writing to OMOP database, for debugging
 LABS_OMOP_DISPLAY_RECORDS_WHEN_NOT_WRITING_TO_DB = False
 
+# directory to also write the new MEASUREMENT records to as OMOP CDM files, e.g. './output/labs',
+# for dry runs with LABS_OMOP_WRITE_TO_DATABASE = False and for bulk loading later. None for no files
+LABS_OMOP_FILE_OUTPUT_DIR = None
+
+# format of those files, 'parquet' or 'csv'
+LABS_OMOP_FILE_OUTPUT_FORMAT = 'parquet'
+
 
 
 
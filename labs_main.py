@@ -2,8 +2,14 @@
 #
 # simple python script to kick off the AIREADI main labs etl processing function
 #
+import argparse
 from labs_etl import process_labs_etl
 
 if __name__ == '__main__':
-    process_labs_etl()
-
+    parser = argparse.ArgumentParser(description='AIREADI labs OMOP ETL')
+    parser.add_argument('--workers', type=int, default=1, 
+                        help='number of worker processes used to read and transform the lab files and sheets (default 1)')
+    parser.add_argument('--profile', action='store_true',
+                        help='run each stage under cProfile and tracemalloc and write the profiles next to the run report')
+    args = parser.parse_args()
+    process_labs_etl(workers=args.workers, profile=args.profile)
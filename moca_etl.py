@@ -11,22 +11,35 @@ import pandas as pd
 import numpy as np
 from sqlalchemy import create_engine, text
 import glob
+from concurrent.futures import ThreadPoolExecutor
 import time
 import re
 
 # utility imports
 from omop_etl_utils import create_empty_measurement_record
 from omop_etl_utils import create_empty_observation_record
-from omop_etl_utils import moca_string_to_date, moca_string_to_datetime, moca_string_to_time
+from omop_etl_utils import OMOPMeasurementRecord, OMOPObservationRecord, records_to_dataframe
+from omop_etl_utils import OMOP_CDM_54_MEASUREMENT_DEFAULTS, OMOP_CDM_54_OBSERVATION_DEFAULTS
+from omop_etl_utils import moca_string_to_date_datetime_time, moca_column_to_date_datetime_time
 from omop_etl_utils import STANDARD_ALGORITHM_OMOP_CONCEPT_ID, EQUALS_OMOP_CONCEPT_ID
-from omop_etl_utils import OMOPIDTracker
+from omop_etl_utils import OMOPIDBlockAllocator
 from omop_etl_utils import get_table_row_count
+from omop_etl_utils import OMOPRecordDigestIndex, filter_duplicate_records
+from omop_etl_utils import MEASUREMENT_DIGEST_KEY_COLUMNS, OBSERVATION_DIGEST_KEY_COLUMNS
+from omop_etl_utils import ETLIncrementalManifest, file_sha256, compute_mapping_plan_key
+from omop_etl_utils import OMOPReferenceSnapshotCache, MappingPlan
+from omop_etl_utils import ETLDiagnostics, ETLRunReport
+from omop_etl_utils import copy_dataframe_to_table, OMOP_CDM_54_MEASUREMENT_COLUMNS, OMOP_CDM_54_OBSERVATION_COLUMNS
+from omop_etl_utils import write_omop_dataframe_to_file
 
 # configurable parameter imports
 import moca_etl_parameters
 from moca_etl_parameters import POSTGRES_CONN_STRING_KEY
 from moca_etl_parameters import STANDARDS_MAPPING_CSV_PATH
 from moca_etl_parameters import MOCA_SOURCE_DATA_GLOB
+from moca_etl_parameters import MOCA_CSV_ENGINE, MOCA_SOURCE_READ_THREADS
+from moca_etl_parameters import MOCA_DIAGNOSTICS_MAX_SAMPLES, MOCA_DIAGNOSTICS_QUARANTINE_PATH
+from moca_etl_parameters import MOCA_RUN_REPORT_PATH
 
 from moca_etl_parameters import POSTGRES_OMOP_READ_PERSON_TABLE_NAME
 
@@ -37,7 +50,14 @@ from moca_etl_parameters import POSTGRES_MOCA_WRITE_SCHEMA_NAME
 from moca_etl_parameters import POSTGRES_MOCA_WRITE_MEASUREMENT_TABLE_NAME
 from moca_etl_parameters import POSTGRES_MOCA_WRITE_OBSERVATION_TABLE_NAME
 
+from moca_etl_parameters import MOCA_OMOP_FILTER_OUT_DUPLICATE_RECORDS, MOCA_OMOP_FILTER_OUT_EXISTING_RECORDS
+from moca_etl_parameters import MOCA_OMOP_MEASUREMENT_DIGEST_INDEX_PATH, MOCA_OMOP_OBSERVATION_DIGEST_INDEX_PATH
+from moca_etl_parameters import MOCA_INCREMENTAL_MODE, MOCA_INCREMENTAL_MANIFEST_PATH
+from moca_etl_parameters import MOCA_OMOP_COLUMNAR_TRANSFORM
+from moca_etl_parameters import MOCA_USE_REFERENCE_SNAPSHOT_CACHE, MOCA_REFERENCE_SNAPSHOT_CACHE_DIR
 from moca_etl_parameters import MOCA_OMOP_WRITE_TO_DATABASE
+from moca_etl_parameters import MOCA_OMOP_DATABASE_WRITE_METHOD, MOCA_OMOP_COPY_FORMAT
+from moca_etl_parameters import MOCA_OMOP_FILE_OUTPUT_DIR, MOCA_OMOP_FILE_OUTPUT_FORMAT
 
 ##SRC Added 10-30-24 This is part of getting the phys assess date from redcap
 from moca_etl_parameters import redcap_report
@@ -52,10 +72,49 @@ MOCA_MANUAL_measurement_type_concept_id = None
 
 
 ###SRC Added 10-30-24, read the redcap data to use the physical assessment date for MOCA
-def initialize_redcap(filename):
-    redcap=pd.read_csv(filename)
-    rcvars=redcap.dtypes
-    return redcap
+# physical assessment date used when a participant is not in the redcap report
+REDCAP_DEFAULT_PHYSICAL_ASSESSMENT_DATE = '01/01/2001'
+MOCA_WARNING_REDCAP_DATE_NOT_CONVERTED = f'redcap pacmpdat missing or not converted, using {REDCAP_DEFAULT_PHYSICAL_ASSESSMENT_DATE}'
+
+def initialize_redcap(filename, snapshot_cache=None, diagnostics=None):
+    # build a studyid -> (date, datetime, time) lookup of the physical assessment dates,
+    # reading only the needed columns, so each record does a dict lookup instead of
+    # scanning the whole redcap report. studyids whose pacmpdat is missing or can't be
+    # converted are added to diagnostics and left out, so they get the default date
+    if snapshot_cache is not None:
+        redcap=snapshot_cache.read_file(filename, pd.read_csv, usecols=['studyid', 'pacmpdat'])
+    else:
+        redcap=pd.read_csv(filename, usecols=['studyid', 'pacmpdat'])
+    redcap['studyid']=redcap['studyid'].astype(str)
+
+    # flag duplicate studyids, the first physical assessment date is used for these
+    duplicated = redcap['studyid'].duplicated(keep='first')
+    if duplicated.any():
+        duplicate_studyids = list(redcap.loc[duplicated, 'studyid'].unique())
+        sys.stderr.write(f"Redcap report has {len(duplicate_studyids)} duplicate studyids, using the first pacmpdat for each: {duplicate_studyids[:20]}\n")
+    redcap = redcap[~duplicated]
+
+    # convert the physical assessment dates once for the whole column,
+    # the date format is worked out from the column rather than tried per record
+    pacmpdat_date, pacmpdat_datetime, pacmpdat_time, unmatched_values = moca_column_to_date_datetime_time(redcap['pacmpdat'], 'pacmpdat')
+
+    # the record dates are NOT NULL, never hand out a NaT date
+    converted = pacmpdat_datetime.notna().to_numpy()
+    if not converted.all():
+        sys.stderr.write(f"Redcap report has {(~converted).sum()} studyids with a missing or unconverted pacmpdat, e.g. {unmatched_values[:20]}, " \
+                         f"using {REDCAP_DEFAULT_PHYSICAL_ASSESSMENT_DATE} for these.\n")
+        if diagnostics is not None:
+            diagnostics.add_rows(MOCA_WARNING_REDCAP_DATE_NOT_CONVERTED, redcap[~converted], sample_column='studyid')
+    return dict(zip(redcap['studyid'].to_numpy()[converted], 
+                    zip(pacmpdat_date.to_numpy()[converted], pacmpdat_datetime.to_numpy(dtype=object)[converted], pacmpdat_time.to_numpy()[converted])))
+
+
+def lookup_physical_assessment_date(redcap, studyid):
+    # return (date, datetime, time) of the physical assessment for a participant
+    physical_assess_date_datetime_time = redcap.get(studyid)
+    if physical_assess_date_datetime_time is None:
+        physical_assess_date_datetime_time = moca_string_to_date_datetime_time(REDCAP_DEFAULT_PHYSICAL_ASSESSMENT_DATE)
+    return physical_assess_date_datetime_time
 
 def display_moca_configuration_parameters():
     sys.stderr.write("Configuration Parameters:\n")
@@ -65,10 +124,21 @@ def display_moca_configuration_parameters():
                     
     
 class MoCAValidityChecker(object):
-    def __init__(self, tablename, idfieldname, engine):
-        query = text(f"SELECT {idfieldname} FROM {tablename}")
-        df_temp = pd.read_sql(query, engine)      
+    def __init__(self, tablename, idfieldname, engine, person_ids=None, snapshot_cache=None):
+        # only load the ids in person_ids when given, e.g. the participants in the raw moca data
+        if snapshot_cache is not None:
+            # the person table snapshot is shared with the labs ETL
+            df_temp = snapshot_cache.read_person_birth_years(tablename)
+            if person_ids is not None:
+                df_temp = df_temp[df_temp[idfieldname].isin(person_ids)]
+        elif person_ids is None:
+            query = text(f"SELECT {idfieldname} FROM {tablename}")
+            df_temp = pd.read_sql(query, engine)      
+        else:
+            query = text(f"SELECT {idfieldname} FROM {tablename} WHERE {idfieldname} = ANY(:person_ids)")
+            df_temp = pd.read_sql(query, engine, params={'person_ids': [int(pid) for pid in person_ids]})
         self.ids = set(df_temp[idfieldname])
+        self.id_array = np.unique(df_temp[idfieldname].to_numpy(dtype=np.int64))
             
     def is_valid_measurement(self, m):
         return isinstance(m['person_id'], int) and (m['person_id'] in self.ids) 
@@ -76,6 +146,18 @@ class MoCAValidityChecker(object):
     def is_valid_observation(self, o):
         return isinstance(o['person_id'], int) and (o['person_id'] in self.ids) 
 
+    def select_valid_rows(self, df_moca_data):
+        # keep the raw moca rows whose Institute File number is an integer person_id present in 
+        # the person table, returns the valid rows and the rows rejected for each reason,
+        # the rejected rows keep their index in df_moca_data
+        person_ids = get_moca_person_ids(df_moca_data)
+        is_integer = person_ids.notna().to_numpy()
+        is_person = np.zeros(df_moca_data.shape[0], dtype=bool)
+        is_person[is_integer] = np.isin(person_ids[is_integer].to_numpy(dtype=np.int64), self.id_array)
+        rejections = {MOCA_REJECTED_NOT_AN_INTEGER: df_moca_data[~is_integer],
+                      MOCA_REJECTED_NOT_IN_PERSON_TABLE: df_moca_data[is_integer & ~is_person]}
+        return df_moca_data[is_person].reset_index(drop=True), rejections
+
 # compile regular expression for extraction time from 
 # minutes, seconds string
 MINSEC_REGEX = re.compile(r'(\d+)\s*mins?\s*(\d+)secs?')
@@ -83,26 +165,64 @@ def convert_duration_string_to_seconds(s):
     mo = MINSEC_REGEX.match(s)
     return 60*int(mo.group(1)) + int(mo.group(2))
 
-def read_moca_mappings():
-    # set constants
-    global MOCA_AUTOMATED_observation_type_concept_id
-    global MOCA_MANUAL_observation_type_concept_id
-    global MOCA_AUTOMATED_measurement_type_concept_id
-    global MOCA_MANUAL_measurement_type_concept_id
+def parse_moca_value_range(value_range):
+    # (range_low, range_high) of a 'low-high' Value_Range, (0.0, 0.0) when no range is given
+    if pd.isna(value_range):
+        # no range given
+        return (0.0, 0.0)
+    elif value_range and (value_range.find('-') >= 0):
+        parts = value_range.split('-')
+        return (float(parts[0]), float(parts[1]))
+    else:
+        # no range given
+        return (0.0, 0.0)
+
+
+def compile_moca_domain_plan(df_domain_mappings):
+    # read-only plan of the mappings of one domain, the mapped SRC_CODE columns in mapping order,
+    # the concept ids and parsed value ranges as arrays, and masks of the data types converted
+    mappings = []
+    for mapping_row in df_domain_mappings.to_dict('records'):
+        # only Integer values have a range, report and ignore any range that can't be parsed
+        range_low, range_high = (0.0, 0.0)
+        if mapping_row['Data_Type'] == 'Integer':
+            try:
+                range_low, range_high = parse_moca_value_range(mapping_row['Value_Range'])
+            except (ValueError, TypeError, IndexError, AttributeError) as e:
+                sys.stderr.write(f"Unable to parse Value_Range '{mapping_row['Value_Range']}' for MOCA mapping '{mapping_row['SRC_CODE']}', " \
+                                 f"using no range: {e}\n")
+        mappings.append(MappingPlan(SRC_CODE=mapping_row['SRC_CODE'], Data_Type=mapping_row['Data_Type'], 
+                                    TARGET_CONCEPT_ID=int(mapping_row['TARGET_CONCEPT_ID']), TARGET_CONCEPT_NAME=mapping_row['TARGET_CONCEPT_NAME'],
+                                    range_low=range_low, range_high=range_high))
+    data_types = np.array([mapping.Data_Type for mapping in mappings], dtype=object)
+    return MappingPlan(mappings=tuple(mappings),
+                       src_codes=tuple(mapping.SRC_CODE for mapping in mappings),
+                       concept_ids=np.array([mapping.TARGET_CONCEPT_ID for mapping in mappings], dtype=np.int64),
+                       is_integer=data_types == 'Integer',
+                       is_duration=data_types == 'Time Duration',
+                       range_low=np.array([mapping.range_low for mapping in mappings], dtype=float),
+                       range_high=np.array([mapping.range_high for mapping in mappings], dtype=float))
+
+
+# bump when compile_moca_mapping_plan() changes, so incremental manifests of the old plan are discarded
+MOCA_MAPPING_PLAN_VERSION = 1
+
+def compile_moca_mapping_plan(snapshot_cache=None):
+    # compile the standards mapping file into a read-only plan with the automated vs. manual 
+    # type concept ids, and a plan of the completed mappings for each of the Measurement and Observation domains
+    sys.stderr.write("Compiling completed MOCA OMOP mappings.\n")
 
     # read the mapping file
-    df_mapping = pd.read_csv(STANDARDS_MAPPING_CSV_PATH)    
+    if snapshot_cache is not None:
+        df_mapping = snapshot_cache.read_file(STANDARDS_MAPPING_CSV_PATH, pd.read_csv)
+    else:
+        df_mapping = pd.read_csv(STANDARDS_MAPPING_CSV_PATH)    
 
-    # read and set the automated vs. manual concept ids constants
+    # read the automated vs. manual concept ids constants
     # app_generated
     # manually_entered_from_paper
-    MOCA_AUTOMATED_observation_type_concept_id = \
-        int(df_mapping[lambda df: df['SRC_CODE'] == 'app_generated'].iloc[0]['TARGET_CONCEPT_ID'])
-    MOCA_AUTOMATED_measurement_type_concept_id = MOCA_AUTOMATED_observation_type_concept_id
-
-    MOCA_MANUAL_observation_type_concept_id = \
-        int(df_mapping[lambda df: df['SRC_CODE'] == 'manually_entered_from_paper'].iloc[0]['TARGET_CONCEPT_ID'])
-    MOCA_MANUAL_measurement_type_concept_id = MOCA_MANUAL_observation_type_concept_id
+    automated_type_concept_id = int(df_mapping[lambda df: df['SRC_CODE'] == 'app_generated'].iloc[0]['TARGET_CONCEPT_ID'])
+    manual_type_concept_id = int(df_mapping[lambda df: df['SRC_CODE'] == 'manually_entered_from_paper'].iloc[0]['TARGET_CONCEPT_ID'])
 
     # load mappings files that are completed and ready for mapping...
     MAPPING_COLUMNS_REQUIRED = [
@@ -118,15 +238,39 @@ def read_moca_mappings():
                                                     (df['Map_to_OMOP'] == 'Yes') & \
                                                     df.TARGET_CONCEPT_ID.notnull()][MAPPING_COLUMNS_REQUIRED]
 
-    # correct data types...
-    df_completed_mappings.TARGET_CONCEPT_ID = df_completed_mappings.TARGET_CONCEPT_ID.astype(int)
+    return MappingPlan(automated_type_concept_id=automated_type_concept_id,
+                       manual_type_concept_id=manual_type_concept_id,
+                       measurement=compile_moca_domain_plan(df_completed_mappings[df_completed_mappings.TARGET_DOMAIN_ID == 'Measurement']),
+                       observation=compile_moca_domain_plan(df_completed_mappings[df_completed_mappings.TARGET_DOMAIN_ID == 'Observation']))
+
+
+def get_moca_mapping_plan_key():
+    # key of the moca mapping plan, changes when the plan would compile differently
+    return compute_mapping_plan_key(MOCA_MAPPING_PLAN_VERSION, [STANDARDS_MAPPING_CSV_PATH])
+
+
+def read_moca_mappings(snapshot_cache=None):
+    # compile the moca mapping plan, with a snapshot cache the mapping file is read from its snapshot
+    # when unchanged, and set the type concept id constants from it
+    global MOCA_AUTOMATED_observation_type_concept_id
+    global MOCA_MANUAL_observation_type_concept_id
+    global MOCA_AUTOMATED_measurement_type_concept_id
+    global MOCA_MANUAL_measurement_type_concept_id
+
+    plan = compile_moca_mapping_plan(snapshot_cache)
+
+    MOCA_AUTOMATED_observation_type_concept_id = plan.automated_type_concept_id
+    MOCA_AUTOMATED_measurement_type_concept_id = MOCA_AUTOMATED_observation_type_concept_id
+    MOCA_MANUAL_observation_type_concept_id = plan.manual_type_concept_id
+    MOCA_MANUAL_measurement_type_concept_id = MOCA_MANUAL_observation_type_concept_id
 
     # output for logging and debugging...
     sys.stderr.write("Completed valid MOCA OMOP mappings:\n")
-    sys.stderr.write(str(df_completed_mappings.reset_index(drop=True)))
-    sys.stderr.write('\n')
+    for domain, domain_plan in (('Measurement', plan.measurement), ('Observation', plan.observation)):
+        for mapping in domain_plan.mappings:
+            sys.stderr.write(f"\t{mapping.SRC_CODE} ({mapping.Data_Type}) -> {domain} {mapping.TARGET_CONCEPT_ID} {mapping.TARGET_CONCEPT_NAME}, range {mapping.range_low}-{mapping.range_high}\n")
 
-    return df_completed_mappings
+    return plan
 
 def safe_integer_converstion(s):
     s = str(s) # ensure we are dealing with a string
@@ -138,24 +282,103 @@ def safe_integer_converstion(s):
         # return string as is, we will catch it later
         return s
 
-def load_raw_moca_data():
-    # load the data files
-    df_moca_data = None
-    for filepattern in MOCA_SOURCE_DATA_GLOB.split(';'):
-        for filename in glob.glob(filepattern):
-            sys.stderr.write(f"Reading MoCA data file: {filename}\n")
-            df_temp = pd.read_csv(filename)
-            # add source simple filename to the moca data table
-            df_temp['source_filename'] = os.path.split(filename)[1]
-            # accumulate data
-            if df_moca_data is None:
-                df_moca_data = df_temp
-            else:
-                df_moca_data = pd.concat((df_moca_data, df_temp), axis=0)
+# reasons raw MoCA rows are rejected before the transform
+MOCA_REJECTED_NOT_AN_INTEGER = 'Institute File number is not an integer'
+MOCA_REJECTED_NOT_IN_PERSON_TABLE = 'participant not in the person table'
+MOCA_REMOVED_DUPLICATE_MEASUREMENT = 'duplicate MEASUREMENT records removed'
+MOCA_REMOVED_DUPLICATE_OBSERVATION = 'duplicate OBSERVATION records removed'
+MOCA_WARNING_CHANGED_ROW = 'new or changed rows of participants already loaded from the file, their records are appended next to the earlier records'
+
+def get_moca_person_ids(df_moca_data):
+    # the person_id of each raw moca row as a nullable integer series, 
+    # missing when the Institute File number is not an integer
+    file_numbers = df_moca_data['Institute File number'].astype(str)
+    return pd.to_numeric(file_numbers.where(file_numbers.str.isnumeric()), errors='coerce').astype('Int64')
+
+# incremental manifest namespace of the raw MoCA rows, and the columns that identify a row,
+# a new row with the same values is a changed row
+MOCA_INCREMENTAL_ROW_NAMESPACE = 'moca'
+MOCA_INCREMENTAL_ROW_KEY_COLUMNS = ['Institute File number', 'source_filename']
+
+def get_moca_source_column_dtypes(moca_mapping_plan):
+    # the columns read from the MoCA data files, and their dtypes. the participant id is read 
+    # verbatim as a string, the mapped columns are left to the csv parser's conversion (None),
+    # so their source values, e.g. '5' read as 5.0, and record digests are the same as always
+    column_dtypes = {'Institute File number': str}
+    for domain_plan in (moca_mapping_plan.measurement, moca_mapping_plan.observation):
+        for mapping in domain_plan.mappings:
+            column_dtypes.setdefault(mapping.SRC_CODE, None)
+    return column_dtypes
+
+
+def read_moca_source_file(filename, column_dtypes=None, incremental_manifest=None):
+    # read one MoCA data file, only the columns in column_dtypes when given, of those the file has.
+    # with an incremental_manifest, unchanged files are not read and only new or changed rows are kept.
+    # returns the file's sha256 (incremental only), the rows read or None, a DataFrame of the fingerprint,
+    # key fingerprint and changed flag of each row kept (incremental only), and the number of rows in the file.
+    # safe to run in a thread, the manifest is not changed
+    sha256 = None
+    if incremental_manifest is not None:
+        sha256 = file_sha256(filename)
+        if incremental_manifest.is_file_unchanged(filename, sha256):
+            return sha256, None, None, 0
+    if column_dtypes is None:
+        df_temp = pd.read_csv(filename, engine=MOCA_CSV_ENGINE)
+    else:
+        # read the header first, so mapped columns missing from a file are just not read
+        header = pd.read_csv(filename, nrows=0).columns
+        usecols = [c for c in header if c in column_dtypes]
+        df_temp = pd.read_csv(filename, usecols=usecols, engine=MOCA_CSV_ENGINE,
+                              dtype={c: column_dtypes[c] for c in usecols if column_dtypes[c] is not None})
+    # add source simple filename to the moca data table
+    df_temp['source_filename'] = os.path.split(filename)[1]
+    n_rows = df_temp.shape[0]
+    df_fingerprints = None
+    if incremental_manifest is not None:
+        df_temp, fingerprints, key_fingerprints, changed = incremental_manifest.select_unprocessed_rows(df_temp, MOCA_INCREMENTAL_ROW_NAMESPACE, 
+                                                                                                       MOCA_INCREMENTAL_ROW_KEY_COLUMNS)
+        df_fingerprints = pd.DataFrame({'filename': filename, 'fingerprint': fingerprints, 'key_fingerprint': key_fingerprints, 'changed': changed})
+    return sha256, df_temp, df_fingerprints, n_rows
+
+
+def load_raw_moca_data(moca_mapping_plan=None, incremental_manifest=None, incremental_updates=None):
+    # load the data files concurrently, with a moca_mapping_plan only the mapped columns and the 
+    # participant id are read. with an incremental_manifest, files that have not changed since
+    # the last run are skipped and only new or changed rows are kept, the hashes of the files
+    # read and the fingerprints of the rows kept, aligned with the returned rows, are put in the incremental_updates dict
+    filenames = [filename for filepattern in MOCA_SOURCE_DATA_GLOB.split(';') for filename in glob.glob(filepattern)]
+    column_dtypes = get_moca_source_column_dtypes(moca_mapping_plan) if moca_mapping_plan is not None else None
+    with ThreadPoolExecutor(max_workers=max(1, MOCA_SOURCE_READ_THREADS)) as executor:
+        results = list(executor.map(lambda filename: read_moca_source_file(filename, column_dtypes, incremental_manifest), filenames))
+
+    # report and accumulate the data in file order
+    df_moca_data = []
+    df_fingerprints = []
+    for filename, (sha256, df_temp, df_file_fingerprints, n_rows) in zip(filenames, results):
+        if df_temp is None:
+            sys.stderr.write(f"Skipping unchanged MoCA data file: {filename}\n")
+            continue
+        sys.stderr.write(f"Read MoCA data file: {filename}\n")
+        if incremental_manifest is not None:
+            incremental_updates.setdefault('files', {})[filename] = sha256
+            df_fingerprints.append(df_file_fingerprints)
+            sys.stderr.write(f"MoCA data file has {df_temp.shape[0]} new or changed rows out of {n_rows}.\n")
+        df_moca_data.append(df_temp)
     
+    if len(df_moca_data) == 0:
+        # no files to process
+        if incremental_manifest is not None:
+            incremental_updates['row_fingerprints'] = pd.DataFrame(columns=['filename', 'fingerprint', 'key_fingerprint', 'changed'])
+        return pd.DataFrame(columns=['Institute File number', 'source_filename'])
+    # concatenate once, rather than copying the growing table for every file
+    df_moca_data = pd.concat(df_moca_data, axis=0, ignore_index=True)
+
     # remove any records that are blank, for our purposes, if the Institute File number
     # is NaN, then the line is blank...
-    df_moca_data = df_moca_data[lambda df: df['Institute File number'].notna()].reset_index(drop=True).copy()
+    not_blank = df_moca_data['Institute File number'].notna().to_numpy()
+    df_moca_data = df_moca_data[not_blank].reset_index(drop=True)
+    if incremental_manifest is not None:
+        incremental_updates['row_fingerprints'] = pd.concat(df_fingerprints, axis=0, ignore_index=True)[not_blank].reset_index(drop=True)
 
     # clean up Institute File number...
     df_moca_data['Institute File number'] = df_moca_data['Institute File number'].map(safe_integer_converstion)
@@ -165,7 +388,7 @@ def load_raw_moca_data():
 
 def create_single_measurement_record(moca_record, mapping_row,redcap):
     # first check to ensure that the column value is not NaN
-    if pd.isna(moca_record[mapping_row['SRC_CODE']]):
+    if pd.isna(moca_record[mapping_row.SRC_CODE]):
         # don't create a measurement record for this value
         return None
 
@@ -186,7 +409,7 @@ def create_single_measurement_record(moca_record, mapping_row,redcap):
     m.provider_id = 0
     m.visit_occurrence_id = 0
     m.visit_detail_id = 0
-    m.measurement_source_value = mapping_row['SRC_CODE']
+    m.measurement_source_value = mapping_row.SRC_CODE
     m.measurement_source_concept_id = 0
     m.unit_source_value = ''
     m.unit_source_concept_id = 0
@@ -205,10 +428,7 @@ def create_single_measurement_record(moca_record, mapping_row,redcap):
     ##SRC Added 10-30-24 get the physical assessment date from redcap
     #id=moca_record['Institute File number'])
     #print(moca_record['Institute File number'],redcap[(redcap["studyid"]==id)].shape[0])
-    if redcap[(redcap["studyid"]==moca_record['Institute File number'])].shape[0] !=0:
-       physical_assess_date=redcap.loc[(redcap["studyid"]==moca_record['Institute File number'])].pacmpdat.item()
-    else:
-        physical_assess_date='01/01/2001'
+    physical_assess_date_datetime_time = lookup_physical_assessment_date(redcap, moca_record['Institute File number'])
     
     #m.measurement_date = moca_string_to_date(moca_record['test_upload_date'])
     #m.measurement_datetime = moca_string_to_datetime(moca_record['test_upload_date'])
@@ -216,9 +436,7 @@ def create_single_measurement_record(moca_record, mapping_row,redcap):
     
     ##SRC Added 10-30-24 Use the pa date
     #print(physical_assess_date)
-    m.measurement_date = moca_string_to_date(physical_assess_date)
-    m.measurement_datetime = moca_string_to_datetime(physical_assess_date)
-    m.measurement_time = moca_string_to_time(physical_assess_date)      
+    m.measurement_date, m.measurement_datetime, m.measurement_time = physical_assess_date_datetime_time
 
     # DEBUGGING
     #print() 
@@ -227,46 +445,35 @@ def create_single_measurement_record(moca_record, mapping_row,redcap):
     #print() 
 
     # set computed value fields...
-    raw_value_text = str(moca_record[mapping_row['SRC_CODE']])
+    raw_value_text = str(moca_record[mapping_row.SRC_CODE])
     m.value_source_value = raw_value_text
-    if mapping_row['Data_Type'] == 'Integer':
+    if mapping_row.Data_Type == 'Integer':
         m.value_as_number = float(raw_value_text)
         m.value_as_concept_id = 0
-        value_range = mapping_row['Value_Range']
-        if pd.isna(value_range):
-            # no range given
-            m.range_low = 0.0
-            m.range_high = 0.0
-        elif value_range and (value_range.find('-') >= 0):
-            parts = value_range.split('-')
-            m.range_low = float(parts[0])
-            m.range_high = float(parts[1])
-        else:
-            # no range given
-            m.range_low = 0.0
-            m.range_high = 0.0
+        # the Value_Range was parsed when the plan was compiled
+        m.range_low = mapping_row.range_low
+        m.range_high = mapping_row.range_high
 
     # DEBUG CODE
     #print(m)
     #print()
 
-    # return as dotdict
+    # return as record
     return m
 
 
-def create_measurement_records(moca_record, df_mappings,redcap):
+def create_measurement_records(moca_record, moca_mapping_plan,redcap):
     moca_measurements = []
-    for index, r in df_mappings.iterrows():
-        if r.TARGET_DOMAIN_ID == 'Measurement':
-            m = create_single_measurement_record(moca_record, r,redcap)
-            if m:
-                moca_measurements.append(m)
+    for mapping_row in moca_mapping_plan.measurement.mappings:
+        m = create_single_measurement_record(moca_record, mapping_row,redcap)
+        if m:
+            moca_measurements.append(m)
     return moca_measurements
 
 
 def create_single_observation_record(moca_record, mapping_row,redcap):
     # first check to ensure that the column value is not NaN
-    if pd.isna(moca_record[mapping_row['SRC_CODE']]):
+    if pd.isna(moca_record[mapping_row.SRC_CODE]):
         # don't create an observation record for this value
         return None
 
@@ -287,7 +494,7 @@ def create_single_observation_record(moca_record, mapping_row,redcap):
     o.provider_id = 0
     o.visit_occurrence_id = 0
     o.visit_detail_id = 0
-    o.observation_source_value = mapping_row['SRC_CODE']
+    o.observation_source_value = mapping_row.SRC_CODE
     o.observation_source_concept_id = 0
     o.unit_source_value = ''
     o.qualifier_source_value = ''
@@ -303,26 +510,22 @@ def create_single_observation_record(moca_record, mapping_row,redcap):
     # set date and time fields...
     
     ##SRC Added 10-30-24 get the physical assessment date from redcap
-    if redcap[(redcap["studyid"]==moca_record['Institute File number'])].shape[0] !=0:
-       physical_assess_date=redcap.loc[(redcap["studyid"]==moca_record['Institute File number'])].pacmpdat.item()
-    else:
-        physical_assess_date='01/01/2001'
+    physical_assess_date_datetime_time = lookup_physical_assessment_date(redcap, moca_record['Institute File number'])
     
     #o.observation_date = moca_string_to_date(moca_record['test_upload_date'])
     #o.observation_datetime = moca_string_to_datetime(moca_record['test_upload_date'])
     
     ##SRC Added 10-30-24 Use the pa date
-    o.observation_date = moca_string_to_date(physical_assess_date)
-    o.observation_datetime = moca_string_to_datetime(physical_assess_date)
+    o.observation_date, o.observation_datetime, ignore = physical_assess_date_datetime_time
     
     # set computed value fields...
-    raw_value_text = moca_record[mapping_row['SRC_CODE']]
+    raw_value_text = moca_record[mapping_row.SRC_CODE]
     o.value_source_value = str(raw_value_text)
     o.value_as_string = str(raw_value_text).strip()
     o.value_as_concept_id = 0 # nothing to put in here so far
-    if mapping_row['Data_Type'] == 'Integer':
+    if mapping_row.Data_Type == 'Integer':
         o.value_as_number = float(raw_value_text)
-    elif mapping_row['Data_Type'] == 'Time Duration':
+    elif mapping_row.Data_Type == 'Time Duration':
         # special handling for moca_total_score_time or any other Time Duration 
         # data type must convert string MM mins SS secs to value_as_number_seconds
         o.value_as_number = float(convert_duration_string_to_seconds(raw_value_text))      
@@ -333,122 +536,345 @@ def create_single_observation_record(moca_record, mapping_row,redcap):
     #print(o)
     #print()
 
-    # return as dotdict
+    # return as record
     return o
         
 
-def create_observation_records(moca_record, df_mappings,redcap):
+def create_observation_records(moca_record, moca_mapping_plan,redcap):
     moca_observations = []
-    for index, r in df_mappings.iterrows():
-        if r.TARGET_DOMAIN_ID == 'Observation':
-            o = create_single_observation_record(moca_record, r,redcap)
-            if o:
-                moca_observations.append(o)
+    for mapping_row in moca_mapping_plan.observation.mappings:
+        o = create_single_observation_record(moca_record, mapping_row,redcap)
+        if o:
+            moca_observations.append(o)
     return moca_observations
 
 
-def process_moca_etl():
+def update_moca_incremental_manifest(incremental_manifest, incremental_updates):
+    # remember the rows read this run, and the files all of whose rows were read, once their 
+    # records are written. rows of participants not in the person table yet are left out, with
+    # their files, so they are read again on the next run. rows rejected as not having an integer
+    # Institute File number would be rejected again, they are remembered.
+    # returns the number of rows left for the next run
+    df_fingerprints = incremental_updates['row_fingerprints']
+    retried = incremental_updates['retried']
+    retried_filenames = set(df_fingerprints['filename'][retried])
+    for filename, sha256 in incremental_updates.get('files', {}).items():
+        if filename not in retried_filenames:
+            incremental_manifest.add_file(filename, sha256)
+    incremental_manifest.add_row_fingerprints(MOCA_INCREMENTAL_ROW_NAMESPACE, df_fingerprints['fingerprint'][~retried].to_numpy(dtype=np.uint64),
+                                              df_fingerprints['key_fingerprint'][~retried].to_numpy(dtype=np.uint64))
+    return int(retried.sum())
+
+
+def melt_moca_domain(df_moca_data, domain_plan):
+    # long form of the mapped SRC_CODE columns of one domain, one row per non-missing value in 
+    # raw row order, then mapping order, which is the order the per-record path creates records in.
+    # returns the long frame, with the raw row and mapping positions
+    n_rows = df_moca_data.shape[0]
+    n_mappings = len(domain_plan.src_codes)
+    if n_rows == 0:
+        # nothing to melt, the raw data may not even have the mapped columns
+        values = np.empty(0, dtype=object)
+    else:
+        values = df_moca_data[list(domain_plan.src_codes)].to_numpy(dtype=object).ravel()
+    df_long = pd.DataFrame({
+        'row_position': np.repeat(np.arange(n_rows), n_mappings),
+        'mapping_position': np.tile(np.arange(n_mappings), n_rows),
+        'raw_value': pd.Series(values, dtype=object),
+    })
+    return df_long[pd.notna(values)].reset_index(drop=True)
+
+
+def get_moca_row_columns(df_moca_data, redcap):
+    # person_id, paper flag and physical assessment date, datetime and time of each raw row,
+    # the redcap lookup is done once per participant
+    codes, distinct_file_numbers = pd.factorize(df_moca_data['Institute File number'])
+    dates_datetimes_times = [lookup_physical_assessment_date(redcap, fn) for fn in distinct_file_numbers]
+    return {
+        'person_id': get_moca_person_ids(df_moca_data).to_numpy(dtype=np.int64),
+        'is_paper': df_moca_data['source_filename'].str.lower().str.contains('paper', regex=False).to_numpy(dtype=bool),
+        'date': np.array([d for d, dt, t in dates_datetimes_times], dtype=object)[codes],
+        'datetime': np.array([dt for d, dt, t in dates_datetimes_times], dtype=object)[codes],
+        'time': np.array([t for d, dt, t in dates_datetimes_times], dtype=object)[codes],
+    }
+
+
+def convert_duration_column_to_seconds(values):
+    # vectorized convert_duration_string_to_seconds()
+    values = pd.Series(values, dtype=object).astype(str)
+    parts = values.str.extract('^' + MINSEC_REGEX.pattern)
+    unmatched = parts[0].isna().to_numpy()
+    if unmatched.any():
+        raise ValueError(f"Unable to convert Time Duration values to seconds: {list(values[unmatched][:20])}")
+    return 60.0 * parts[0].astype(int).to_numpy() + parts[1].astype(int).to_numpy()
+
+
+def create_measurement_dataframe(df_moca_data, moca_mapping_plan, redcap):
+    # columnar version of create_measurement_records() over all of the raw rows, 
+    # returns a DataFrame of MEASUREMENT records that matches the per-record path field for field
+    domain_plan = moca_mapping_plan.measurement
+    df_long = melt_moca_domain(df_moca_data, domain_plan)
+    if df_long.shape[0] == 0:
+        return records_to_dataframe([], OMOPMeasurementRecord)
+    rows = get_moca_row_columns(df_moca_data, redcap)
+    row_position = df_long['row_position'].to_numpy()
+    mapping_position = df_long['mapping_position'].to_numpy()
+    is_integer = domain_plan.is_integer[mapping_position]
+    value_source_value = df_long['raw_value'].map(str).to_numpy(dtype=object)
+
+    df_m = pd.DataFrame({c: [OMOP_CDM_54_MEASUREMENT_DEFAULTS[c]] * df_long.shape[0] for c in OMOP_CDM_54_MEASUREMENT_COLUMNS})
+    df_m['person_id'] = rows['person_id'][row_position]
+    df_m['measurement_concept_id'] = domain_plan.concept_ids[mapping_position]
+    df_m['measurement_date'] = rows['date'][row_position]
+    df_m['measurement_datetime'] = pd.to_datetime(rows['datetime'][row_position])
+    df_m['measurement_time'] = rows['time'][row_position]
+    df_m['measurement_type_concept_id'] = np.where(rows['is_paper'][row_position], MOCA_MANUAL_measurement_type_concept_id, MOCA_AUTOMATED_measurement_type_concept_id)
+    df_m['operator_concept_id'] = EQUALS_OMOP_CONCEPT_ID
+    df_m['measurement_source_value'] = np.array(domain_plan.src_codes, dtype=object)[mapping_position]
+    df_m['value_source_value'] = value_source_value
+    # only Integer values are converted, the others keep the default value and range
+    value_as_number = np.zeros(df_long.shape[0])
+    value_as_number[is_integer] = value_source_value[is_integer].astype(float)
+    df_m['value_as_number'] = value_as_number
+    df_m['range_low'] = np.where(is_integer, domain_plan.range_low[mapping_position], 0.0)
+    df_m['range_high'] = np.where(is_integer, domain_plan.range_high[mapping_position], 0.0)
+    return df_m
+
+
+def create_observation_dataframe(df_moca_data, moca_mapping_plan, redcap):
+    # columnar version of create_observation_records() over all of the raw rows, 
+    # returns a DataFrame of OBSERVATION records that matches the per-record path field for field
+    domain_plan = moca_mapping_plan.observation
+    df_long = melt_moca_domain(df_moca_data, domain_plan)
+    if df_long.shape[0] == 0:
+        return records_to_dataframe([], OMOPObservationRecord)
+    rows = get_moca_row_columns(df_moca_data, redcap)
+    row_position = df_long['row_position'].to_numpy()
+    mapping_position = df_long['mapping_position'].to_numpy()
+    raw_value = df_long['raw_value'].to_numpy(dtype=object)
+    value_source_value = df_long['raw_value'].map(str)
+
+    df_o = pd.DataFrame({c: [OMOP_CDM_54_OBSERVATION_DEFAULTS[c]] * df_long.shape[0] for c in OMOP_CDM_54_OBSERVATION_COLUMNS})
+    df_o['person_id'] = rows['person_id'][row_position]
+    df_o['observation_concept_id'] = domain_plan.concept_ids[mapping_position]
+    df_o['observation_date'] = rows['date'][row_position]
+    df_o['observation_datetime'] = pd.to_datetime(rows['datetime'][row_position])
+    df_o['observation_type_concept_id'] = np.where(rows['is_paper'][row_position], MOCA_MANUAL_observation_type_concept_id, MOCA_AUTOMATED_observation_type_concept_id)
+    df_o['observation_source_value'] = np.array(domain_plan.src_codes, dtype=object)[mapping_position]
+    df_o['value_source_value'] = value_source_value.to_numpy(dtype=object)
+    df_o['value_as_string'] = value_source_value.str.strip().to_numpy(dtype=object)
+    # Integer values are converted, and Time Duration values (MM mins SS secs) become seconds
+    value_as_number = np.zeros(df_long.shape[0])
+    is_integer = domain_plan.is_integer[mapping_position]
+    is_duration = domain_plan.is_duration[mapping_position]
+    value_as_number[is_integer] = raw_value[is_integer].astype(float)
+    value_as_number[is_duration] = convert_duration_column_to_seconds(raw_value[is_duration])
+    df_o['value_as_number'] = value_as_number
+    return df_o
+
+
+def process_moca_etl(profile=False, engine=None, snapshot_cache=None, measurementIDTracker=None, observationIDTracker=None, **report_info):
+    # engine, snapshot_cache, the source of the reference tables and files, and the id trackers
+    # can be passed in, e.g. by the benchmark, otherwise they are created from the parameters.
+    # report_info is added to the run report
     # begin timing
     sys.stderr.write(f"Starting process_moca_etl().\n")
     display_moca_configuration_parameters()                        
     start = time.time()
+    report = ETLRunReport('moca', MOCA_RUN_REPORT_PATH, profile, **report_info)
     
     # connect to the OMOP database
-    engine = create_engine(POSTGRES_CONN_STRING_KEY)
+    if engine is None:
+        engine = create_engine(POSTGRES_CONN_STRING_KEY)
     connection = engine.connect()    
     
-    # read and configure the mappings as well as the constant codes for manual vs. automated values...   
-    df_completed_mappings = read_moca_mappings()
-
-    # display the read in defined constant codes for manual vs. automated values...    
-    sys.stderr.write('\n')
-    sys.stderr.write(f'MOCA_AUTOMATED_observation_type_concept_id and MOCA_AUTOMATED_measurement_type_concept_id set to {MOCA_AUTOMATED_observation_type_concept_id},{MOCA_AUTOMATED_measurement_type_concept_id} from mapping file.\n')
-    sys.stderr.write(f'MOCA_MANUAL_observation_type_concept_id and MOCA_MANUAL_measurement_type_concept_id set to {MOCA_MANUAL_observation_type_concept_id},{MOCA_MANUAL_measurement_type_concept_id} from mapping file.\n')
-    sys.stderr.write('\n')
-
-    ###SRC Added 10.30.24 Read in the redcap report to get the phys assess date
-    redcap=initialize_redcap(redcap_report)
-    redcap['studyid']=redcap['studyid'].astype(str)
-    #print(redcap['studyid'].dtypes)
-
-    # read the raw moca data
-    df_moca_data = load_raw_moca_data()
-    sys.stderr.write(f"Read {df_moca_data.shape[0]} raw MoCA records:\n")
-    sys.stderr.write(str(df_moca_data))
-    sys.stderr.write('\n')
-
-    # process moca data into records...
-    # these records do not have the measurement_id and observation_id filled in unti later!
-    moca_measurements = []
-    moca_observations = []
-    ##SRC
-    #df_moca_data['Institute File number'].astype(int)
-    #print(df_moca_data.dtypes)
-    for index, r in df_moca_data.iterrows():
-        #print(redcap[(redcap["studyid"]==r['Institute File number'])] )
-        mms = create_measurement_records(r, df_completed_mappings,redcap)
-        moca_measurements.extend(mms)
-
-        mos = create_observation_records(r, df_completed_mappings,redcap)
-        moca_observations.extend(mos)    
-
-    sys.stderr.write(f"Created {len(moca_measurements)} new MEASUREMENT records from MoCA data.\n")
-    sys.stderr.write(f"Created {len(moca_observations)} new OBSERVATION records from MoCA data.\n")
-            
-    # remove any records that don't meet checking criteria
-    # for now the person_ids must be integers, and the participant ids
-    # must be present in the person table
-    checker = MoCAValidityChecker(POSTGRES_OMOP_READ_PERSON_TABLE_NAME, 'person_id', engine)
-    moca_measurements = [m for m in moca_measurements if checker.is_valid_measurement(m)]
-    moca_observations = [o for o in moca_observations if checker.is_valid_observation(o)]    
-    sys.stderr.write(f"Validity checking found {len(moca_measurements)} valid MEASUREMENT records.\n")
-    sys.stderr.write(f"Validity checking found {len(moca_observations)} valid OBSERVATION records.\n")
-    
-    # initialize record id trackers...
-    measurementIDTracker = OMOPIDTracker(POSTGRES_MOCA_READ_MEASUREMENT_TABLE_NAME, 'measurement_id', engine)
-    observationIDTracker = OMOPIDTracker(POSTGRES_MOCA_READ_OBSERVATION_TABLE_NAME, 'observation_id', engine)
-    
-    # for the valid records, we need to add the measurement_id and observeration_ids...
-    for m in moca_measurements:
-        m.measurement_id = measurementIDTracker.get_next_id();
-    sys.stderr.write(f"Filled in measurement_id for valid MEASUREMENT records.\n")
-    for o in moca_observations:
-        o.observation_id = observationIDTracker.get_next_id();
-    sys.stderr.write(f"Filled in observation_id for valid OBSERVATION records.\n")
+    # warnings and rejections are counted and summarized at the end of the run
+    diagnostics = ETLDiagnostics('MoCA', MOCA_DIAGNOSTICS_MAX_SAMPLES, quarantine=MOCA_DIAGNOSTICS_QUARANTINE_PATH is not None)
+
+    with report.stage('reference_load'):
+        # local snapshots of the reference data, refreshed when the tables or files change
+        if snapshot_cache is None and MOCA_USE_REFERENCE_SNAPSHOT_CACHE:
+            snapshot_cache = OMOPReferenceSnapshotCache(MOCA_REFERENCE_SNAPSHOT_CACHE_DIR, engine)
+
+        # read and configure the mappings as well as the constant codes for manual vs. automated values...   
+        moca_mapping_plan = read_moca_mappings(snapshot_cache)
+
+        # display the read in defined constant codes for manual vs. automated values...    
+        sys.stderr.write('\n')
+        sys.stderr.write(f'MOCA_AUTOMATED_observation_type_concept_id and MOCA_AUTOMATED_measurement_type_concept_id set to {MOCA_AUTOMATED_observation_type_concept_id},{MOCA_AUTOMATED_measurement_type_concept_id} from mapping file.\n')
+        sys.stderr.write(f'MOCA_MANUAL_observation_type_concept_id and MOCA_MANUAL_measurement_type_concept_id set to {MOCA_MANUAL_observation_type_concept_id},{MOCA_MANUAL_measurement_type_concept_id} from mapping file.\n')
+        sys.stderr.write('\n')
+
+        ###SRC Added 10.30.24 Read in the redcap report to get the phys assess date
+        redcap=initialize_redcap(redcap_report, snapshot_cache, diagnostics)
+
+    with report.stage('source_read') as stage:
+        # read the raw moca data, in incremental mode only the new or changed rows
+        incremental_manifest = None
+        incremental_updates = {}
+        if MOCA_INCREMENTAL_MODE:
+            incremental_manifest = ETLIncrementalManifest(MOCA_INCREMENTAL_MANIFEST_PATH, get_moca_mapping_plan_key())
+        df_moca_data = load_raw_moca_data(moca_mapping_plan, incremental_manifest, incremental_updates)
+        sys.stderr.write(f"Read {df_moca_data.shape[0]} raw MoCA records with {df_moca_data.shape[1]} columns.\n")
+        stage.records = df_moca_data.shape[0]
+
+    if MOCA_INCREMENTAL_MODE:
+        changed = incremental_updates['row_fingerprints']['changed'].to_numpy(dtype=bool)
+        diagnostics.add_rows(MOCA_WARNING_CHANGED_ROW, df_moca_data[changed], 'source_filename', 'Institute File number', quarantine=False)
+
+    with report.stage('participant_lookup') as stage:
+        # remove the rows that don't meet checking criteria before building any records,
+        # for now the person_ids must be integers, and the participant ids
+        # must be present in the person table
+        stage.records = df_moca_data.shape[0]
+        person_ids = get_moca_person_ids(df_moca_data).dropna().unique()
+        checker = MoCAValidityChecker(POSTGRES_OMOP_READ_PERSON_TABLE_NAME, 'person_id', engine, person_ids, snapshot_cache)
+        n_rows = df_moca_data.shape[0]
+        df_moca_data, rejections = checker.select_valid_rows(df_moca_data)
+        if MOCA_INCREMENTAL_MODE:
+            # rows of participants not in the person table yet are retried on the next run
+            retried = np.zeros(n_rows, dtype=bool)
+            retried[rejections[MOCA_REJECTED_NOT_IN_PERSON_TABLE].index.to_numpy()] = True
+            incremental_updates['retried'] = retried
+        for reason, df_rejected in rejections.items():
+            sys.stderr.write(f"Validity checking rejected {df_rejected.shape[0]} raw MoCA records, {reason}.\n")
+            diagnostics.add_rows(reason, df_rejected, 'source_filename', 'Institute File number')
+        sys.stderr.write(f"Validity checking found {df_moca_data.shape[0]} valid raw MoCA records.\n")
+
+    with report.stage('transform') as stage:
+        # process moca data into records...
+        # these records do not have the measurement_id and observation_id filled in unti later!
+        moca_measurements = []
+        moca_observations = []
+        ##SRC
+        #df_moca_data['Institute File number'].astype(int)
+        #print(df_moca_data.dtypes)
+        if MOCA_OMOP_COLUMNAR_TRANSFORM:
+            # transform all of the raw rows at once with array operations
+            df_new_measurements = create_measurement_dataframe(df_moca_data, moca_mapping_plan, redcap)
+            df_new_observations = create_observation_dataframe(df_moca_data, moca_mapping_plan, redcap)
+        else:
+            for index, r in df_moca_data.iterrows():
+                #print(redcap[(redcap["studyid"]==r['Institute File number'])] )
+                mms = create_measurement_records(r, moca_mapping_plan,redcap)
+                moca_measurements.extend(mms)
+
+                mos = create_observation_records(r, moca_mapping_plan,redcap)
+                moca_observations.extend(mos)    
+
+            sys.stderr.write(f"Created {len(moca_measurements)} new MEASUREMENT records from MoCA data.\n")
+            sys.stderr.write(f"Created {len(moca_observations)} new OBSERVATION records from MoCA data.\n")
+
+            # create new measurements and observations data frame in preparation to write to database
+            df_new_measurements = records_to_dataframe(moca_measurements, OMOPMeasurementRecord)
+            df_new_observations = records_to_dataframe(moca_observations, OMOPObservationRecord)    
+        sys.stderr.write(f"Created dataframe with {df_new_measurements.shape[0]} new MEASUREMENT records.\n")
+        sys.stderr.write(f"Created dataframe with {df_new_observations.shape[0]} new OBSERVATION records.\n")
+        stage.records = df_new_measurements.shape[0] + df_new_observations.shape[0]
+
+    if MOCA_OMOP_FILTER_OUT_DUPLICATE_RECORDS:
+        with report.stage('dedup') as stage:
+            stage.records = df_new_measurements.shape[0] + df_new_observations.shape[0]
+            sys.stderr.write("Filtering out duplicate records...\n")
+            measurement_digest_index = None
+            observation_digest_index = None
+            if MOCA_OMOP_FILTER_OUT_EXISTING_RECORDS:
+                measurement_digest_index = OMOPRecordDigestIndex(POSTGRES_MOCA_WRITE_SCHEMA_NAME, POSTGRES_MOCA_WRITE_MEASUREMENT_TABLE_NAME, 'measurement_id',
+                                                                 MEASUREMENT_DIGEST_KEY_COLUMNS, MOCA_OMOP_MEASUREMENT_DIGEST_INDEX_PATH, engine)
+                observation_digest_index = OMOPRecordDigestIndex(POSTGRES_MOCA_WRITE_SCHEMA_NAME, POSTGRES_MOCA_WRITE_OBSERVATION_TABLE_NAME, 'observation_id',
+                                                                 OBSERVATION_DIGEST_KEY_COLUMNS, MOCA_OMOP_OBSERVATION_DIGEST_INDEX_PATH, engine)
+            df_duplicates = df_new_measurements
+            df_new_measurements, duplicated, existing = filter_duplicate_records(df_new_measurements, MEASUREMENT_DIGEST_KEY_COLUMNS, measurement_digest_index)
+            diagnostics.add_rows(MOCA_REMOVED_DUPLICATE_MEASUREMENT, df_duplicates[duplicated], 'measurement_source_value', 'person_id', quarantine=False)
+            sys.stderr.write(f"Removed {duplicated.sum()} duplicate and {existing.sum()} existing MEASUREMENT records, {df_new_measurements.shape[0]} remain.\n")
+            df_duplicates = df_new_observations
+            df_new_observations, duplicated, existing = filter_duplicate_records(df_new_observations, OBSERVATION_DIGEST_KEY_COLUMNS, observation_digest_index)
+            diagnostics.add_rows(MOCA_REMOVED_DUPLICATE_OBSERVATION, df_duplicates[duplicated], 'observation_source_value', 'person_id', quarantine=False)
+            sys.stderr.write(f"Removed {duplicated.sum()} duplicate and {existing.sum()} existing OBSERVATION records, {df_new_observations.shape[0]} remain.\n")
+            sys.stderr.write("OK, filtering complete.\n\n")
+
+    with report.stage('id_assignment') as stage:
+        # initialize record id allocators, ids are only reserved when the records will be written...
+        if measurementIDTracker is None:
+            measurementIDTracker = OMOPIDBlockAllocator(POSTGRES_MOCA_READ_MEASUREMENT_TABLE_NAME, 'measurement_id', engine, peek=not MOCA_OMOP_WRITE_TO_DATABASE)
+        if observationIDTracker is None:
+            observationIDTracker = OMOPIDBlockAllocator(POSTGRES_MOCA_READ_OBSERVATION_TABLE_NAME, 'observation_id', engine, peek=not MOCA_OMOP_WRITE_TO_DATABASE)
         
-    # create new measurements and observations data frame in preparation to write to database
-    df_new_measurements = pd.DataFrame([dict(m) for m in moca_measurements])
-    sys.stderr.write(f"Created dataframe with {df_new_measurements.shape[0]} new MEASUREMENT records.\n")
-    df_new_observations = pd.DataFrame([dict(o) for o in moca_observations])    
-    sys.stderr.write(f"Created dataframe with {df_new_observations.shape[0]} new OBSERVATION records.\n")
+        # for the valid unique records, we need to add the measurement_id and observeration_ids...
+        df_new_measurements['measurement_id'] = measurementIDTracker.get_next_ids(df_new_measurements.shape[0])
+        sys.stderr.write(f"Filled in measurement_id for valid MEASUREMENT records.\n")
+        df_new_observations['observation_id'] = observationIDTracker.get_next_ids(df_new_observations.shape[0])
+        sys.stderr.write(f"Filled in observation_id for valid OBSERVATION records.\n")
+        stage.records = df_new_measurements.shape[0] + df_new_observations.shape[0]
 
     if MOCA_OMOP_WRITE_TO_DATABASE:    
-        # write measurement records to table as append...
-        # pd.to_sql does not return the total number of rows written,
-        # so we have to compute this for ourselves...
-        n_before = get_table_row_count(POSTGRES_MOCA_WRITE_SCHEMA_NAME, POSTGRES_MOCA_WRITE_MEASUREMENT_TABLE_NAME, engine)    
-        ignore = df_new_measurements.to_sql(POSTGRES_MOCA_WRITE_MEASUREMENT_TABLE_NAME, schema=POSTGRES_MOCA_WRITE_SCHEMA_NAME, 
-                               if_exists='append', index=False, con=engine)    
-        n_wrote = get_table_row_count(POSTGRES_MOCA_WRITE_SCHEMA_NAME, POSTGRES_MOCA_WRITE_MEASUREMENT_TABLE_NAME, engine) - n_before        
-        sys.stderr.write(f"Appended {n_wrote} MEASUREMENT records to table '{POSTGRES_MOCA_WRITE_SCHEMA_NAME}.{POSTGRES_MOCA_WRITE_MEASUREMENT_TABLE_NAME}'.\n")
+        with report.stage('db_write_measurement') as stage:
+            # write measurement records to table as append...
+            if MOCA_OMOP_DATABASE_WRITE_METHOD == 'copy':
+                # COPY reports the exact number of rows written
+                n_wrote = copy_dataframe_to_table(df_new_measurements, POSTGRES_MOCA_WRITE_SCHEMA_NAME, POSTGRES_MOCA_WRITE_MEASUREMENT_TABLE_NAME, 
+                                                  OMOP_CDM_54_MEASUREMENT_COLUMNS, engine, copy_format=MOCA_OMOP_COPY_FORMAT)
+            else:
+                # pd.to_sql does not return the total number of rows written,
+                # so we have to compute this for ourselves...
+                n_before = get_table_row_count(POSTGRES_MOCA_WRITE_SCHEMA_NAME, POSTGRES_MOCA_WRITE_MEASUREMENT_TABLE_NAME, engine)    
+                ignore = df_new_measurements.to_sql(POSTGRES_MOCA_WRITE_MEASUREMENT_TABLE_NAME, schema=POSTGRES_MOCA_WRITE_SCHEMA_NAME, 
+                                       if_exists='append', index=False, con=engine)    
+                n_wrote = get_table_row_count(POSTGRES_MOCA_WRITE_SCHEMA_NAME, POSTGRES_MOCA_WRITE_MEASUREMENT_TABLE_NAME, engine) - n_before        
+            sys.stderr.write(f"Appended {n_wrote} MEASUREMENT records to table '{POSTGRES_MOCA_WRITE_SCHEMA_NAME}.{POSTGRES_MOCA_WRITE_MEASUREMENT_TABLE_NAME}'.\n")
+            stage.records = n_wrote
     else:
         sys.stderr.write("*** Skipping writing MEASUREMENT records to database.***\n")
         sys.stderr.write("Set configuration option MOCA_OMOP_WRITE_TO_DATABASE to True to enable write.\n")
         
     if MOCA_OMOP_WRITE_TO_DATABASE:    
-        # write observation records to table as append...
-        n_before = get_table_row_count(POSTGRES_MOCA_WRITE_SCHEMA_NAME, POSTGRES_MOCA_WRITE_OBSERVATION_TABLE_NAME, engine)    
-        ignore = df_new_observations.to_sql(POSTGRES_MOCA_WRITE_OBSERVATION_TABLE_NAME, schema=POSTGRES_MOCA_WRITE_SCHEMA_NAME,  
-                               if_exists='append', index=False, con=engine)
-        n_wrote = get_table_row_count(POSTGRES_MOCA_WRITE_SCHEMA_NAME, POSTGRES_MOCA_WRITE_OBSERVATION_TABLE_NAME, engine) - n_before        
-        sys.stderr.write(f"Appended {n_wrote} OBSERVATION records to table '{POSTGRES_MOCA_WRITE_SCHEMA_NAME}.{POSTGRES_MOCA_WRITE_OBSERVATION_TABLE_NAME}'.\n")
+        with report.stage('db_write_observation') as stage:
+            # write observation records to table as append...
+            if MOCA_OMOP_DATABASE_WRITE_METHOD == 'copy':
+                n_wrote = copy_dataframe_to_table(df_new_observations, POSTGRES_MOCA_WRITE_SCHEMA_NAME, POSTGRES_MOCA_WRITE_OBSERVATION_TABLE_NAME, 
+                                                  OMOP_CDM_54_OBSERVATION_COLUMNS, engine, copy_format=MOCA_OMOP_COPY_FORMAT)
+            else:
+                n_before = get_table_row_count(POSTGRES_MOCA_WRITE_SCHEMA_NAME, POSTGRES_MOCA_WRITE_OBSERVATION_TABLE_NAME, engine)    
+                ignore = df_new_observations.to_sql(POSTGRES_MOCA_WRITE_OBSERVATION_TABLE_NAME, schema=POSTGRES_MOCA_WRITE_SCHEMA_NAME,  
+                                       if_exists='append', index=False, con=engine)
+                n_wrote = get_table_row_count(POSTGRES_MOCA_WRITE_SCHEMA_NAME, POSTGRES_MOCA_WRITE_OBSERVATION_TABLE_NAME, engine) - n_before        
+            sys.stderr.write(f"Appended {n_wrote} OBSERVATION records to table '{POSTGRES_MOCA_WRITE_SCHEMA_NAME}.{POSTGRES_MOCA_WRITE_OBSERVATION_TABLE_NAME}'.\n")
+            stage.records = n_wrote
     else:
         sys.stderr.write("*** Skipping writing OBSERVATION records to database.***\n")
         sys.stderr.write("Set configuration option MOCA_OMOP_WRITE_TO_DATABASE to True to enable write.\n")
+
+    # write the records to OMOP CDM files, to diff between runs or bulk load later
+    if MOCA_OMOP_FILE_OUTPUT_DIR is not None:
+        with report.stage('file_write') as stage:
+            stage.records = 0
+            for table_name, df, columns, defaults in [('MEASUREMENT', df_new_measurements, OMOP_CDM_54_MEASUREMENT_COLUMNS, OMOP_CDM_54_MEASUREMENT_DEFAULTS),
+                                                      ('OBSERVATION', df_new_observations, OMOP_CDM_54_OBSERVATION_COLUMNS, OMOP_CDM_54_OBSERVATION_DEFAULTS)]:
+                filename = os.path.join(MOCA_OMOP_FILE_OUTPUT_DIR, f'{table_name.lower()}.{MOCA_OMOP_FILE_OUTPUT_FORMAT}')
+                n_wrote = write_omop_dataframe_to_file(df, filename, columns, defaults)
+                sys.stderr.write(f"Wrote {n_wrote} {table_name} records to file '{filename}'.\n")
+                stage.records += n_wrote
+
+    # the new records are written, remember the files and rows they came from
+    if MOCA_INCREMENTAL_MODE:
+        if MOCA_OMOP_WRITE_TO_DATABASE:
+            n_retried = update_moca_incremental_manifest(incremental_manifest, incremental_updates)
+            incremental_manifest.save()
+            sys.stderr.write(f"Updated incremental manifest '{MOCA_INCREMENTAL_MANIFEST_PATH}', {n_retried} rows of participants not in the person table are read again next run.\n")
+        else:
+            sys.stderr.write(f"Incremental manifest '{MOCA_INCREMENTAL_MANIFEST_PATH}' not updated.\n")
+
+    # report the warnings and rejections of the whole run
+    diagnostics.write_summary()
+    if MOCA_DIAGNOSTICS_QUARANTINE_PATH is not None:
+        n_quarantined = diagnostics.write_quarantine(MOCA_DIAGNOSTICS_QUARANTINE_PATH)
+        sys.stderr.write(f"Wrote {n_quarantined} rejected rows to quarantine file '{MOCA_DIAGNOSTICS_QUARANTINE_PATH}'.\n")
         
     # close database connection
     connection.close()
 
     # end timing
+    report.info['diagnostics'] = {reason: diagnostics.get_total(reason) for reason, key in diagnostics.counts}
+    report.write()
     elapsed = time.time() - start    
     sys.stderr.write(f"Completed process_moca_etl() in {elapsed:0.2f} seconds.\n")
@@ -17,9 +17,72 @@ STANDARDS_MAPPING_CSV_PATH='/home/azureuser/omop_etl_labs_and_moca/MOCA/STANDARD
 # glob wildcard path to the raw MOCA source data files
 MOCA_SOURCE_DATA_GLOB = '/home/azureuser/data/moca/MOCA-latest.csv;/home/azureuser/data/moca/MOCA-latest-Paper.csv'
 
+# pandas csv engine used to read the MoCA data files, None for the default engine. keep None:
+# the 'pyarrow' engine reads values such as '12:30' and '2023-01-02' as times and dates, which
+# changes their value_source_value and record digests. the data files are read by this many threads
+MOCA_CSV_ENGINE = None
+MOCA_SOURCE_READ_THREADS = 4
+
+# control filtering out DUPLICATE records, off by default. the MoCA ETL did not filter duplicates before,
+# with this on only the first record with each person_id, datetime, source value and value is kept,
+# which drops many records from exports that repeat a participant's values (see README)
+MOCA_OMOP_FILTER_OUT_DUPLICATE_RECORDS = False
+
+# control also filtering out records that are already in the OMOP measurement and observation
+# tables, off by default, only used when filtering out duplicate records. the digests of the existing records
+# are kept in on-disk indexes, only records added since the last run are read from the database
+MOCA_OMOP_FILTER_OUT_EXISTING_RECORDS = False
+MOCA_OMOP_MEASUREMENT_DIGEST_INDEX_PATH = './cache/measurement_digest_index.npz'
+MOCA_OMOP_OBSERVATION_DIGEST_INDEX_PATH = './cache/observation_digest_index.npz'
+
+# control incremental runs, source files that have not changed since the last run are skipped
+# and only the new or changed participant rows of the other files are transformed and appended.
+# the manifest of loaded files and rows is only updated after the records are written. rows of participants
+# not in the person table yet, and their files, are read again on the next run, and all files and rows are
+# processed again when the mapping files change. changed rows are reported in the diagnostics, the records
+# of their earlier version are not removed
+MOCA_INCREMENTAL_MODE = False
+MOCA_INCREMENTAL_MANIFEST_PATH = './cache/moca_incremental_manifest.npz'
+
+# control caching the reference data read on each run (the person table, the standards mapping 
+# csv and the redcap report) as local snapshots, shared with the labs ETL. snapshots are
+# refreshed when the tables or files change, which is checked
+# from the tables' row count, highest id and statistics counters. off by default, the parquet snapshots
+# are written to the cache directory, relative to the working directory unless it is an absolute path
+MOCA_USE_REFERENCE_SNAPSHOT_CACHE = False
+MOCA_REFERENCE_SNAPSHOT_CACHE_DIR = './cache/reference_snapshots'
+
+# control transforming the raw MoCA rows with the columnar (array based) engine
+# instead of creating one record at a time, the output records are the same
+MOCA_OMOP_COLUMNAR_TRANSFORM = False
+
+# warnings and rejected rows are counted by reason and source file and summarized at the end
+# of the run, with this many sample participant ids of each. set the quarantine path, a .csv or
+# .parquet file, e.g. './quarantine/moca_rejected.csv', to also write the full rejected raw rows
+MOCA_DIAGNOSTICS_MAX_SAMPLES = 5
+MOCA_DIAGNOSTICS_QUARANTINE_PATH = None
+
+# JSON run report with the seconds, records/sec and peak memory of each stage of the run,
+# None for no report. with --profile the stage profiles are written next to it
+MOCA_RUN_REPORT_PATH = './reports/moca_run_report.json'
+
 # control writing to the OMOP database, for debugging
 MOCA_OMOP_WRITE_TO_DATABASE = True 
 
+# method used to write records to the OMOP database, 'copy' streams the records
+# with postgres COPY ... FROM STDIN, 'to_sql' appends them with INSERT statements
+MOCA_OMOP_DATABASE_WRITE_METHOD = 'copy'
+
+# COPY format used when writing with the 'copy' method, 'text' or 'binary'
+MOCA_OMOP_COPY_FORMAT = 'text'
+
+# directory to also write the new MEASUREMENT and OBSERVATION records to as OMOP CDM files, e.g. './output/moca',
+# for dry runs with MOCA_OMOP_WRITE_TO_DATABASE = False and for bulk loading later. None for no files
+MOCA_OMOP_FILE_OUTPUT_DIR = None
+
+# format of those files, 'parquet' or 'csv'
+MOCA_OMOP_FILE_OUTPUT_FORMAT = 'parquet'
+
 ##SRC:  This points to the Redcap extract file
 redcap_report='/home/azureuser/data/redcap/Redcap_data_report_329574.csv'
 
@@ -2,7 +2,12 @@
 #
 # simple python script to kick off the main moca etl processing function
 #
+import argparse
 from moca_etl import process_moca_etl
 
 if __name__ == '__main__':
-    process_moca_etl()
+    parser = argparse.ArgumentParser(description='AIREADI MoCA OMOP ETL')
+    parser.add_argument('--profile', action='store_true',
+                        help='run each stage under cProfile and tracemalloc and write the profiles next to the run report')
+    args = parser.parse_args()
+    process_moca_etl(profile=args.profile)
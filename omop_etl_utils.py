@@ -4,7 +4,28 @@
 # constants, functions, and structures useful for
 # several source data type ETL processes.
 #
+import sys
+import os
+import io
+import re
+import struct
+import decimal
+import functools
+import hashlib
+import json
+import time
+import datetime
+import contextlib
+import cProfile
+import pstats
+try:
+    import resource
+except ImportError:
+    # unix only, without it the memory high-water marks are not reported
+    resource = None
+import tracemalloc
 import pandas as pd
+import numpy as np
 from sqlalchemy import text
 
 # omop concepts used
@@ -26,76 +47,248 @@ class dotdict(dict):
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
     
+class MappingPlan():
+    # read-only object compiled once from a standards mapping file, e.g. by the ETLs'
+    # mapping plan compilers. the attributes are set from the keyword arguments and
+    # numpy arrays are made read-only, so a plan can be shared and cached safely
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            object.__setattr__(self, name, value)
+        self.__setstate__(self.__dict__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"MappingPlan is read-only, unable to set '{name}'")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"MappingPlan is read-only, unable to delete '{name}'")
+
+    def __repr__(self):
+        return f"MappingPlan({', '.join(f'{k}={v!r}' for k, v in self.__dict__.items())})"
+
 # omop structures
-def create_empty_measurement_record():
+# explicit OMOP CDM 5.4 column orders, used for records and when writing to the database
+OMOP_CDM_54_MEASUREMENT_COLUMNS = [
+    'measurement_id', 'person_id', 'measurement_concept_id', 'measurement_date', 'measurement_datetime', 
+    'measurement_time', 'measurement_type_concept_id', 'operator_concept_id', 'value_as_number', 
+    'value_as_concept_id', 'unit_concept_id', 'range_low', 'range_high', 'provider_id', 
+    'visit_occurrence_id', 'visit_detail_id', 'measurement_source_value', 'measurement_source_concept_id', 
+    'unit_source_value', 'unit_source_concept_id', 'value_source_value', 'measurement_event_id', 
+    'meas_event_field_concept_id',
+]
+
+OMOP_CDM_54_OBSERVATION_COLUMNS = [
+    'observation_id', 'person_id', 'observation_concept_id', 'observation_date', 'observation_datetime', 
+    'observation_type_concept_id', 'value_as_number', 'value_as_string', 'value_as_concept_id', 
+    'qualifier_concept_id', 'unit_concept_id', 'provider_id', 'visit_occurrence_id', 'visit_detail_id', 
+    'observation_source_value', 'observation_source_concept_id', 'unit_source_value', 
+    'qualifier_source_value', 'value_source_value', 'observation_event_id', 'obs_event_field_concept_id',
+]
+
+# default values of the fields of a new, empty record
+OMOP_CDM_54_MEASUREMENT_DEFAULTS = {
+    'measurement_id':0,
+    'person_id':0,
+    'measurement_concept_id':0,
+    'measurement_date':None,
+    'measurement_datetime':None,
+    'measurement_time':None,
+    'measurement_type_concept_id':0,
+    'operator_concept_id':0,
+    'value_as_number':0.0,
+    'value_as_concept_id':0,
+    'unit_concept_id':0,
+    'range_low':0.0,
+    'range_high':0.0,
+    'provider_id':0,
+    'visit_occurrence_id':0,
+    'visit_detail_id':0,
+    'measurement_source_value':'',
+    'measurement_source_concept_id':0,
+    'unit_source_value':'',
+    'unit_source_concept_id':0,
+    'value_source_value':'',
+    'measurement_event_id':0,
+    'meas_event_field_concept_id':0,
+}
+
+OMOP_CDM_54_OBSERVATION_DEFAULTS = {
+    'observation_id':0,
+    'person_id':0,
+    'observation_concept_id':0,
+    'observation_date':None,
+    'observation_datetime':None,
+    'observation_type_concept_id':0,
+    'value_as_number':0.0,
+    'value_as_string':'',
+    'value_as_concept_id':0,
+    'qualifier_concept_id':0,
+    'unit_concept_id':0,
+    'provider_id':0,
+    'visit_occurrence_id':0,
+    'visit_detail_id':0,
+    'observation_source_value':'',
+    'observation_source_concept_id':0,
+    'unit_source_value':'',
+    'qualifier_source_value':'',
+    'value_source_value':'',
+    'observation_event_id':0,
+    'obs_event_field_concept_id':0,
+}
+
+# OMOP CDM 5.4 postgres DDL for the tables written by the ETLs, for scratch and benchmark schemas
+OMOP_CDM_54_MEASUREMENT_DDL = """
+CREATE TABLE {schema}.measurement (
+    measurement_id integer NOT NULL,
+    person_id integer NOT NULL,
+    measurement_concept_id integer NOT NULL,
+    measurement_date date NOT NULL,
+    measurement_datetime timestamp NULL,
+    measurement_time varchar(10) NULL,
+    measurement_type_concept_id integer NOT NULL,
+    operator_concept_id integer NULL,
+    value_as_number numeric NULL,
+    value_as_concept_id integer NULL,
+    unit_concept_id integer NULL,
+    range_low numeric NULL,
+    range_high numeric NULL,
+    provider_id integer NULL,
+    visit_occurrence_id integer NULL,
+    visit_detail_id integer NULL,
+    measurement_source_value varchar(50) NULL,
+    measurement_source_concept_id integer NULL,
+    unit_source_value varchar(50) NULL,
+    unit_source_concept_id integer NULL,
+    value_source_value varchar(50) NULL,
+    measurement_event_id bigint NULL,
+    meas_event_field_concept_id integer NULL )"""
+
+OMOP_CDM_54_OBSERVATION_DDL = """
+CREATE TABLE {schema}.observation (
+    observation_id integer NOT NULL,
+    person_id integer NOT NULL,
+    observation_concept_id integer NOT NULL,
+    observation_date date NOT NULL,
+    observation_datetime timestamp NULL,
+    observation_type_concept_id integer NOT NULL,
+    value_as_number numeric NULL,
+    value_as_string varchar(60) NULL,
+    value_as_concept_id integer NULL,
+    qualifier_concept_id integer NULL,
+    unit_concept_id integer NULL,
+    provider_id integer NULL,
+    visit_occurrence_id integer NULL,
+    visit_detail_id integer NULL,
+    observation_source_value varchar(50) NULL,
+    observation_source_concept_id integer NULL,
+    unit_source_value varchar(50) NULL,
+    qualifier_source_value varchar(50) NULL,
+    value_source_value varchar(50) NULL,
+    observation_event_id bigint NULL,
+    obs_event_field_concept_id integer NULL )"""
+
+class OMOPRecord():
+    # compact OMOP record with one slot per field instead of a dict per record.
+    # keeps the attribute and item access of the dotdict records it replaces,
+    # and dict(record) still works. subclasses set __slots__, fields and defaults.
+    __slots__ = ()
+    fields = ()
+    defaults = ()
+
+    def __init__(self):
+        for name, value in zip(self.fields, self.defaults):
+            setattr(self, name, value)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def keys(self):
+        return list(self.fields)
+
+    def values(self):
+        return [getattr(self, name) for name in self.fields]
+
+    def __repr__(self):
+        return repr(dict(zip(self.fields, self.values())))
+
+
+class OMOPMeasurementRecord(OMOPRecord):
     # based on OMOP CDM 5.4
-    dx = {'measurement_id':0, 
-          'person_id':0,
-          'measurement_concept_id':0,
-          'measurement_date':None, 
-          'measurement_datetime':None, 
-          'measurement_time':None,
-          'measurement_type_concept_id':0, 
-          'operator_concept_id':0, 
-          'value_as_number':0.0,
-          'value_as_concept_id':0, 
-          'unit_concept_id':0, 
-          'range_low':0.0, 
-          'range_high':0.0,
-          'provider_id':0, 
-          'visit_occurrence_id':0, 
-          'visit_detail_id':0,
-          'measurement_source_value':'', 
-          'measurement_source_concept_id':0,
-          'unit_source_value':'', 
-          'unit_source_concept_id':0, 
-          'value_source_value':'',
-          'measurement_event_id':0, 
-          'meas_event_field_concept_id':0}
-    # return a dotdict to save a lot of biolerplate typing
-    # needs to be changed back into a dict when using in DataFrame
-    return dotdict(dx)
+    __slots__ = tuple(OMOP_CDM_54_MEASUREMENT_COLUMNS)
+    fields = tuple(OMOP_CDM_54_MEASUREMENT_COLUMNS)
+    defaults = tuple(OMOP_CDM_54_MEASUREMENT_DEFAULTS[c] for c in OMOP_CDM_54_MEASUREMENT_COLUMNS)
 
 
-def create_empty_observation_record():
+class OMOPObservationRecord(OMOPRecord):
     # based on OMOP CDM 5.4
-    dx = {'observation_id':0, 
-          'person_id':0, 
-          'observation_concept_id':0,
-          'observation_date':None,
-          'observation_datetime':None,
-          'observation_type_concept_id':0, 
-          'value_as_number':0.0, 
-          'value_as_string':'',
-          'value_as_concept_id':0, 
-          'qualifier_concept_id':0, 
-          'unit_concept_id':0,
-          'provider_id':0, 
-          'visit_occurrence_id':0, 
-          'visit_detail_id':0,
-          'observation_source_value':'', 
-          'observation_source_concept_id':0,
-          'unit_source_value':'', 
-          'qualifier_source_value':'', 
-          'value_source_value':'',
-          'observation_event_id':0, 
-          'obs_event_field_concept_id':0}
-    # return a dotdict to save a lot of biolerplate typing
-    # needs to be changed back into a dict when using in DataFrame
-    return dotdict(dx)
+    __slots__ = tuple(OMOP_CDM_54_OBSERVATION_COLUMNS)
+    fields = tuple(OMOP_CDM_54_OBSERVATION_COLUMNS)
+    defaults = tuple(OMOP_CDM_54_OBSERVATION_DEFAULTS[c] for c in OMOP_CDM_54_OBSERVATION_COLUMNS)
+
+
+def create_empty_measurement_record():
+    return OMOPMeasurementRecord()
+
+
+def create_empty_observation_record():
+    return OMOPObservationRecord()
+
+
+def records_to_dataframe(records, record_class):
+    # build a DataFrame straight from the record fields, one column at a time,
+    # without copying every record into a dict first
+    return pd.DataFrame({name: [getattr(r, name) for r in records] for name in record_class.fields}, 
+                        columns=list(record_class.fields))
 
 #
 # MOCA data formats seem to vary
 #
 # SRC Change 10.22.24: made all dates d/m/y and added flexibiilty fo years
 MOCA_STRING_DATE_FORMATS = ['%m-%d-%Y', '%m/%d/%Y','%m-%d-%y','%m/%d/%y','%Y-%m-%d', '%Y/%m/%d','%y-%m-%d','%y/%m/%d']
- 
+
+# regular expressions for the shape of a string in each of the MOCA_STRING_DATE_FORMATS,
+# a string is only handed to pd.to_datetime() for the formats whose shape it has,
+# so finding the right format does not cost an exception for every format tried.
+# these are deliberately a little looser than the strptime fields, pd.to_datetime() has the final say.
+MOCA_STRING_DATE_FORMAT_FIELD_REGEXES = {'%m': r'[ \d]?\d', '%d': r'[ \d]?\d', '%Y': r'\d{1,4}', '%y': r'\d{1,2}'}
+
+def moca_date_format_to_regex(date_format):
+    regex = re.escape(date_format)
+    for field, field_regex in MOCA_STRING_DATE_FORMAT_FIELD_REGEXES.items():
+        regex = regex.replace(re.escape(field), field_regex)
+    return re.compile(regex)
+
+MOCA_STRING_DATE_FORMAT_REGEXES = {df: moca_date_format_to_regex(df) for df in MOCA_STRING_DATE_FORMATS}
+
+def sniff_moca_date_formats(s):
+    # return the MOCA_STRING_DATE_FORMATS, in order, that the string has the shape of
+    return [df for df in MOCA_STRING_DATE_FORMATS if MOCA_STRING_DATE_FORMAT_REGEXES[df].fullmatch(s)]
+
+# the record at a time date conversions below are memoized, the same few hundred distinct
+# date strings are converted over and over for hundreds of thousands of records. the caches
+# are bounded, so a long run or worker process does not keep every value it ever parsed, the
+# columnar paths convert each distinct value of a column once and don't need them.
+# pd.Timestamp values are immutable, so it is safe to hand out cached values.
+DATE_CONVERSION_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=DATE_CONVERSION_CACHE_SIZE)
 def moca_string_to_datetime(s):
-    for df in MOCA_STRING_DATE_FORMATS:
-        try:
-            return pd.to_datetime(s, format=df)
-        except:
-            pass
+    if not isinstance(s, str):
+        # missing values and real datetimes, pd.to_datetime() handles these with the first format
+        return pd.to_datetime(s, format=MOCA_STRING_DATE_FORMATS[0])
+    # the first format, in list order, that converts the string wins
+    for df in sniff_moca_date_formats(s):
+        dt = pd.to_datetime(s, format=df, errors='coerce')
+        if pd.notna(dt):
+            return dt
     return None # can't convert the date format
 
 def moca_string_to_date(s):
@@ -104,35 +297,138 @@ def moca_string_to_date(s):
 def moca_string_to_time(s):
     return moca_string_to_datetime(s).time()
 
+def moca_string_to_date_datetime_time(s):
+    # parse once and return (date, datetime, time) together
+    dt = moca_string_to_datetime(s)
+    if dt is None:
+        raise ValueError(f"Unable to convert MoCA date '{s}' using any of the formats {MOCA_STRING_DATE_FORMATS}.")
+    return (dt.date(), dt, dt.time())
+
+def moca_column_to_date_datetime_time(values, column_name):
+    # vectorized version of moca_string_to_date_datetime_time(), returns four values,
+    # three Series (date, datetime, time) aligned with values, and the list of strings that
+    # don't match any of the MOCA_STRING_DATE_FORMATS, which are reported and converted to NaT.
+    # the distinct strings are grouped by the format they have the shape of and each 
+    # group is converted in one pass, trying the formats in list order as moca_string_to_datetime() does.
+    values = pd.Series(values, dtype=object)
+    distinct_values = pd.Series(values.dropna().unique(), dtype=object)
+    distinct_strings = distinct_values[distinct_values.map(lambda v: isinstance(v, str)).to_numpy(dtype=bool)]
+    datetime_by_value = {v: moca_string_to_datetime(v) for v in distinct_values if not isinstance(v, str)}
+    winning_format_counts = {}
+    unresolved = distinct_strings
+    for df in MOCA_STRING_DATE_FORMATS:
+        if unresolved.shape[0] == 0:
+            break
+        has_shape = unresolved.str.fullmatch(MOCA_STRING_DATE_FORMAT_REGEXES[df]).to_numpy(dtype=bool)
+        if not has_shape.any():
+            continue
+        converted = pd.to_datetime(unresolved[has_shape], format=df, errors='coerce')
+        resolved = converted.notna()
+        datetime_by_value.update(zip(unresolved[has_shape][resolved.to_numpy()], converted[resolved]))
+        if resolved.any():
+            winning_format_counts[df] = int(resolved.sum())
+        unresolved = unresolved[~unresolved.isin(list(datetime_by_value.keys()))]
+
+    # report the formats found and the strings that did not match any format
+    sys.stderr.write(f"Converted {len(distinct_strings) - len(unresolved)} distinct '{column_name}' dates using formats {winning_format_counts}.\n")
+    unmatched_values = list(unresolved)
+    if unmatched_values:
+        sys.stderr.write(f"Unable to convert {len(unmatched_values)} distinct '{column_name}' dates, these are set to NaT: {unmatched_values[:20]}\n")
+
+    datetimes = values.map(datetime_by_value)
+    datetimes = pd.to_datetime(datetimes.where(datetimes.notna(), pd.NaT))
+    return (datetimes.dt.date.astype(object), datetimes, datetimes.dt.time.astype(object), unmatched_values)
+
 #
 # these formats should not be changed
 #
-def labs_string_to_date(s):
-    return pd.to_datetime(s, format='%m/%d/%Y').date()
+LABS_STRING_DATE_FORMAT = '%m/%d/%Y'
 
+@functools.lru_cache(maxsize=DATE_CONVERSION_CACHE_SIZE)
 def labs_string_to_datetime(s):
-    return pd.to_datetime(s, format='%m/%d/%Y')    
+    # real Excel datetime cells are used as is, without going through a string
+    if isinstance(s, (datetime.datetime, datetime.date)):
+        return pd.Timestamp(s)
+    return pd.to_datetime(s, format=LABS_STRING_DATE_FORMAT)    
+
+def labs_string_to_date(s):
+    return labs_string_to_datetime(s).date()
 
 def labs_string_to_time(s):
-    return pd.to_datetime(s, format='%m/%d/%Y').time()
+    return labs_string_to_datetime(s).time()
 
+def labs_string_to_date_datetime_time(s):
+    # parse once and return (date, datetime, time) together
+    dt = labs_string_to_datetime(s)
+    return (dt.date(), dt, dt.time())
+
+def labs_column_to_date_datetime_time(values):
+    # vectorized version of labs_string_to_date_datetime_time(), returns three
+    # Series (date, datetime, time) aligned with values. each distinct value is parsed
+    # once, the distinct strings with a single whole column conversion, and 
+    # Excel datetime cells are used directly without converting them to strings.
+    values = pd.Series(values, dtype=object)
+    distinct_values = pd.Series(values.unique(), dtype=object)
+    is_string = distinct_values.map(lambda v: isinstance(v, str)).to_numpy(dtype=bool)
+    distinct_datetimes = list(distinct_values)
+    if is_string.any():
+        for i, dt in zip(np.flatnonzero(is_string), pd.to_datetime(distinct_values[is_string], format=LABS_STRING_DATE_FORMAT)):
+            distinct_datetimes[i] = dt
+    for i in np.flatnonzero(~is_string):
+        distinct_datetimes[i] = labs_string_to_datetime(distinct_values.iat[i])
+    datetime_by_value = dict(zip(distinct_values, distinct_datetimes))
+    date_by_value = {v: dt.date() for v, dt in datetime_by_value.items()}
+    time_by_value = {v: dt.time() for v, dt in datetime_by_value.items()}
+    return (values.map(date_by_value).astype(object), 
+            pd.to_datetime(values.map(datetime_by_value)), 
+            values.map(time_by_value).astype(object))
+
+
+class OMOPIDBlockAllocator():
+    # hands out contiguous blocks of new record ids for a table, reserved with a postgres
+    # sequence, so that several ETL processes can write to the same table at the same time.
+    # each reservation takes a transaction level advisory lock on the sequence, moves the
+    # sequence past MAX(id) if rows were written without it, and advances the sequence by
+    # the size of the block. ids of a block that is never written are simply skipped.
+    # with peek=True nothing is reserved, ids follow on from the current high-water mark,
+    # for dry runs that do not write to the database.
+    def __init__(self, tablename, idfieldname, engine, peek=False):
+        self.tablename = tablename
+        self.idfieldname = idfieldname
+        self.engine = engine
+        self.peek = peek
+        self.sequence_name = f"{tablename}_{idfieldname}_etl_seq"
+        self.next_peek_id = None
+
+    def get_high_water_id(self, connection):
+        # largest id either written to the table or already reserved from the sequence
+        max_id = connection.execute(text(f"SELECT COALESCE(MAX({self.idfieldname}), 0) FROM {self.tablename}")).scalar()
+        last_reserved_id = 0
+        if connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {'name': self.sequence_name}).scalar():
+            last_reserved_id = connection.execute(text(f"SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END FROM {self.sequence_name}")).scalar()
+        return max(int(max_id), int(last_reserved_id))
+
+    def get_next_ids(self, n):
+        # reserve a contiguous block of n ids for a whole batch of records
+        if self.peek:
+            if self.next_peek_id is None:
+                with self.engine.connect() as connection:
+                    self.next_peek_id = self.get_high_water_id(connection) + 1
+            first_id = self.next_peek_id
+            self.next_peek_id += n
+            return np.arange(first_id, first_id + n, dtype=np.int64)
+
+        with self.engine.begin() as connection:
+            connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {'name': self.sequence_name})
+            connection.execute(text(f"CREATE SEQUENCE IF NOT EXISTS {self.sequence_name} AS bigint MINVALUE 0 START WITH 0"))
+            first_id = self.get_high_water_id(connection) + 1
+            if n > 0:
+                connection.execute(text("SELECT setval(:name, :last_id, true)"), {'name': self.sequence_name, 'last_id': first_id + n - 1})
+        return np.arange(first_id, first_id + n, dtype=np.int64)
 
-class OMOPIDTracker():
-    def __init__(self, tablename, idfieldname, engine):
-        self.next_id = None
-        query = text(f"SELECT MAX({idfieldname}) FROM {tablename}")
-        try:
-            df_temp = pd.read_sql(query, engine)      
-            self.next_id = df_temp.iloc[0]['max'] + 1
-        except:
-            self.next_id = 1
-            
-        
     def get_next_id(self):
-        nid = self.next_id
-        self.next_id += 1
-        return nid
-        
+        return int(self.get_next_ids(1)[0])
+
 def get_table_row_count(schema_name, table_name, engine):
     query = text(f"SELECT COUNT(*) FROM {schema_name}.{table_name}")
     df_temp = pd.read_sql(query, engine)      
@@ -140,37 +436,835 @@ def get_table_row_count(schema_name, table_name, engine):
     
 
 class OMOPVisitOccurrenceLookup():
-    def __init__(self, tablename, visit_concept_id, engine):
-        # grab all the visits of the correct type...
-        query = text(f"""SELECT visit_occurrence_id, visit_start_date, person_id 
-                        FROM {tablename}
-                        WHERE visit_concept_id = {visit_concept_id}""")
-        df_temp = pd.read_sql(query, engine)
-
-        # force id types to integers - this may not be needed with the VM DB
-        # but seems to be needed with the development db, 
+    def __init__(self, tablename, visit_concept_id, engine, person_ids=None, snapshot_cache=None):
+        # grab the earliest visit of the correct type for each person, optionally only for 
+        # the persons in person_ids, ties on the start date go to the lowest visit_occurrence_id
+        if snapshot_cache is not None:
+            df_temp = snapshot_cache.read_earliest_visits(tablename, visit_concept_id)
+            if person_ids is not None:
+                df_temp = df_temp[df_temp.person_id.isin(person_ids)]
+        else:
+            person_filter = "" if person_ids is None else "AND person_id = ANY(:person_ids)"
+            query = text(f"""SELECT DISTINCT ON (person_id) person_id, visit_occurrence_id, visit_start_date
+                            FROM {tablename}
+                            WHERE visit_concept_id = {visit_concept_id} {person_filter}
+                            ORDER BY person_id, visit_start_date, visit_occurrence_id""")
+            params = None if person_ids is None else {'person_ids': [int(pid) for pid in person_ids]}
+            df_temp = pd.read_sql(query, engine, params=params)
+
+        # arrays sorted by person_id for batch lookups, force id types to integers - 
+        # this may not be needed with the VM DB but seems to be needed with the development db, 
         # it should not hurt anything
-        df_temp.visit_occurrence_id = df_temp.visit_occurrence_id.astype(int)
-        #df_temp.person_id = df_temp.person_id.astype(float).astype(int)
-        df_temp.person_id = df_temp.person_id.astype(int)
-
-        # construct a table mapping person_id to the earliest visit_start_date
-        lookup = {}
-        for index, r in df_temp.iterrows():
-            if r.person_id not in lookup:
-                lookup[r.person_id] = (r.visit_occurrence_id, r.visit_start_date)
-            elif r.visit_start_date < lookup[r.person_id][1]:
-                lookup[r.person_id] = (r.visit_occurrence_id, r.visit_start_date)
+        self.person_ids = df_temp.person_id.to_numpy(dtype=np.int64)
+        self.visit_occurrence_ids = df_temp.visit_occurrence_id.to_numpy(dtype=np.int64)
+        self.visit_start_dates = df_temp.visit_start_date.to_numpy(dtype=object)
+
         # save mapping from person_id -> (visit_occurrence_id, visit_start_date)
-        self.lookup = lookup
+        self.lookup = dict(zip(self.person_ids.tolist(), zip(self.visit_occurrence_ids.tolist(), self.visit_start_dates)))
+
+    def get_earliest_visits(self, person_ids):
+        # batch lookup, returns arrays of visit_occurrence_ids (0 when not found), 
+        # visit_start_dates (None when not found) and a found mask
+        person_ids = np.asarray(person_ids, dtype=np.int64)
+        visit_occurrence_ids = np.zeros(person_ids.shape[0], dtype=np.int64)
+        visit_start_dates = np.full(person_ids.shape[0], None, dtype=object)
+        found = np.zeros(person_ids.shape[0], dtype=bool)
+        if self.person_ids.shape[0] > 0:
+            positions = np.searchsorted(self.person_ids, person_ids).clip(max=self.person_ids.shape[0] - 1)
+            found = self.person_ids[positions] == person_ids
+            visit_occurrence_ids[found] = self.visit_occurrence_ids[positions[found]]
+            visit_start_dates[found] = self.visit_start_dates[positions[found]]
+        return visit_occurrence_ids, visit_start_dates, found
 
     def get_earliest_visit_occurrence_id_and_start_date(self, person_id):
         return self.lookup.get(person_id, None)
 
 
+#
+# bulk loading records into postgres with COPY ... FROM STDIN
+#
+
+def format_copy_text_value(v):
+    # format a single value for the COPY text format, None/NaN/NaT are NULL
+    if v is None or (not isinstance(v, str) and pd.isna(v)):
+        return '\\N'
+    if isinstance(v, str):
+        return v.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    if isinstance(v, (float, np.floating)):
+        # integral floats are written without a fraction so they load into integer columns
+        return str(int(v)) if float(v).is_integer() else repr(float(v))
+    if isinstance(v, (datetime.datetime, datetime.date, datetime.time)):
+        return v.isoformat(sep=' ') if isinstance(v, datetime.datetime) else v.isoformat()
+    return str(v)
+
+
+def encode_column_values(values, encode, null_value):
+    # encode each distinct value in a column once, OMOP record columns repeat
+    # the same concept ids, dates and units over and over
+    codes, uniques = pd.factorize(values.astype(object))
+    encoded = np.array([encode(v) for v in uniques] + [null_value], dtype=object)
+    return encoded[codes]
+
 
+def format_copy_text_column(values):
+    # format a whole column for the COPY text format
+    if (pd.api.types.is_integer_dtype(values.dtype) or pd.api.types.is_bool_dtype(values.dtype)) and not values.isna().any():
+        return values.astype(np.int64).astype(str).to_numpy(dtype=object)
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return values.dt.strftime('%Y-%m-%d %H:%M:%S.%f').where(values.notna(), '\\N').to_numpy(dtype=object)
+    return encode_column_values(values, format_copy_text_value, '\\N')
 
 
+def dataframe_to_copy_text_buffer(df, columns):
+    # build an in-memory buffer in the COPY text format, one line per record
+    formatted = [format_copy_text_column(df[c]) for c in columns]
+    buffer = io.StringIO()
+    if df.shape[0] > 0:
+        lines = formatted[0]
+        for column in formatted[1:]:
+            lines = lines + '\t' + column
+        buffer.write('\n'.join(lines))
+        buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+# postgres epoch used by the COPY binary format
+POSTGRES_EPOCH_DATE = datetime.date(2000, 1, 1)
+POSTGRES_EPOCH_DATETIME = datetime.datetime(2000, 1, 1)
+POSTGRES_NUMERIC_NEG = 0x4000
+
+def encode_postgres_numeric(v):
+    # encode a number in the postgres NUMERIC binary format, base 10000 digit groups
+    d = decimal.Decimal(repr(float(v)) if isinstance(v, (float, np.floating)) else str(v))
+    sign, digits, exponent = d.as_tuple()
+    digit_string = ''.join(str(x) for x in digits)
+    if exponent > 0:
+        digit_string += '0' * exponent
+        exponent = 0
+    dscale = -exponent
+    n_integer_digits = len(digit_string) + exponent
+    if n_integer_digits > 0:
+        integer_part, fraction_part = digit_string[:n_integer_digits], digit_string[n_integer_digits:]
+    else:
+        integer_part, fraction_part = '', '0' * (-n_integer_digits) + digit_string
+    integer_part = integer_part.zfill((len(integer_part) + 3) // 4 * 4)
+    fraction_part = fraction_part.ljust((len(fraction_part) + 3) // 4 * 4, '0')
+    groups = [int(integer_part[i:i+4]) for i in range(0, len(integer_part), 4)] + \
+             [int(fraction_part[i:i+4]) for i in range(0, len(fraction_part), 4)]
+    weight = len(integer_part) // 4 - 1
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    return struct.pack(f'>hhHH{len(groups)}H', len(groups), weight, 
+                       POSTGRES_NUMERIC_NEG if sign else 0, dscale, *groups)
+
+
+def encode_postgres_timestamp(v):
+    v = pd.Timestamp(v).to_pydatetime()
+    delta = v - POSTGRES_EPOCH_DATETIME
+    return struct.pack('>q', (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def encode_postgres_date(v):
+    if isinstance(v, datetime.datetime):
+        v = v.date()
+    return struct.pack('>i', (v - POSTGRES_EPOCH_DATE).days)
+
+
+def encode_postgres_text(v):
+    if isinstance(v, (datetime.date, datetime.time)):
+        v = v.isoformat()
+    return str(v).encode('utf-8')
+
+
+# COPY binary encoders for the postgres column types used by the OMOP CDM tables
+POSTGRES_COPY_BINARY_ENCODERS = {
+    'smallint': lambda v: struct.pack('>h', int(v)),
+    'integer': lambda v: struct.pack('>i', int(v)),
+    'bigint': lambda v: struct.pack('>q', int(v)),
+    'real': lambda v: struct.pack('>f', float(v)),
+    'double precision': lambda v: struct.pack('>d', float(v)),
+    'numeric': encode_postgres_numeric,
+    'date': encode_postgres_date,
+    'timestamp without time zone': encode_postgres_timestamp,
+    'character varying': encode_postgres_text,
+    'character': encode_postgres_text,
+    'text': encode_postgres_text,
+}
+
+def get_postgres_column_types(schema_name, table_name, connection):
+    # read the postgres type of every column in a table, the binary format needs exact types
+    cursor = connection.cursor()
+    cursor.execute("""SELECT a.attname, format_type(a.atttypid, NULL)
+                      FROM pg_attribute a
+                      WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped""", 
+                   (f'{schema_name}.{table_name}',))
+    column_types = dict(cursor.fetchall())
+    cursor.close()
+    return column_types
+
+
+def dataframe_to_copy_binary_buffer(df, columns, column_types):
+    # build an in-memory buffer in the COPY binary format
+    encoders = []
+    for c in columns:
+        if column_types[c] not in POSTGRES_COPY_BINARY_ENCODERS:
+            raise ValueError(f"COPY binary format does not support column '{c}' of type '{column_types[c]}'.")
+        encoders.append(POSTGRES_COPY_BINARY_ENCODERS[column_types[c]])
+    # each field is its length followed by its bytes, NULL is a length of -1
+    def encode_field(encode):
+        def encode_with_length(v):
+            data = encode(v)
+            return struct.pack('>i', len(data)) + data
+        return encode_with_length
+    fields = [encode_column_values(df[c], encode_field(encode), struct.pack('>i', -1)) for c, encode in zip(columns, encoders)]
+    field_count = struct.pack('>h', len(columns))
+    buffer = io.BytesIO()
+    buffer.write(b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0))
+    for row in zip(*fields):
+        buffer.write(field_count)
+        buffer.write(b''.join(row))
+    buffer.write(struct.pack('>h', -1))
+    buffer.seek(0)
+    return buffer
+
+
+def copy_dataframe_to_table(df, schema_name, table_name, columns, engine, copy_format='text'):
+    # stream the records in df to postgres with COPY ... FROM STDIN from an in-memory buffer,
+    # in the given explicit column order, in a single transaction.
+    # returns the exact number of rows copied as reported by postgres.
+    if copy_format not in ('text', 'binary'):
+        raise ValueError(f"Unknown COPY format '{copy_format}', use 'text' or 'binary'.")
+    if df.shape[0] == 0:
+        return 0
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if copy_format == 'binary':
+            buffer = dataframe_to_copy_binary_buffer(df, columns, get_postgres_column_types(schema_name, table_name, connection))
+        else:
+            buffer = dataframe_to_copy_text_buffer(df, columns)
+        column_list = ', '.join(columns)
+        cursor.copy_expert(f"COPY {schema_name}.{table_name} ({column_list}) FROM STDIN WITH (FORMAT {copy_format})", buffer)
+        n_copied = cursor.rowcount
+        cursor.close()
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return n_copied
+
+
+#
+# writing records to parquet or csv files instead of the database
+#
 
+def get_omop_file_column_type(column, default):
+    # the file type of an OMOP column, from its name and the type of its default value
+    if column.endswith('_datetime'):
+        return 'datetime'
+    if column.endswith('_date'):
+        return 'date'
+    if column.endswith('_time'):
+        return 'time'
+    if isinstance(default, int):
+        return 'integer'
+    if isinstance(default, float):
+        return 'number'
+    return 'string'
+
+
+def format_omop_time_value(v):
+    # times are varchar(10) in the OMOP CDM, written as they are loaded, e.g. '08:30:15'
+    if v is None or (not isinstance(v, str) and pd.isna(v)):
+        return None
+    return v.strftime('%H:%M:%S') if isinstance(v, datetime.time) else str(v)
+
+
+def omop_dataframe_to_file_dataframe(df, columns, defaults):
+    # the records in df in the explicit OMOP column order, one consistent dtype per column,
+    # so files from the record and columnar transforms and from different runs compare equal
+    out = {}
+    for c in columns:
+        column_type = get_omop_file_column_type(c, defaults[c])
+        values = df[c]
+        if column_type == 'integer':
+            out[c] = pd.to_numeric(values).astype('Int64')
+        elif column_type == 'number':
+            out[c] = pd.to_numeric(values).astype(np.float64)
+        elif column_type == 'datetime':
+            out[c] = pd.to_datetime(values).astype('datetime64[us]')
+        elif column_type == 'date':
+            dates = pd.to_datetime(values)
+            out[c] = pd.Series(dates.dt.date.to_numpy(dtype=object), index=df.index).where(dates.notna(), None)
+        elif column_type == 'time':
+            out[c] = encode_column_values(values, format_omop_time_value, None)
+        else:
+            out[c] = values.astype(object).where(values.notna(), None).astype(pd.StringDtype())
+    return pd.DataFrame(out, columns=columns, index=df.index).reset_index(drop=True)
+
+
+def write_omop_dataframe_to_file(df, path, columns, defaults):
+    # write the records in df to path, a parquet file if it ends with .parquet otherwise a csv file,
+    # through a temporary file so a partly written file never replaces a good one.
+    # returns the number of rows written
+    file_df = omop_dataframe_to_file_dataframe(df, columns, defaults)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    if path.endswith('.parquet'):
+        file_df.to_parquet(temp_path, index=False)
+    else:
+        file_df.to_csv(temp_path, index=False, date_format='%Y-%m-%d %H:%M:%S.%f')
+    os.replace(temp_path, path)
+    return file_df.shape[0]
+
+
+#
+# duplicate record detection with stable content digests
+#
+
+# the essential distinctive source data fields of each record type
+MEASUREMENT_DIGEST_KEY_COLUMNS = ['person_id', 'measurement_datetime', 'measurement_source_value', 'value_source_value']
+OBSERVATION_DIGEST_KEY_COLUMNS = ['person_id', 'observation_datetime', 'observation_source_value', 'value_source_value']
+
+DIGEST_KEY_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+def format_digest_key_value(v):
+    # canonical text for one key value, the same whether the value came from
+    # a new record or was read back from the database
+    if isinstance(v, (float, np.floating)) and float(v).is_integer():
+        return str(int(v))
+    if isinstance(v, datetime.date):
+        return pd.Timestamp(v).strftime(DIGEST_KEY_DATETIME_FORMAT)
+    return str(v)
+
+
+def format_digest_key_column(values):
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return values.dt.strftime(DIGEST_KEY_DATETIME_FORMAT).fillna('').to_numpy(dtype=object)
+    return encode_column_values(values, format_digest_key_value, '')
+
+
+def compute_record_digests(df, key_columns):
+    # stable 64 bit blake2b digest of the key columns of every record,
+    # unlike hash() these do not change from run to run, so they can be stored
+    formatted = [format_digest_key_column(df[c]) for c in key_columns]
+    if df.shape[0] == 0:
+        return np.empty(0, dtype=np.uint64)
+    keys = formatted[0]
+    for column in formatted[1:]:
+        keys = keys + '\x1f' + column
+    return np.fromiter((int.from_bytes(hashlib.blake2b(k.encode('utf-8'), digest_size=8).digest(), 'little') for k in keys), 
+                       dtype=np.uint64, count=len(keys))
+
+
+class OMOPRecordDigestIndex():
+    # sorted array of the digests of the records already in an OMOP table, saved to 
+    # an .npz file along with the highest record id and the row count it covers.
+    # on each run only the records added since then are read from the database,
+    # the index is rebuilt from scratch when rows have been removed from the table.
+    def __init__(self, schema_name, table_name, id_column_name, key_columns, index_path, engine):
+        self.index_path = index_path
+        digests = np.empty(0, dtype=np.uint64)
+        high_water_id = -1
+        row_count = 0
+        if os.path.exists(index_path):
+            with np.load(index_path) as saved:
+                if list(saved['key_columns']) == list(key_columns):
+                    digests = saved['digests']
+                    high_water_id = int(saved['high_water_id'])
+                    row_count = int(saved['row_count'])
+
+        query = text(f"""SELECT COUNT(*) FILTER (WHERE {id_column_name} <= :high_water_id), COUNT(*), MAX({id_column_name})
+                         FROM {schema_name}.{table_name}""")
+        with engine.connect() as connection:
+            n_indexed, n_rows, max_id = connection.execute(query, {'high_water_id': high_water_id}).one()
+        if n_indexed != row_count:
+            sys.stderr.write(f"Digest index '{index_path}' is out of date with '{schema_name}.{table_name}', rebuilding it.\n")
+            digests = np.empty(0, dtype=np.uint64)
+            high_water_id = -1
+
+        # add the digests of the records written since the index was saved
+        query = text(f"SELECT {', '.join(key_columns)} FROM {schema_name}.{table_name} WHERE {id_column_name} > :high_water_id")
+        df_new = pd.read_sql(query, engine, params={'high_water_id': high_water_id})
+        self.digests = np.unique(np.concatenate((digests, compute_record_digests(df_new, key_columns))))
+        sys.stderr.write(f"Digest index covers {n_rows} records in '{schema_name}.{table_name}', {df_new.shape[0]} read from the database.\n")
+
+        if df_new.shape[0] > 0 or n_indexed != row_count:
+            os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+            temp_path = f'{index_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'wb') as f:
+                np.savez(f, digests=self.digests, key_columns=np.array(key_columns),
+                         high_water_id=-1 if max_id is None else max_id, row_count=n_rows)
+            os.replace(temp_path, index_path)
+
+    def contains(self, digests):
+        # vectorized membership test with a binary search of the sorted digests
+        if self.digests.shape[0] == 0:
+            return np.zeros(len(digests), dtype=bool)
+        positions = np.searchsorted(self.digests, digests).clip(max=self.digests.shape[0] - 1)
+        return self.digests[positions] == digests
+
+
+def filter_duplicate_records(df, key_columns, digest_index=None):
+    # keep the first record having each unique digest of the key columns, and 
+    # drop any record whose digest is already in the table covered by digest_index.
+    # returns the filtered DataFrame, and boolean arrays marking the records dropped
+    # as duplicates within df and the records dropped as already in the database.
+    digests = compute_record_digests(df, key_columns)
+    duplicated = pd.Series(digests).duplicated(keep='first').to_numpy()
+    existing = digest_index.contains(digests) if digest_index is not None else np.zeros(len(digests), dtype=bool)
+    keep = ~(duplicated | existing)
+    return df[keep].reset_index(drop=True), duplicated & ~existing, existing
+
+
+#
+# incremental ETL runs
+#
+
+def file_sha256(filename):
+    # content hash of a source file, read in blocks
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def compute_mapping_plan_key(version, filenames, *args):
+    # key of a mapping plan, from its compiler version, the sha256 hashes of the files
+    # it is compiled from and any other arguments that change it, e.g. sheet names
+    h = hashlib.sha256(repr((version, args)).encode('utf-8'))
+    for filename in filenames:
+        h.update(file_sha256(filename).encode('utf-8'))
+    return h.hexdigest()
+
+
+class ETLIncrementalManifest():
+    # local .npz manifest of the source files and source rows that have already been loaded
+    # with a mapping plan. files are tracked by their sha256 content hash, and rows by a stable 
+    # digest of all of their values, kept in separate namespaces (e.g. one per lab sheet). 
+    # the files and rows are only valid for the plan_key they were loaded with, see
+    # compute_mapping_plan_key(), when the mapping plan changes they are all processed again.
+    # a new or changed row has a digest that is not in the manifest yet, and a row whose
+    # identity key columns (e.g. participant and collection date) are already in the manifest
+    # is flagged as changed, its records are appended next to those of the earlier version.
+    # lookups do not change the manifest, so it can be shared with worker processes, call
+    # add_file(), add_row_fingerprints() and save() once the new records have been written.
+    def __init__(self, manifest_path, plan_key):
+        self.manifest_path = manifest_path
+        self.plan_key = plan_key
+        self.files = {}
+        self.row_fingerprints = {}
+        self.row_key_fingerprints = {}
+        if os.path.exists(manifest_path):
+            with np.load(manifest_path) as manifest:
+                if str(manifest['plan_key']) != plan_key:
+                    sys.stderr.write(f"Incremental manifest '{manifest_path}' was made with another mapping plan, all files and rows are processed again.\n")
+                    return
+                self.files = dict(zip(manifest['file_names'].tolist(), manifest['file_sha256s'].tolist()))
+                for i, namespace in enumerate(manifest['namespaces'].tolist()):
+                    self.row_fingerprints[namespace] = manifest[f'row_fingerprints_{i}']
+                    self.row_key_fingerprints[namespace] = manifest[f'row_key_fingerprints_{i}']
+
+    def is_file_unchanged(self, filename, sha256):
+        return self.files.get(filename) == sha256
+
+    def add_file(self, filename, sha256):
+        self.files[filename] = sha256
+
+    def select_unprocessed_rows(self, df, namespace, key_columns):
+        # returns the rows of df that are new or changed since they were last loaded, the
+        # fingerprints of those rows and of their key_columns, and a mask of the changed rows,
+        # those whose key_columns match a row that was already loaded
+        fingerprints = compute_record_digests(df, list(df.columns))
+        key_fingerprints = compute_record_digests(df, key_columns)
+        processed = np.isin(fingerprints, self.row_fingerprints.get(namespace, np.empty(0, dtype=np.uint64)))
+        changed = np.isin(key_fingerprints[~processed], self.row_key_fingerprints.get(namespace, np.empty(0, dtype=np.uint64)))
+        return df[~processed].reset_index(drop=True), fingerprints[~processed], key_fingerprints[~processed], changed
+
+    def add_row_fingerprints(self, namespace, fingerprints, key_fingerprints):
+        # remember rows that were loaded, or rejected for good, leave out rows that should be retried
+        self.row_fingerprints[namespace] = np.union1d(self.row_fingerprints.get(namespace, np.empty(0, dtype=np.uint64)), fingerprints)
+        self.row_key_fingerprints[namespace] = np.union1d(self.row_key_fingerprints.get(namespace, np.empty(0, dtype=np.uint64)), key_fingerprints)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        namespaces = list(self.row_fingerprints.keys())
+        arrays = {}
+        for i, namespace in enumerate(namespaces):
+            arrays[f'row_fingerprints_{i}'] = self.row_fingerprints[namespace]
+            arrays[f'row_key_fingerprints_{i}'] = self.row_key_fingerprints[namespace]
+        temp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(f, plan_key=np.array(self.plan_key), 
+                     file_names=np.array(list(self.files.keys()), dtype=str), file_sha256s=np.array(list(self.files.values()), dtype=str),
+                     namespaces=np.array(namespaces, dtype=str), **arrays)
+        os.replace(temp_path, self.manifest_path)
+
+
+#
+# local snapshots of the reference data read by each run
+#
+
+class OMOPReferenceSnapshotCache():
+    # parquet snapshots of the reference tables and files the ETLs read on every run, kept
+    # in cache_dir and shared by the labs and MoCA ETLs, each next to a json file with the key
+    # it was saved under. a table snapshot is keyed by the table's row count and highest id,
+    # and the postgres statistics counters of its updated and deleted rows, so no row values 
+    # are read to check it. when only rows above the highest id were added, just those are read
+    # and merged into the snapshot, any other change reloads it. a file snapshot is keyed by 
+    # the file's mtime and size, with the sha256 content hash checked when those change. 
+    # snapshots that can't be written as parquet, e.g. without pyarrow, are not cached. 
+    # the id maxima used to allocate new record ids are never cached.
+    def __init__(self, cache_dir, engine):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.engine = engine
+        sys.stderr.write(f"Using reference snapshots in '{self.cache_dir}'.\n")
+
+    def get_snapshot_path(self, name, key):
+        # path of the snapshot without its .parquet and .json extensions
+        digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=8).hexdigest()
+        return os.path.join(self.cache_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}_{digest}")
+
+    def load_snapshot(self, path):
+        # the key and DataFrame of the snapshot, or None, None
+        if not os.path.exists(f'{path}.json'):
+            return None, None
+        try:
+            with open(f'{path}.json', 'r') as f:
+                key = json.load(f)
+            df = pd.read_parquet(f'{path}.parquet')
+        except Exception:
+            sys.stderr.write(f"Unable to read reference snapshot '{path}', ignoring it.\n")
+            return None, None
+        # pd.read_csv and pd.read_excel leave the missing values of object columns as NaN, not None
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].where(df[column].notna(), np.nan)
+        return key, df
+
+    def save_snapshot(self, path, key, df):
+        # the key file is removed first and written last, so a key is never paired with another snapshot's data
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if os.path.exists(f'{path}.json'):
+            os.remove(f'{path}.json')
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            df.to_parquet(temp_path, index=False)
+        except Exception as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            sys.stderr.write(f"Unable to write reference snapshot '{path}', not caching it: {e}\n")
+            return
+        os.replace(temp_path, f'{path}.parquet')
+        self.save_snapshot_key(path, key)
+
+    def save_snapshot_key(self, path, key):
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(key, f)
+        os.replace(temp_path, f'{path}.json')
+
+    def get_table_watermark(self, tablename, id_column_name, high_water_id):
+        # the row count and highest id of the table, the count of the rows with ids up to 
+        # high_water_id, and the table's counters of updated and deleted rows, None when
+        # postgres keeps no statistics for it
+        query = text(f"""SELECT COUNT(*) FILTER (WHERE {id_column_name} <= :high_water_id), COUNT(*), MAX({id_column_name})
+                         FROM {tablename}""")
+        stats_query = text("SELECT n_tup_upd, n_tup_del FROM pg_stat_user_tables WHERE relid = to_regclass(:tablename)")
+        with self.engine.connect() as connection:
+            n_old, n_rows, max_id = connection.execute(query, {'high_water_id': high_water_id}).one()
+            stats = connection.execute(stats_query, {'tablename': tablename}).one_or_none()
+        if stats is None:
+            return None, None
+        n_updated, n_deleted = int(stats[0]), int(stats[1])
+        old = {'row_count': int(n_old), 'high_water_id': high_water_id, 'n_tup_upd': n_updated, 'n_tup_del': n_deleted}
+        current = {'row_count': int(n_rows), 'high_water_id': -1 if max_id is None else int(max_id), 'n_tup_upd': n_updated, 'n_tup_del': n_deleted}
+        return old, current
+
+    def read_table_snapshot(self, name, tablename, id_column_name, query, reduce):
+        # the result of query over the whole table. query selects from the rows of tablename 
+        # with {id_column_name} > :after_id. reduce() merges a snapshot with the rows read since it was saved.
+        path = self.get_snapshot_path(name, (tablename, query))
+        watermark, df_snapshot = self.load_snapshot(path)
+        high_water_id = watermark['high_water_id'] if watermark is not None else -1
+        old, current = self.get_table_watermark(tablename, id_column_name, high_water_id)
+        if current is None:
+            sys.stderr.write(f"No table statistics for '{tablename}', reading it from the database without a snapshot.\n")
+            return reduce(pd.read_sql(text(query), self.engine, params={'after_id': -1}))
+
+        if watermark is not None and watermark == current:
+            sys.stderr.write(f"Reference snapshot '{name}' of '{tablename}' is up to date.\n")
+            return df_snapshot
+
+        if watermark is not None and watermark == old:
+            # the rows in the snapshot are unchanged, read the rows added above its highest id
+            df_new = pd.read_sql(text(query), self.engine, params={'after_id': high_water_id})
+            sys.stderr.write(f"Refreshing reference snapshot '{name}' of '{tablename}' with {df_new.shape[0]} rows read from the database.\n")
+            df = reduce(pd.concat((df_snapshot, df_new), axis=0, ignore_index=True))
+        else:
+            df = reduce(pd.read_sql(text(query), self.engine, params={'after_id': -1}))
+            sys.stderr.write(f"Loaded reference snapshot '{name}' of '{tablename}' with {df.shape[0]} rows from the database.\n")
+        self.save_snapshot(path, current, df)
+        return df
+
+    def read_person_birth_years(self, tablename):
+        # person_id and year_of_birth of everyone in the person table
+        query = f"SELECT person_id, year_of_birth FROM {tablename} WHERE person_id > :after_id"
+        return self.read_table_snapshot('person', tablename, 'person_id', query, 
+                                        lambda df: df.drop_duplicates('person_id', keep='last').reset_index(drop=True))
+
+    def read_earliest_visits(self, tablename, visit_concept_id):
+        # person_id, visit_occurrence_id and visit_start_date of each person's earliest visit of
+        # visit_concept_id, ties on the start date go to the lowest visit_occurrence_id
+        query = f"""SELECT DISTINCT ON (person_id) person_id, visit_occurrence_id, visit_start_date
+                    FROM {tablename}
+                    WHERE visit_concept_id = {visit_concept_id} AND visit_occurrence_id > :after_id
+                    ORDER BY person_id, visit_start_date, visit_occurrence_id"""
+        return self.read_table_snapshot(f'earliest_visit_{visit_concept_id}', tablename, 'visit_occurrence_id', query,
+                                        lambda df: df.sort_values(['person_id', 'visit_start_date', 'visit_occurrence_id'], kind='stable')
+                                                     .drop_duplicates('person_id').reset_index(drop=True))
+
+    def read_file(self, filename, reader, *args, **kwargs):
+        # reader(filename, *args, **kwargs), a DataFrame reader e.g. pd.read_csv, from the snapshot when the file is unchanged
+        path = self.get_snapshot_path(os.path.basename(filename), (os.path.abspath(filename), reader.__module__, reader.__qualname__, args, sorted(kwargs.items())))
+        stat = os.stat(filename)
+        key, df = self.load_snapshot(path)
+        if key is not None:
+            if (key['mtime_ns'], key['size']) == (stat.st_mtime_ns, stat.st_size):
+                sys.stderr.write(f"Reference snapshot of '{filename}' is up to date.\n")
+                return df
+            sha256 = file_sha256(filename)
+            if key['sha256'] == sha256:
+                sys.stderr.write(f"Reference snapshot of '{filename}' is up to date, content unchanged.\n")
+                self.save_snapshot_key(path, dict(key, mtime_ns=stat.st_mtime_ns, size=stat.st_size))
+                return df
+        else:
+            sha256 = file_sha256(filename)
+        df = reader(filename, *args, **kwargs)
+        sys.stderr.write(f"Loaded reference snapshot of '{filename}'.\n")
+        self.save_snapshot(path, {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': sha256}, df)
+        return df
+
+
+
+#
+# diagnostics collected over a whole run
+#
+
+class ETLDiagnostics():
+    # counts the warnings and rejections of a run by reason and key, e.g. the lab mapping
+    # or source file, keeping the first max_samples samples of each, instead of writing every
+    # event to stderr as it happens. with quarantine on, the full rejected rows are kept so 
+    # they can be written to a csv or parquet file. picklable, so each worker process can
+    # collect its own and the results are merged in work order.
+    def __init__(self, name, max_samples=5, quarantine=False):
+        self.name = name
+        self.max_samples = max_samples
+        self.quarantine = quarantine
+        self.counts = {}
+        self.samples = {}
+        self.quarantined = []
+
+    def add(self, reason, key=None, sample=None, count=1):
+        # count one or more events, sample is e.g. the person_id of the record
+        self.counts[(reason, key)] = self.counts.get((reason, key), 0) + count
+        samples = self.samples.setdefault((reason, key), [])
+        if sample is not None and len(samples) < self.max_samples:
+            samples.append(sample)
+
+    def add_rows(self, reason, df, key_column=None, sample_column=None, quarantine=True):
+        # count the rows of df by the values of key_column, with samples from sample_column,
+        # and quarantine the rows tagged with the reason
+        if df.shape[0] == 0:
+            return
+        keys = df[key_column] if key_column is not None else pd.Series(None, index=df.index, dtype=object)
+        for key, df_key in df.groupby(keys.to_numpy(dtype=object), sort=False, dropna=False):
+            key = None if pd.isna(key) else key
+            self.counts[(reason, key)] = self.counts.get((reason, key), 0) + df_key.shape[0]
+            samples = self.samples.setdefault((reason, key), [])
+            if sample_column is not None:
+                samples.extend(df_key[sample_column].iloc[:max(0, self.max_samples - len(samples))].tolist())
+        if self.quarantine and quarantine:
+            df = df.copy()
+            df.insert(0, 'etl_reason', reason)
+            self.quarantined.append(df)
+
+    def quarantine_record(self, reason, record):
+        # quarantine one rejected record, a dict of its fields, kept as a dict until the quarantine is written
+        if self.quarantine:
+            self.quarantined.append(dict(etl_reason=reason, **record))
+
+    def merge(self, other):
+        # add the events collected by another ETLDiagnostics, e.g. from a worker process
+        for (reason, key), count in other.counts.items():
+            self.counts[(reason, key)] = self.counts.get((reason, key), 0) + count
+            samples = self.samples.setdefault((reason, key), [])
+            samples.extend(other.samples.get((reason, key), [])[:max(0, self.max_samples - len(samples))])
+        self.quarantined.extend(other.quarantined)
+        return self
+
+    def get_total(self, reason=None):
+        return sum(count for (r, key), count in self.counts.items() if reason is None or r == reason)
+
+    def write_summary(self, max_keys=20, stream=None):
+        # write the counts of each reason, and of its max_keys most common keys with their samples
+        stream = stream if stream is not None else sys.stderr
+        reasons = {}
+        for (reason, key), count in self.counts.items():
+            reasons.setdefault(reason, []).append((key, count))
+        stream.write(f"{self.name} diagnostics, {self.get_total()} events:\n")
+        for reason, key_counts in reasons.items():
+            stream.write(f"\t{reason}: {sum(count for key, count in key_counts)}\n")
+            key_counts = sorted(key_counts, key=lambda key_count: -key_count[1])
+            for key, count in key_counts[:max_keys]:
+                label = f"'{key}'" if key is not None else 'samples'
+                stream.write(f"\t\t{label}: {count}, e.g. {self.samples.get((reason, key), [])}\n")
+            if len(key_counts) > max_keys:
+                stream.write(f"\t\t... and {len(key_counts) - max_keys} more\n")
+
+    def write_quarantine(self, path):
+        # write the quarantined rows to path, a parquet file if it ends with .parquet otherwise a csv file,
+        # returns the number of rows written
+        # each run of quarantined records becomes one DataFrame, in the order they were quarantined
+        frames, records = [], []
+        for item in self.quarantined:
+            if isinstance(item, dict):
+                records.append(item)
+                continue
+            if records:
+                frames.append(pd.DataFrame(records))
+                records = []
+            frames.append(item)
+        if records:
+            frames.append(pd.DataFrame(records))
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['etl_reason'])
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if path.endswith('.parquet'):
+            # mixed source columns are written as strings, parquet columns must have one type
+            for c in df.columns[df.dtypes == object]:
+                df[c] = df[c].map(lambda v: None if pd.isna(v) else str(v))
+            df.to_parquet(path, index=False)
+        else:
+            df.to_csv(path, index=False)
+        return df.shape[0]
+
+
+#
+# per-stage timing, throughput and memory of a run
+#
+
+def get_peak_rss_mb(children=False):
+    # high-water mark of the resident memory of this process, or of its largest finished
+    # worker process with children, None without the resource module. ru_maxrss is in
+    # bytes on macOS and in KB on linux and the BSDs
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024.0 * 1024.0) if sys.platform == 'darwin' else maxrss / 1024.0
+
+
+def round_mb(mb):
+    return round(mb, 1) if mb is not None else None
+
+
+class ETLRunReport():
+    # times each stage of a run and records its record count, records/sec and memory,
+    # and writes them as a JSON report. the process memory high-water mark is only ever 
+    # raised, so each stage records the peak at its end and how much the stage raised it.
+    # with profile on, each stage also runs under cProfile and tracemalloc, the traced peak
+    # of the stage is added to the report, and the profile stats and top allocations are
+    # dumped next to it. tracemalloc only sees this process, not worker processes. a stage
+    # that raises is recorded as failed, with its error, and the report is written right away.
+    def __init__(self, name, report_path=None, profile=False, **info):
+        self.name = name
+        self.report_path = report_path
+        self.profile = profile
+        self.info = dict(info)
+        self.stages = []
+        self.started = datetime.datetime.now().isoformat(timespec='seconds')
+        self.start = time.perf_counter()
+        if self.profile:
+            self.profile_dir = os.path.splitext(report_path or f'./{name}_run_report')[0] + '_profile'
+            os.makedirs(self.profile_dir, exist_ok=True)
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, stage_name):
+        # with report.stage('transform') as stage: ... stage.records = n
+        stage = dotdict(records=None)
+        profiler = None
+        if self.profile:
+            tracemalloc.reset_peak()
+            profiler = cProfile.Profile()
+            profiler.enable()
+        peak_rss_before = get_peak_rss_mb()
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield stage
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # a failed stage is recorded too, and the report written, so the run's timings aren't lost
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+            peak_rss = get_peak_rss_mb()
+            result = {'stage': stage_name,
+                      'seconds': round(elapsed, 4),
+                      'cpu_seconds': round(time.process_time() - cpu_start, 4),
+                      'records': stage.records,
+                      'records_per_second': round(stage.records / elapsed, 1) if stage.records is not None and elapsed > 0 else None,
+                      'peak_rss_mb': round_mb(peak_rss),
+                      'peak_rss_growth_mb': round_mb(peak_rss - peak_rss_before) if peak_rss is not None else None,
+                      'peak_worker_rss_mb': round_mb(get_peak_rss_mb(children=True)),
+                      'failed': error is not None}
+            if error is not None:
+                result['error'] = f'{type(error).__name__}: {error}'
+            if profiler is not None:
+                result['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0), 1)
+                profiler.dump_stats(os.path.join(self.profile_dir, f'{stage_name}.prof'))
+                with open(os.path.join(self.profile_dir, f'{stage_name}.txt'), 'w') as f:
+                    pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(40)
+                    f.write('Top allocations still held at the end of the stage:\n')
+                    for statistic in tracemalloc.take_snapshot().statistics('lineno')[:25]:
+                        f.write(f'{statistic}\n')
+            self.stages.append(result)
+            rate = f", {result['records_per_second']:0.0f} records/sec" if result['records_per_second'] is not None else ''
+            memory = f", peak memory {result['peak_rss_mb']:0.0f} MB" if result['peak_rss_mb'] is not None else ''
+            if error is not None:
+                sys.stderr.write(f"Stage '{stage_name}' failed after {elapsed:0.2f} seconds{memory}: {result['error']}\n")
+                self.write()
+            else:
+                sys.stderr.write(f"Stage '{stage_name}' took {elapsed:0.2f} seconds{rate}{memory}.\n")
 
+    def get_report(self):
+        return dict(self.info, etl=self.name, started=self.started, 
+                    seconds=round(time.perf_counter() - self.start, 4),
+                    peak_rss_mb=round_mb(get_peak_rss_mb()),
+                    peak_worker_rss_mb=round_mb(get_peak_rss_mb(children=True)),
+                    profile=self.profile, stages=self.stages)
 
+    def write(self):
+        # write the report, when there is a report_path, and stop tracing memory
+        if self.profile:
+            tracemalloc.stop()
+            sys.stderr.write(f"Wrote stage profiles to '{self.profile_dir}'.\n")
+        if self.report_path is None:
+            return
+        os.makedirs(os.path.dirname(self.report_path) or '.', exist_ok=True)
+        temp_path = f'{self.report_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.get_report(), f, indent=2, default=str)
+        os.replace(temp_path, self.report_path)
+        sys.stderr.write(f"Wrote run report '{self.report_path}'.\n")
@@ -0,0 +1,172 @@
+#
+# test_omop_copy_formats.py
+# checks the COPY text and binary formatting in omop_etl_utils.py without a database.
+# the end to end check against postgres is test_omop_copy_loader.py.
+#
+# usage: python -m pytest test_omop_copy_formats.py
+#
+import struct
+import decimal
+import datetime
+import numpy as np
+import pandas as pd
+
+from omop_etl_utils import format_copy_text_value, dataframe_to_copy_text_buffer
+from omop_etl_utils import dataframe_to_copy_binary_buffer, POSTGRES_COPY_BINARY_ENCODERS
+from omop_etl_utils import encode_postgres_numeric, encode_postgres_timestamp, encode_postgres_date, encode_postgres_text
+
+
+def decode_postgres_numeric(data):
+    # inverse of encode_postgres_numeric(), to check the encoded digit groups
+    ndigits, weight, sign, dscale = struct.unpack('>hhHH', data[:8])
+    groups = struct.unpack(f'>{ndigits}H', data[8:])
+    value = sum(decimal.Decimal(g) * decimal.Decimal(10000) ** (weight - i) for i, g in enumerate(groups))
+    return -value if sign else value, dscale
+
+
+def read_copy_binary_rows(buffer, n_columns):
+    # parse a COPY binary buffer back into rows of raw field bytes, None for NULL
+    data = buffer.read()
+    assert data[:11] == b'PGCOPY\n\xff\r\n\x00'
+    assert struct.unpack('>ii', data[11:19]) == (0, 0)
+    position = 19
+    rows = []
+    while True:
+        (field_count,) = struct.unpack('>h', data[position:position + 2])
+        position += 2
+        if field_count == -1:
+            break
+        assert field_count == n_columns
+        row = []
+        for i in range(field_count):
+            (length,) = struct.unpack('>i', data[position:position + 4])
+            position += 4
+            if length == -1:
+                row.append(None)
+            else:
+                row.append(data[position:position + length])
+                position += length
+        rows.append(row)
+    assert position == len(data)
+    return rows
+
+
+def test_format_copy_text_value_nulls():
+    for v in (None, np.nan, float('nan'), pd.NaT):
+        assert format_copy_text_value(v) == '\\N'
+
+
+def test_format_copy_text_value_escapes_strings():
+    assert format_copy_text_value('NT-proBNP\tC\\A "1"') == 'NT-proBNP\\tC\\\\A "1"'
+    assert format_copy_text_value('line one\nline two\r') == 'line one\\nline two\\r'
+    assert format_copy_text_value("it's 'quoted'") == "it's 'quoted'"
+    assert format_copy_text_value('') == ''
+
+
+def test_format_copy_text_value_numbers():
+    # integral floats have no fraction so they load into integer columns
+    assert format_copy_text_value(3.0) == '3'
+    assert format_copy_text_value(np.float64(-12.0)) == '-12'
+    assert format_copy_text_value(0.001) == '0.001'
+    assert format_copy_text_value(1234567.125) == '1234567.125'
+    assert format_copy_text_value(42) == '42'
+    assert format_copy_text_value(np.int64(7)) == '7'
+
+
+def test_format_copy_text_value_dates_and_times():
+    assert format_copy_text_value(datetime.date(2023, 5, 1)) == '2023-05-01'
+    assert format_copy_text_value(datetime.datetime(2023, 5, 1, 8, 30, 15)) == '2023-05-01 08:30:15'
+    assert format_copy_text_value(datetime.datetime(2023, 6, 1, 12, 0, 0, 250000)) == '2023-06-01 12:00:00.250000'
+    assert format_copy_text_value(datetime.time(8, 30, 15)) == '08:30:15'
+
+
+def test_dataframe_to_copy_text_buffer():
+    df = pd.DataFrame({
+        'measurement_id': [1, 2, 3],
+        'measurement_date': [datetime.date(2023, 5, 1), datetime.date(2023, 5, 2), None],
+        'measurement_datetime': pd.to_datetime(['2023-05-01 08:30:15', None, '2023-05-03 00:00:00']),
+        'value_as_number': [12.5, 3.0, np.nan],
+        'visit_occurrence_id': [None, 501, 502],
+        'measurement_source_value': ['a\tb', 'c\\d', 'e\nf'],
+    })
+    columns = ['measurement_id', 'measurement_date', 'measurement_datetime', 'value_as_number', 'visit_occurrence_id', 'measurement_source_value']
+    lines = dataframe_to_copy_text_buffer(df, columns).read().split('\n')
+    assert lines == [
+        '1\t2023-05-01\t2023-05-01 08:30:15.000000\t12.5\t\\N\ta\\tb',
+        '2\t2023-05-02\t\\N\t3\t501\tc\\\\d',
+        '3\t\\N\t2023-05-03 00:00:00.000000\t\\N\t502\te\\nf',
+        '',
+    ]
+
+
+def test_dataframe_to_copy_text_buffer_column_order():
+    # the buffer follows the explicit column order, not the DataFrame's
+    df = pd.DataFrame({'b': [2], 'a': [1]})
+    assert dataframe_to_copy_text_buffer(df, ['a', 'b']).read() == '1\t2\n'
+
+
+def test_dataframe_to_copy_text_buffer_empty():
+    df = pd.DataFrame({'a': pd.Series([], dtype=object)})
+    assert dataframe_to_copy_text_buffer(df, ['a']).read() == ''
+
+
+def test_encode_postgres_numeric():
+    for v in (0, 1, -1, 12.5, 0.001, 1234567.125, -3.0, 100, 450.25, 10000, 0.0001, 123456789):
+        value, dscale = decode_postgres_numeric(encode_postgres_numeric(v))
+        assert value == decimal.Decimal(repr(float(v)) if isinstance(v, float) else str(v))
+    # the display scale is the number of fraction digits
+    assert decode_postgres_numeric(encode_postgres_numeric(12.5))[1] == 1
+    assert decode_postgres_numeric(encode_postgres_numeric(0.001))[1] == 3
+    assert decode_postgres_numeric(encode_postgres_numeric(100))[1] == 0
+    # zero has no digit groups
+    assert encode_postgres_numeric(0) == struct.pack('>hhHH', 0, 0, 0, 0)
+
+
+def test_encode_postgres_date_and_timestamp():
+    assert struct.unpack('>i', encode_postgres_date(datetime.date(2000, 1, 1)))[0] == 0
+    assert struct.unpack('>i', encode_postgres_date(datetime.date(1999, 12, 31)))[0] == -1
+    assert struct.unpack('>i', encode_postgres_date(datetime.datetime(2000, 1, 2, 23, 59)))[0] == 1
+    assert struct.unpack('>q', encode_postgres_timestamp(datetime.datetime(2000, 1, 1)))[0] == 0
+    assert struct.unpack('>q', encode_postgres_timestamp(pd.Timestamp('2000-01-02 00:00:01.250000')))[0] == 86401250000
+    assert struct.unpack('>q', encode_postgres_timestamp(datetime.datetime(1999, 12, 31, 23, 59, 59)))[0] == -1000000
+
+
+def test_encode_postgres_text():
+    assert encode_postgres_text('pg/mL') == b'pg/mL'
+    assert encode_postgres_text('µg') == 'µg'.encode('utf-8')
+    assert encode_postgres_text(datetime.time(8, 30, 15)) == b'08:30:15'
+    assert encode_postgres_text(datetime.date(2023, 5, 1)) == b'2023-05-01'
+
+
+def test_postgres_copy_binary_integer_encoders():
+    assert POSTGRES_COPY_BINARY_ENCODERS['integer'](np.int64(-5)) == struct.pack('>i', -5)
+    assert POSTGRES_COPY_BINARY_ENCODERS['bigint'](3.0) == struct.pack('>q', 3)
+    assert POSTGRES_COPY_BINARY_ENCODERS['smallint'](7) == struct.pack('>h', 7)
+    assert POSTGRES_COPY_BINARY_ENCODERS['double precision'](0.5) == struct.pack('>d', 0.5)
+
+
+def test_dataframe_to_copy_binary_buffer():
+    df = pd.DataFrame({
+        'measurement_id': [1, 2],
+        'measurement_date': [datetime.date(2000, 1, 2), datetime.date(2000, 1, 1)],
+        'value_as_number': [12.5, np.nan],
+        'unit_source_value': ['pg/mL', None],
+    })
+    columns = ['measurement_id', 'measurement_date', 'value_as_number', 'unit_source_value']
+    column_types = {'measurement_id': 'integer', 'measurement_date': 'date', 'value_as_number': 'numeric',
+                    'unit_source_value': 'character varying'}
+    rows = read_copy_binary_rows(dataframe_to_copy_binary_buffer(df, columns, column_types), len(columns))
+    assert rows == [
+        [struct.pack('>i', 1), struct.pack('>i', 1), encode_postgres_numeric(12.5), b'pg/mL'],
+        [struct.pack('>i', 2), struct.pack('>i', 0), None, None],
+    ]
+
+
+def test_dataframe_to_copy_binary_buffer_unsupported_type():
+    df = pd.DataFrame({'a': [1]})
+    try:
+        dataframe_to_copy_binary_buffer(df, ['a'], {'a': 'jsonb'})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('unsupported column type did not raise')
@@ -0,0 +1,153 @@
+#
+# test_omop_copy_loader.py
+# simple script that checks the COPY based bulk loader in omop_etl_utils.py
+# against a postgres database. creates a scratch schema with the OMOP CDM 5.4
+# measurement and observation tables, copies sample records in both the text
+# and binary formats, reads them back, and then drops the scratch schema.
+#
+# usage: python test_omop_copy_loader.py [postgres connection string]
+# the connection string defaults to POSTGRES_CONN_STRING_KEY in labs_etl_parameters.py,
+# a local throwaway postgres is the intended target.
+#
+import sys
+import datetime
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+# utility imports
+from omop_etl_utils import create_empty_measurement_record
+from omop_etl_utils import create_empty_observation_record
+from omop_etl_utils import OMOPMeasurementRecord, OMOPObservationRecord, records_to_dataframe
+from omop_etl_utils import copy_dataframe_to_table
+from omop_etl_utils import OMOP_CDM_54_MEASUREMENT_COLUMNS, OMOP_CDM_54_OBSERVATION_COLUMNS
+from omop_etl_utils import OMOP_CDM_54_MEASUREMENT_DDL, OMOP_CDM_54_OBSERVATION_DDL
+from omop_etl_utils import get_table_row_count
+
+TEST_SCHEMA_NAME = 'omop_copy_loader_test'
+
+
+def create_test_measurements(n, first_id):
+    measurements = []
+    for i in range(n):
+        m = create_empty_measurement_record()
+        m.measurement_id = first_id + i
+        m.person_id = 1001 + i % 7
+        m.measurement_concept_id = 3020460
+        m.measurement_date = datetime.date(2023, 5, 1) + datetime.timedelta(days=i)
+        m.measurement_datetime = datetime.datetime(2023, 5, 1, 8, 30, 15) + datetime.timedelta(days=i)
+        m.measurement_time = '08:30:15'
+        m.measurement_type_concept_id = 32856
+        m.operator_concept_id = 4172703
+        m.value_as_number = [12.5, 0.001, 1234567.125, -3.0, 100][i % 5]
+        m.unit_concept_id = 8840
+        m.range_low = 0.0
+        m.range_high = 450.25
+        m.visit_occurrence_id = None if i % 3 == 0 else 500 + i
+        m.measurement_source_value = 'NT-proBNP\tC\\A "1"'
+        m.unit_source_value = 'pg/mL'
+        m.value_source_value = str(m.value_as_number)
+        measurements.append(m)
+    return records_to_dataframe(measurements, OMOPMeasurementRecord)
+
+
+def create_test_observations(n, first_id):
+    observations = []
+    for i in range(n):
+        o = create_empty_observation_record()
+        o.observation_id = first_id + i
+        o.person_id = 1001 + i % 7
+        o.observation_concept_id = 4064009
+        o.observation_date = datetime.date(2023, 6, 1)
+        o.observation_datetime = datetime.datetime(2023, 6, 1, 12, 0, 0, 250000)
+        o.observation_type_concept_id = 32880
+        o.value_as_string = 'line one\nline two' if i % 2 else "it's 'quoted'"
+        o.observation_source_value = 'moca_q1'
+        o.value_source_value = 'yes'
+        observations.append(o)
+    return records_to_dataframe(observations, OMOPObservationRecord)
+
+
+def check_copied_records(df_expected, schema_name, table_name, id_column_name, columns, engine):
+    df_read = pd.read_sql(text(f"SELECT {', '.join(columns)} FROM {schema_name}.{table_name} WHERE {id_column_name} BETWEEN :low AND :high ORDER BY {id_column_name}"),
+                          engine, params={'low': int(df_expected[id_column_name].min()), 'high': int(df_expected[id_column_name].max())})
+    if df_read.shape[0] != df_expected.shape[0]:
+        sys.stderr.write(f"Error read back {df_read.shape[0]} records, expected {df_expected.shape[0]}...")
+        return False
+    n_mismatches = 0
+    for c in columns:
+        for expected, found in zip(df_expected[c], df_read[c]):
+            if pd.isna(expected) and pd.isna(found):
+                continue
+            if isinstance(expected, float) or isinstance(found, float):
+                matched = abs(float(expected) - float(found)) < 1e-9
+            elif isinstance(expected, datetime.datetime):
+                matched = pd.Timestamp(expected) == pd.Timestamp(found)
+            else:
+                matched = expected == found or str(expected) == str(found)
+            if not matched:
+                n_mismatches += 1
+                sys.stderr.write(f"\n\tMismatch in column '{c}' expected '{expected}' found '{found}'")
+    return n_mismatches == 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        conn_string = sys.argv[1]
+    else:
+        from labs_etl_parameters import POSTGRES_CONN_STRING_KEY
+        conn_string = POSTGRES_CONN_STRING_KEY
+
+    sys.stderr.write("\n*** Begin COPY Loader Testing ***\n")
+    engine = create_engine(conn_string)
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {TEST_SCHEMA_NAME} CASCADE"))
+        connection.execute(text(f"CREATE SCHEMA {TEST_SCHEMA_NAME}"))
+        connection.execute(text(OMOP_CDM_54_MEASUREMENT_DDL.format(schema=TEST_SCHEMA_NAME)))
+        connection.execute(text(OMOP_CDM_54_OBSERVATION_DDL.format(schema=TEST_SCHEMA_NAME)))
+    sys.stderr.write(f"Created scratch schema '{TEST_SCHEMA_NAME}'.\n\n")
+
+    n_failed = 0
+    first_id = 1
+    for copy_format in ['text', 'binary']:
+        for table_name, id_column_name, columns, create_records in [
+                ('measurement', 'measurement_id', OMOP_CDM_54_MEASUREMENT_COLUMNS, create_test_measurements),
+                ('observation', 'observation_id', OMOP_CDM_54_OBSERVATION_COLUMNS, create_test_observations)]:
+            sys.stderr.write(f"Copying {table_name} records with the '{copy_format}' format...")
+            df = create_records(1000, first_id)
+            n_before = get_table_row_count(TEST_SCHEMA_NAME, table_name, engine)
+            n_copied = copy_dataframe_to_table(df, TEST_SCHEMA_NAME, table_name, columns, engine, copy_format=copy_format)
+            n_counted = get_table_row_count(TEST_SCHEMA_NAME, table_name, engine) - n_before
+            if n_copied != df.shape[0] or n_counted != df.shape[0]:
+                sys.stderr.write(f"Error copied {n_copied} and counted {n_counted} records, expected {df.shape[0]}.\n")
+                n_failed += 1
+            elif not check_copied_records(df, TEST_SCHEMA_NAME, table_name, id_column_name, columns, engine):
+                sys.stderr.write("\nError records read back do not match.\n")
+                n_failed += 1
+            else:
+                sys.stderr.write(f"OK, copied {n_copied} records.\n")
+        first_id += 1000
+
+    # a failing COPY must leave nothing behind
+    sys.stderr.write("Checking a failed copy is rolled back...")
+    df = create_test_measurements(10, first_id)
+    df.loc[5, 'measurement_date'] = None
+    n_before = get_table_row_count(TEST_SCHEMA_NAME, 'measurement', engine)
+    try:
+        copy_dataframe_to_table(df, TEST_SCHEMA_NAME, 'measurement', OMOP_CDM_54_MEASUREMENT_COLUMNS, engine)
+        sys.stderr.write("Error copy with a NULL measurement_date did not fail.\n")
+        n_failed += 1
+    except Exception:
+        if get_table_row_count(TEST_SCHEMA_NAME, 'measurement', engine) != n_before:
+            sys.stderr.write("Error failed copy was not rolled back.\n")
+            n_failed += 1
+        else:
+            sys.stderr.write("OK.\n")
+
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP SCHEMA {TEST_SCHEMA_NAME} CASCADE"))
+    sys.stderr.write(f"\nDropped scratch schema '{TEST_SCHEMA_NAME}'.\n")
+
+    if n_failed:
+        sys.stderr.write(f"*** COPY Loader Testing FAILED {n_failed} checks ***\n")
+        sys.exit(1)
+    sys.stderr.write("*** COPY Loader Testing Completed ***\n")